@@ -0,0 +1,435 @@
+"""Benchmarks of the API and CLI hot paths.
+
+Generate a synthetic library into a temporary `memes.sqlite`, drive the views
+with the Flask test client and the CLI commands with click's runner, and
+report throughput and latency percentiles as JSON:
+
+    $ python -m benchmarks.bench --images 100000 --output bench.json
+    $ python -m benchmarks.bench --images 100000 --baseline bench.json
+
+With --baseline, every scenario is compared against the stored result and the
+exit status is 1 if any of them regressed by more than --threshold.
+"""
+import hashlib
+import json
+import math
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from io import BytesIO
+from pathlib import Path
+
+import click
+from click.testing import CliRunner
+from sqlalchemy import text
+
+from meme_manager import cli, create_app, db, blobs
+from meme_manager.cache import response_cache
+from meme_manager.migrations import stamp
+from meme_manager.search import INDEX_SELECT
+
+# rows per executemany() while generating a library.
+INSERT_BATCH_SIZE = 10000
+# (img_type, weight)
+IMG_TYPES = (('jpeg', 6), ('png', 3), ('gif', 1))
+# log-normal blob sizes: median ~60KB, a few MB at most.
+BLOB_SIZE_MU = math.log(60 * 1024)
+BLOB_SIZE_SIGMA = 1.0
+BLOB_SIZE_MAX = 8 * 2**20
+# untimed requests sent first by every API scenario: connections, statement
+# caches and the page cache are warm once they are done.
+WARMUP_REQUESTS = 3
+
+
+def blob_size(rng):
+    return min(int(rng.lognormvariate(BLOB_SIZE_MU, BLOB_SIZE_SIGMA)) + 64, BLOB_SIZE_MAX)
+
+
+def random_bytes(rng, size):
+    return rng.getrandbits(size * 8).to_bytes(size, 'little')
+
+
+def percentile(values, p):
+    """Nearest-rank percentile.
+    Params:
+        values [list[float]]: sorted.
+        p [float]: 0-100
+    """
+    if not values:
+        return None
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def summarize(latencies, elapsed=None, units=None):
+    """
+    Params:
+        latencies [list[float]]: seconds of each operation.
+        elapsed [float]: wall time of the scenario, default to the sum of latencies.
+        units [int]: items processed, default to the number of operations.
+    Return:
+        result [dict]: throughput in items per second, latencies in milliseconds.
+    """
+    latencies = sorted(latencies)
+    elapsed = sum(latencies) if elapsed is None else elapsed
+    units = len(latencies) if units is None else units
+    ms = lambda v: round(v * 1000, 3)
+    return {
+        'count': units,
+        'throughput': round(units / elapsed, 2) if elapsed else None,
+        'mean_ms': ms(sum(latencies) / len(latencies)),
+        'p50_ms': ms(percentile(latencies, 50)),
+        'p90_ms': ms(percentile(latencies, 90)),
+        'p99_ms': ms(percentile(latencies, 99)),
+        'max_ms': ms(latencies[-1]),
+    }
+
+
+def make_app(db_path):
+    app = create_app('production')
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
+    # every request would be slow on a cold cache, do not log them.
+    app.config['METRICS_SLOW_REQUEST'] = None
+    return app
+
+
+class Library(object):
+    """Shape of a synthetic library.
+    Params:
+        images [int]
+        groups [int]: images are spread over groups with a Zipf-like fan-out.
+        ungrouped [float]: ratio of images in no group.
+        tags [int]: size of the tag vocabulary, used with a Zipf-like frequency.
+        tags_per_image [tuple[int, int]]: (min, max)
+        blobs [int]: images whose blob is written to storage, the others get
+            a unique fake digest. Written blobs have log-normal sizes.
+        seed [int]
+    """
+
+    def __init__(self, images, groups=50, ungrouped=0.2, tags=2000,
+                 tags_per_image=(1, 5), blobs=1000, seed=0):
+        self.images = images
+        self.groups = groups
+        self.ungrouped = ungrouped
+        self.tags = tags
+        self.tags_per_image = tags_per_image
+        self.blobs = min(blobs, images)
+        self.seed = seed
+
+    def meta(self):
+        return dict(vars(self))
+
+    def generate(self, db_path, echo=print):
+        """Create the database file, its blob storage and every row."""
+        rng = random.Random(self.seed)
+        app = make_app(db_path)
+        with app.app_context():
+            db.create_all()
+            stamp()
+
+            group_names = [f'group{i}' for i in range(self.groups)]
+            db.session.execute(
+                text('INSERT INTO "group" (id, name) VALUES (:id, :name)'),
+                [{'id': i + 1, 'name': name} for i, name in enumerate(group_names)],
+            )
+            tag_names = [f'tag{i}' for i in range(self.tags)]
+            db.session.execute(
+                text('INSERT INTO tag (id, name) VALUES (:id, :name)'),
+                [{'id': i + 1, 'name': name} for i, name in enumerate(tag_names)],
+            )
+            # Zipf-like weights: a few groups and tags are much more popular.
+            group_weights = [1 / (i + 1) for i in range(self.groups)]
+            tag_weights = [1 / (i + 1) for i in range(self.tags)]
+            types, type_weights = zip(*IMG_TYPES)
+
+            start = datetime(2020, 1, 1)
+            images, image_tags = [], []
+            for image_id in range(1, self.images + 1):
+                img_type = rng.choices(types, type_weights)[0]
+                if image_id <= self.blobs:
+                    data = random_bytes(rng, blob_size(rng))
+                    digest, size = blobs.put(data), len(data)
+                else:
+                    digest = hashlib.sha256(b'fake%d' % image_id).hexdigest()
+                    size = blob_size(rng)
+                group_id = None
+                if self.groups and rng.random() >= self.ungrouped:
+                    group_id = rng.choices(range(1, self.groups + 1), group_weights)[0]
+                images.append({
+                    'id': image_id,
+                    'digest': digest,
+                    'size': size,
+                    'img_type': img_type,
+                    'phash': '%016x' % rng.getrandbits(64),
+                    'filename': f'meme{image_id}.{img_type}',
+                    'group_id': group_id,
+                    'create_at': start + timedelta(minutes=image_id + rng.randrange(60)),
+                })
+                n = rng.randint(*self.tags_per_image)
+                for tag_id in set(rng.choices(range(1, self.tags + 1), tag_weights, k=n)):
+                    image_tags.append({'tag_id': tag_id, 'image_id': image_id})
+
+                if len(images) >= INSERT_BATCH_SIZE or image_id == self.images:
+                    self.insert(images, image_tags)
+                    images, image_tags = [], []
+                    echo(f'Generate images: {image_id}/{self.images}')
+
+            db.session.execute(text(f'INSERT INTO image_fts (rowid, tags, group_name, filename) {INDEX_SELECT}'))
+            db.session.commit()
+            db.session.execute(text('ANALYZE'))
+            db.session.commit()
+
+    def insert(self, images, image_tags):
+        db.session.execute(text(
+            'INSERT INTO image (id, digest, size, img_type, phash, filename, group_id, create_at) '
+            'VALUES (:id, :digest, :size, :img_type, :phash, :filename, :group_id, :create_at)'
+        ), images)
+        if image_tags:
+            db.session.execute(text(
+                'INSERT INTO image_tag (tag_id, image_id) VALUES (:tag_id, :image_id)'
+            ), image_tags)
+        db.session.commit()
+
+
+def run_requests(app, requests, cached=False):
+    """
+    Params:
+        app [Flask]
+        requests [Iterable[Callable[[FlaskClient], Response]]]
+        cached [bool]: False to invalidate the response cache before each request.
+    Return:
+        result [dict]
+    """
+    client = app.test_client()
+    requests = list(requests)
+    for send in requests[:WARMUP_REQUESTS]:
+        send(client).close()
+    latencies = []
+    began = time.perf_counter()
+    for send in requests:
+        if not cached:
+            with app.app_context():
+                response_cache.invalidate()
+        start = time.perf_counter()
+        resp = send(client)
+        resp.get_data()
+        resp.close()
+        latencies.append(time.perf_counter() - start)
+        if resp.status_code >= 400:
+            raise RuntimeError(f'{resp.status_code}: {resp.get_data(as_text=True)[:200]}')
+    result = summarize(latencies)
+    result['wall_throughput'] = round(len(latencies) / (time.perf_counter() - began), 2)
+    return result
+
+
+def api_scenarios(library, n, rng):
+    """
+    Params:
+        library [Library]
+        n [int]: requests per scenario.
+        rng [Random]
+    Return:
+        scenarios [dict[str, tuple[Iterable[Callable], bool]]]: name -> (requests, cached)
+    """
+    def get(path, **query_string):
+        return lambda client: client.get(path, query_string=query_string)
+
+    pages = max(1, library.images // 20)
+    types = [t for t, _ in IMG_TYPES]
+
+    def add_image(client):
+        img_type = rng.choice(types)
+        data = random_bytes(rng, blob_size(rng))
+        return client.post('/api/images/add', data={
+            'image': (BytesIO(data), f'bench.{img_type}'),
+            'metadata': json.dumps({'tags': ['bench', f'tag{rng.randrange(library.tags)}'], 'img_type': img_type}),
+        })
+
+    scenarios = {
+        'list_first_page': ([get('/api/images/')] * n, False),
+        'list_first_page_cached': ([get('/api/images/')] * n, True),
+        'list_deep_page': ([get('/api/images/', page=rng.randrange(pages) + 1) for _ in range(n)], False),
+        'list_keyset': ([get('/api/images/', after='')] * n, False),
+        'list_group': ([get('/api/images/', group=f'group{rng.randrange(max(library.groups, 1))}')
+                        for _ in range(n)], False),
+        'list_tag': ([get('/api/images/', tag=f'tag{rng.randrange(min(library.tags, 20))}')
+                      for _ in range(n)], False),
+        'list_tag_prefix': ([get('/api/images/', tag_prefix=f'tag{rng.randrange(10)}') for _ in range(n)], False),
+        'list_filter': ([get('/api/images/', filter=f'(tag:tag{rng.randrange(20)} OR tag:tag{rng.randrange(20)}) '
+                                                    f'-type:gif created>=2000')
+                         for _ in range(n)], False),
+        'search': ([get('/api/images/', q=f'tag{rng.randrange(min(library.tags, 100))}') for _ in range(n)], False),
+        'get_image': ([get('/api/images/', id=rng.randint(1, library.blobs)) for _ in range(n)], True),
+        'show_groups': ([get('/api/groups/')] * n, False),
+        'suggest_tags': ([get('/api/tags/suggest', prefix=f'tag{rng.randrange(100)}'[:rng.randint(1, 5)])
+                          for _ in range(n)], True),
+        'all_tags_top': ([get('/api/tags/all', limit=50)] * n, False),
+        'show_tags': ([get('/api/tags/', image_id=rng.randint(1, library.images)) for _ in range(n)], False),
+        'add_image': ([add_image] * n, False),
+    }
+    if library.groups == 0:
+        del scenarios['list_group']
+    return scenarios
+
+
+def cli_scenarios(db_path, workdir, files, rng, echo=print):
+    """Time `import` of a directory of files and `export` of that group.
+    Return:
+        results [dict[str, dict]]
+    """
+    src = workdir/'import'/'benchimport'
+    src.mkdir(parents=True)
+    for i in range(files):
+        (src/f'meme{i}.jpeg').write_bytes(random_bytes(rng, blob_size(rng)))
+
+    runner = CliRunner()
+    results = {}
+    start = time.perf_counter()
+    result = runner.invoke(cli, ['import', '--group', 'benchimport', str(src), str(db_path)])
+    elapsed = time.perf_counter() - start
+    if result.exit_code != 0:
+        raise RuntimeError(result.output)
+    results['cli_import'] = summarize([elapsed], elapsed, units=files)
+    echo(f'cli_import: {results["cli_import"]["throughput"]} images/s')
+
+    dest = workdir/'export'
+    dest.mkdir()
+    start = time.perf_counter()
+    result = runner.invoke(cli, ['export', '--group', 'benchimport', '--name-pattern', 'id', str(db_path), str(dest)])
+    elapsed = time.perf_counter() - start
+    if result.exit_code != 0:
+        raise RuntimeError(result.output)
+    results['cli_export'] = summarize([elapsed], elapsed, units=files)
+    echo(f'cli_export: {results["cli_export"]["throughput"]} images/s')
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Params:
+        results [dict]: output of run().
+        baseline [dict]: a previous output of run().
+        threshold [float]: tolerated slowdown, eg: 0.25 for 25%.
+    Return:
+        lines [list[str]], regressions [list[str]]: names of regressed scenarios.
+    """
+    lines, regressions = [], []
+    if results['meta']['library'] != baseline['meta']['library']:
+        lines.append('Warning: the baseline was measured on another library: '
+                     + json.dumps(baseline['meta']['library']))
+    for name, result in results['results'].items():
+        old = baseline['results'].get(name)
+        if old is None:
+            lines.append(f'{name:<24} new')
+            continue
+        changes = []
+        regressed = False
+        for key in ('p50_ms', 'p99_ms'):
+            if old[key]:
+                ratio = result[key] / old[key] - 1
+                changes.append(f'{key} {old[key]} -> {result[key]} ({ratio:+.0%})')
+                regressed |= key == 'p50_ms' and ratio > threshold
+        if old['throughput'] and result['throughput']:
+            ratio = result['throughput'] / old['throughput'] - 1
+            changes.append(f'throughput {old["throughput"]} -> {result["throughput"]} ({ratio:+.0%})')
+            regressed |= -ratio > threshold / (1 + threshold)
+        if regressed:
+            regressions.append(name)
+        lines.append(f'{name:<24} {"REGRESSION " if regressed else ""}' + ', '.join(changes))
+    return lines, regressions
+
+
+def run(library, requests=50, import_files=100, workdir=None, scenarios=None, echo=print):
+    """Generate the library and run the scenarios.
+    Params:
+        library [Library]
+        requests [int]: requests per API scenario.
+        import_files [int]: files imported by the CLI scenario, 0 to skip.
+        workdir [Path]: where the library is written, default to a temporary directory.
+        scenarios [Iterable[str]]: run only these, default to all.
+    Return:
+        results [dict]: meta and results keyed by scenario.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(workdir or tmp)
+        workdir.mkdir(parents=True, exist_ok=True)
+        db_path = (workdir/'memes.sqlite').resolve()
+        if db_path.exists():
+            raise click.UsageError(f'{db_path} already exists.')
+
+        start = time.perf_counter()
+        library.generate(db_path, echo=echo)
+        generate_time = time.perf_counter() - start
+
+        rng = random.Random(library.seed + 1)
+        app = make_app(db_path)
+        results = {}
+        for name, (reqs, cached) in api_scenarios(library, requests, rng).items():
+            if scenarios and name not in scenarios:
+                continue
+            results[name] = run_requests(app, reqs, cached)
+            echo(f'{name}: p50 {results[name]["p50_ms"]}ms, p99 {results[name]["p99_ms"]}ms')
+        if import_files and (not scenarios or {'cli_import', 'cli_export'} & set(scenarios)):
+            results.update(cli_scenarios(db_path, workdir, import_files, rng, echo))
+
+        return {
+            'meta': {
+                'library': library.meta(),
+                'requests': requests,
+                'generate_seconds': round(generate_time, 2),
+                'time': datetime.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'sqlite': sqlite3.sqlite_version,
+                'platform': platform.platform(),
+                'cpus': os.cpu_count(),
+            },
+            'results': results,
+        }
+
+
+@click.command()
+@click.option('--images', default=10000, type=click.IntRange(min=1), help='Images in the library.')
+@click.option('--groups', default=50, type=click.IntRange(min=0), help='Groups in the library.')
+@click.option('--tags', default=2000, type=click.IntRange(min=1), help='Size of the tag vocabulary.')
+@click.option('--blobs', default=1000, type=click.IntRange(min=1),
+    help='Images whose blob is written, the others only have a row.')
+@click.option('--requests', default=50, type=click.IntRange(min=1), help='Requests per API scenario.')
+@click.option('--import-files', default=100, type=click.IntRange(min=0),
+    help='Files imported by the CLI scenario, 0 to skip.')
+@click.option('--seed', default=0, help='Seed of the generated library and requests.')
+@click.option('--scenario', 'scenarios', multiple=True, help='Run only these scenarios.')
+@click.option('--workdir', type=click.Path(file_okay=False),
+    help='Keep the generated library in this directory.')
+@click.option('--output', type=click.Path(dir_okay=False), help='Write results as JSON to this file.')
+@click.option('--baseline', type=click.Path(exists=True, dir_okay=False),
+    help='Compare against results of a previous run.')
+@click.option('--threshold', default=0.25, help='Tolerated slowdown against the baseline.')
+def main(images, groups, tags, blobs, requests, import_files, seed, scenarios,
+         workdir, output, baseline, threshold):
+    """Benchmark the API and CLI on a synthetic library."""
+    echo = lambda msg: click.echo(msg, err=True)
+    library = Library(images, groups=groups, tags=tags, blobs=blobs, seed=seed)
+    results = run(library, requests=requests, import_files=import_files,
+                  workdir=workdir, scenarios=scenarios, echo=echo)
+
+    dumped = json.dumps(results, indent=2, ensure_ascii=False)
+    if output:
+        Path(output).write_text(dumped + '\n')
+    else:
+        click.echo(dumped)
+
+    if baseline:
+        lines, regressions = compare(results, json.loads(Path(baseline).read_text()), threshold)
+        for line in lines:
+            echo(line)
+        if regressions:
+            echo(f'{len(regressions)} scenarios regressed by more than {threshold:.0%}.')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
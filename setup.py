@@ -36,11 +36,12 @@ setup(
     package_dir={'': 'src'},
     packages=find_packages(where='src'),
     python_requires='>=3.6',
-    install_requires=['flask', 'flask-sqlalchemy', 'waitress'],
-    # extras_require={  # Optional
-    #     'dev': ['check-manifest'],
-    #     'test': ['coverage'],
-    # },
+    # sqlite.SQLAlchemy overrides hooks of Flask-SQLAlchemy 2.x, which runs on SQLAlchemy 1.x.
+    install_requires=['flask>=2.2', 'flask-sqlalchemy>=2.5,<3', 'sqlalchemy>=1.4,<2', 'waitress'],
+    extras_require={  # Optional
+        'thumbnails': ['Pillow'],
+        'fast': ['orjson'],
+    },
 
     # setuptools not support "**" rescursive include sub directory. so I have to specify every sub dir.
     # ref: https://github.com/pypa/setuptools/issues/1806
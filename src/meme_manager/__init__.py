@@ -1,4 +1,5 @@
 from .create_app import create_app
 from .cli import cli
-from .models import db, Image, Group
+from .models import db, Image, Group, Tag
+from .storage import blobs
 from .version import __version__
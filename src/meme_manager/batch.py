@@ -0,0 +1,197 @@
+"""Set-based changes of many images at once.
+
+Every function issues a constant number of statements whatever the number of
+images, in the current transaction: the caller commits once. As the statements
+bypass the session, they keep the search index and version counters in sync
+themselves.
+"""
+from sqlalchemy import delete, insert, select, true, update
+
+from .models import Image, Tag, image_tag, bump_versions
+from .search import reindex_images, unindex_images
+
+
+def existing_ids(session, image_ids):
+    """
+    Params:
+        session [Session]
+        image_ids [Iterable[int]]
+    Return:
+        image_ids [list[int]]: ids of existing images, in ascending order.
+    """
+    return session.execute(
+        select(Image.id).where(Image.id.in_(list(image_ids))).order_by(Image.id)
+    ).scalars().all()
+
+
+def move_images(session, image_ids, group_id):
+    """
+    Params:
+        session [Session]
+        image_ids [Iterable[int]]
+        group_id [int] or None: None to move out of any group.
+    Return:
+        count [int]: images moved.
+    """
+    image_ids = existing_ids(session, image_ids)
+    if not image_ids:
+        return 0
+
+    session.execute(
+        update(Image.__table__).where(Image.id.in_(image_ids)).values(group_id=group_id)
+    )
+    reindex_images(session, image_ids)
+    bump_versions(session, 'images')
+    return len(image_ids)
+
+
+def add_image_tags(session, image_ids, names):
+    """
+    Params:
+        session [Session]
+        image_ids [Iterable[int]]
+        names [Iterable[str]]
+    Return:
+        count [int]: images tagged.
+    """
+    image_ids = existing_ids(session, image_ids)
+    names = list(dict.fromkeys(names))
+    if not image_ids or not names:
+        return 0
+
+    session.execute(
+        insert(Tag.__table__).prefix_with('OR IGNORE'),
+        [{'name': name} for name in names],
+    )
+    session.execute(
+        insert(image_tag).prefix_with('OR IGNORE').from_select(
+            ['tag_id', 'image_id'],
+            # every tag with every image: a deliberate cross join.
+            select(Tag.id, Image.id).select_from(Tag).join(Image, true())
+            .where(Tag.name.in_(names), Image.id.in_(image_ids)),
+        )
+    )
+    reindex_images(session, image_ids)
+    bump_versions(session, 'images')
+    return len(image_ids)
+
+
+def remove_image_tags(session, image_ids, names):
+    """
+    Params:
+        session [Session]
+        image_ids [Iterable[int]]
+        names [Iterable[str]]
+    Return:
+        count [int]: images untagged.
+    """
+    image_ids = existing_ids(session, image_ids)
+    names = list(names)
+    if not image_ids or not names:
+        return 0
+
+    session.execute(
+        delete(image_tag).where(
+            image_tag.c.image_id.in_(image_ids),
+            image_tag.c.tag_id.in_(select(Tag.id).where(Tag.name.in_(names))),
+        )
+    )
+    reindex_images(session, image_ids)
+    bump_versions(session, 'images')
+    return len(image_ids)
+
+
+def delete_images(session, image_ids):
+    """Delete images, their blobs are removed once the transaction commits.
+    Params:
+        session [Session]
+        image_ids [Iterable[int]]
+    Return:
+        count [int]: images deleted.
+    """
+    rows = session.execute(
+        select(Image.id, Image.digest).where(Image.id.in_(list(image_ids)))
+    ).all()
+    if not rows:
+        return 0
+
+    image_ids = [image_id for image_id, _ in rows]
+    session.execute(delete(image_tag).where(image_tag.c.image_id.in_(image_ids)))
+    session.execute(delete(Image.__table__).where(Image.id.in_(image_ids)))
+    unindex_images(session, image_ids)
+    bump_versions(session, 'images', 'image_deletes')
+    # digests are unique, no other image references these blobs.
+    session.info.setdefault('orphan_digests', set()).update(digest for _, digest in rows)
+    return len(rows)
+
+
+def tagged_ids(session, tag_ids):
+    """
+    Params:
+        session [Session]
+        tag_ids [list[int]]
+    Return:
+        image_ids [list[int]]: images having any of the tags.
+    """
+    return session.execute(
+        select(image_tag.c.image_id).where(image_tag.c.tag_id.in_(tag_ids)).distinct()
+    ).scalars().all()
+
+
+def rename_tag(session, name, new_name):
+    """Rename a tag on every image having it, with one UPDATE of the tag row.
+    Params:
+        session [Session]
+        name [str]
+        new_name [str]: must not be an existing tag, see merge_tags().
+    Return:
+        count [int] or None: images retagged, None if the tag does not exist.
+    Raise:
+        ValueError: new_name already exists.
+    """
+    tags = dict(session.execute(
+        select(Tag.name, Tag.id).where(Tag.name.in_([name, new_name]))
+    ).all())
+    if name not in tags:
+        return None
+    if new_name == name:
+        return 0
+    if new_name in tags:
+        raise ValueError(new_name)
+
+    image_ids = tagged_ids(session, [tags[name]])
+    session.execute(update(Tag.__table__).where(Tag.id == tags[name]).values(name=new_name))
+    reindex_images(session, image_ids)
+    bump_versions(session, 'images')
+    return len(image_ids)
+
+
+def merge_tags(session, names, target):
+    """Replace tags by the target tag on every image having any of them, and
+    remove them. Image counts of tags follow through the image_tag triggers.
+    Params:
+        session [Session]
+        names [Iterable[str]]: missing tags are ignored.
+        target [str]: created if it does not exist.
+    Return:
+        count [int]: images retagged.
+    """
+    names = [n for n in dict.fromkeys(names) if n != target]
+    tag_ids = session.execute(select(Tag.id).where(Tag.name.in_(names))).scalars().all()
+    if not tag_ids:
+        return 0
+
+    image_ids = tagged_ids(session, tag_ids)
+    session.execute(insert(Tag.__table__).prefix_with('OR IGNORE').values(name=target))
+    target_id = select(Tag.id).where(Tag.name == target).scalar_subquery()
+    session.execute(
+        insert(image_tag).prefix_with('OR IGNORE').from_select(
+            ['tag_id', 'image_id'],
+            select(target_id, image_tag.c.image_id).where(image_tag.c.tag_id.in_(tag_ids)),
+        )
+    )
+    session.execute(delete(image_tag).where(image_tag.c.tag_id.in_(tag_ids)))
+    session.execute(delete(Tag.__table__).where(Tag.id.in_(tag_ids)))
+    reindex_images(session, image_ids)
+    bump_versions(session, 'images')
+    return len(image_ids)
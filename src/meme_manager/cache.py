@@ -0,0 +1,157 @@
+"""In-process cache of list responses.
+
+A cached response depends on some version counters (eg: 'images'), each
+paired with an in-process generation. Every commit which bumps a version
+counter (see `bump_versions()`) advances its generation, so the responses
+built before are never served again. Hot pages are served without touching
+sqlite at all.
+
+Writers in other processes (eg: `meme-manager import` while the server runs)
+can not advance the generations, RESPONSE_CACHE_TTL bounds how long their
+changes may go unnoticed.
+"""
+import threading
+import time
+from collections import Counter
+from functools import wraps
+
+from flask import current_app, has_app_context, request
+from sqlalchemy import event
+
+from .models import db
+from .lru import LRUCache
+
+# bytes accounted for every cache entry besides the response body.
+CACHE_ENTRY_OVERHEAD = 512
+
+
+def cache_key():
+    """Normalized key of the current request: path and sorted args.
+    Empty args are kept: `after=` asks for the first keyset page, not the
+    offset listing.
+    """
+    args = sorted(request.args.items(multi=True))
+    return request.path, tuple(args)
+
+
+class ResponseCache(object):
+    """Flask extension caching responses of read-only views.
+    Config:
+    - RESPONSE_CACHE_BYTES: bound of the total size of cached responses,
+      default 16MB, 0 to disable.
+    - RESPONSE_CACHE_TTL: seconds a response is served at most, default 30,
+      None for no limit.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('RESPONSE_CACHE_BYTES', 16 * 2**20)
+        app.config.setdefault('RESPONSE_CACHE_TTL', 30)
+        app.extensions['response_cache'] = {
+            'entries': LRUCache(app.config['RESPONSE_CACHE_BYTES']),
+            'generations': Counter(),
+            'lock': threading.Lock(),
+        }
+
+    @property
+    def state(self):
+        return current_app.extensions['response_cache']
+
+    def generations(self, names):
+        generations = self.state['generations']
+        return tuple(generations[name] for name in names)
+
+    def invalidate(self, *names):
+        """Advance generations of version counters, every response is
+        invalidated if no name is given.
+        """
+        state = self.state
+        with state['lock']:
+            # every response depends on '*'.
+            for name in names or ('*',):
+                state['generations'][name] += 1
+
+    def get(self, names, key):
+        """
+        Return:
+            response [Response] or None
+        """
+        entry = self.state['entries'].get(key)
+        if entry is None:
+            return None
+        generations, expires_at, body, status, headers = entry
+        if generations != self.generations(names) or (expires_at is not None and expires_at < time.monotonic()):
+            return None
+
+        response = current_app.response_class(body, status, headers)
+        etag, _ = response.get_etag()
+        if etag is not None and request.if_none_match.contains_weak(etag):
+            response.status_code = 304
+            response.set_data(b'')
+        return response
+
+    def set(self, names, key, generations, response):
+        if response.status_code != 200 or response.is_streamed:
+            return
+        ttl = current_app.config['RESPONSE_CACHE_TTL']
+        expires_at = None if ttl is None else time.monotonic() + ttl
+        body = response.get_data()
+        entry = (generations, expires_at, body, response.status_code, list(response.headers.items()))
+        self.state['entries'].set(key, entry, CACHE_ENTRY_OVERHEAD + len(body))
+
+    def serve(self, names, build):
+        """Serve the current request from the cache, build and cache the
+        response on a miss.
+        Params:
+            names [Iterable[str]]: version counters the response depends on.
+            build [Callable[[], Response]]
+        Return:
+            response [Response]
+        """
+        names = ('*', *names)
+        key = cache_key()
+        response = self.get(names, key)
+        if response is not None:
+            return response
+
+        # taken before building: a write committed meanwhile invalidates it.
+        generations = self.generations(names)
+        response = current_app.make_response(build())
+        self.set(names, key, generations, response)
+        return response
+
+    def cached(self, *names):
+        """Decorator of views whose response only depends on request args and
+        the given version counters.
+        """
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                return self.serve(names, lambda: view(*args, **kwargs))
+            return wrapper
+        return decorator
+
+
+response_cache = ResponseCache()
+
+
+@event.listens_for(db.session, 'after_commit')
+def invalidate_responses(session):
+    names = session.info.pop('bumped_versions', None)
+    if names and has_app_context() and 'response_cache' in current_app.extensions:
+        response_cache.invalidate(*names)
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def forget_bumped_versions(session, previous_transaction):
+    session.info.pop('bumped_versions', None)
+
+
+@event.listens_for(db.metadata, 'after_create')
+@event.listens_for(db.metadata, 'after_drop')
+def invalidate_all_responses(target, connection, **kw):
+    if has_app_context() and 'response_cache' in current_app.extensions:
+        response_cache.invalidate()
@@ -4,11 +4,23 @@ import webbrowser
 import uuid
 
 import click
+from sqlalchemy import func, select
 from waitress import serve
 
 from .version import __version__
 from .create_app import create_app
-from .models import db, Image, Group
+from .models import db, Image, Group, Tag, image_tag, IMAGE_TAG_ORDER
+from .importer import Importer
+from .exporter import Exporter, UniqueNames
+from .dedup import POLICIES, collapse_duplicates
+from .batch import merge_tags, rename_tag
+from .similar import find_clusters
+from .sqlite import report_pragmas
+from .migrations import MIGRATIONS, applied_versions, compute_phashes, forget, migrate, stamp, version_of
+from .explain import audit
+
+
+EXPORT_BATCH_SIZE = 1000
 
 
 @click.group()
@@ -30,9 +42,154 @@ def initdb(db_file):
     app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{fp}'
     with app.app_context():
         db.create_all()
+        # created from the models: every migration is already applied.
+        stamp()
         print(f'Initialize {fp} done.')
 
 
+@cli.command('migrate')
+@click.option('--batch-size', default=100, type=click.IntRange(min=1), help='Rows per transaction.')
+@click.option('--redo', type=int, multiple=True, metavar='VERSION',
+    help='Apply a migration again, eg: compute perceptual hashes once Pillow is installed.')
+@click.option('--vacuum', is_flag=True,
+    help='Shrink the file once done, needs free disk space as large as the file.')
+@click.option('--status', is_flag=True, help='List migrations, do not apply any.')
+@click.argument('db_file', type=click.Path(exists=True, file_okay=True, dir_okay=False))
+def migrate_(batch_size, redo, vacuum, status, db_file):
+    """Migrate a database created by an older version.
+    Interrupted migrations resume where they stopped when run again.
+    """
+    db_path = Path(db_file).resolve().absolute()
+    app = create_app(os.getenv('FLASK_ENV', 'production'))
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
+    with app.app_context():
+        if status:
+            applied = applied_versions()
+            for version, name, _ in MIGRATIONS:
+                print(f'[{"x" if version in applied else " "}] {version} {name}')
+            return
+
+        if redo:
+            forget(redo)
+        applied = migrate(batch_size=batch_size, vacuum_after=vacuum)
+    if applied:
+        print(f'Migrate {db_path} to version {max(applied)} done.')
+    else:
+        print(f'{db_path} is already up to date.')
+
+
+@cli.command('upgrade', hidden=True)
+@click.option('--batch-size', default=100, type=click.IntRange(min=1), help='Rows per transaction.')
+@click.argument('db_file', type=click.Path(exists=True, file_okay=True, dir_okay=False))
+@click.pass_context
+def upgrade_(ctx, batch_size, db_file):
+    """Deprecated alias of migrate."""
+    ctx.invoke(migrate_, batch_size=batch_size, db_file=db_file)
+
+
+@cli.command('dedup')
+@click.option('--batch-size', default=100, help='Duplicate sets per transaction.')
+@click.argument('db_file', type=click.Path(exists=True, file_okay=True, dir_okay=False))
+def dedup_(batch_size, db_file):
+    """Collapse images with the same content into one, merging their tags."""
+    db_path = Path(db_file).resolve().absolute()
+    app = create_app(os.getenv('FLASK_ENV', 'production'))
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
+    with app.app_context():
+        count = collapse_duplicates(db.session, batch_size=batch_size)
+    if count:
+        print(f'Total remove {count} duplicate images.')
+    else:
+        print(f'{db_path} has no duplicate image.')
+
+
+@cli.command('find-dupes')
+@click.option('-d', '--distance', type=click.IntRange(0, 64),
+    help='Max hamming distance of perceptual hashes, default to SIMILAR_DISTANCE config.')
+@click.argument('db_file', type=click.Path(exists=True, file_okay=True, dir_okay=False))
+def find_dupes(distance, db_file):
+    """Find sets of similar images (re-encoded, resized, re-compressed...)."""
+    db_path = Path(db_file).resolve().absolute()
+    app = create_app(os.getenv('FLASK_ENV', 'production'))
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
+    with app.app_context():
+        if distance is None:
+            distance = app.config['SIMILAR_DISTANCE']
+        # `phash != ''` is not true for NULL either: unhashed images are counted apart.
+        rows = db.session.query(Image.id, Image.phash).filter(Image.phash != '').all()
+        unhashed = db.session.query(func.count(Image.id)).filter(Image.phash.is_(None)).scalar()
+        clusters = find_clusters(rows, distance)
+
+    for cluster in clusters:
+        print('Similar images: ' + ', '.join(f'id={image_id}' for image_id in cluster))
+    print(f'Total {len(clusters)} sets of similar images.')
+    if unhashed:
+        print(f'{unhashed} images have no perceptual hash, install Pillow and run '
+              f'`meme-manager migrate --redo {version_of(compute_phashes)} {db_file}`.')
+
+
+@cli.command('rename-tag')
+@click.argument('name')
+@click.argument('new_name')
+@click.argument('db_file', type=click.Path(exists=True, file_okay=True, dir_okay=False))
+def rename_tag_(name, new_name, db_file):
+    """Rename tag NAME to NEW_NAME on every image."""
+    db_path = Path(db_file).resolve().absolute()
+    app = create_app(os.getenv('FLASK_ENV', 'production'))
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
+    with app.app_context():
+        try:
+            count = rename_tag(db.session, name, new_name)
+        except ValueError:
+            print(f'Error: tag {new_name} already exists, use merge-tags.')
+            return
+        if count is None:
+            print(f'Error: tag {name} not exists.')
+            return
+        db.session.commit()
+    print(f'Rename tag {name} to {new_name} on {count} images done.')
+
+
+@cli.command('merge-tags')
+@click.option('--into', 'target', required=True, help='Tag replacing the others, created if missing.')
+@click.argument('names', nargs=-1, required=True)
+@click.argument('db_file', type=click.Path(exists=True, file_okay=True, dir_okay=False))
+def merge_tags_(target, names, db_file):
+    """Replace tags NAMES by the --into tag on every image, and remove them."""
+    db_path = Path(db_file).resolve().absolute()
+    app = create_app(os.getenv('FLASK_ENV', 'production'))
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
+    with app.app_context():
+        count = merge_tags(db.session, names, target)
+        db.session.commit()
+    print(f'Merge tags {", ".join(names)} into {target} on {count} images done.')
+
+
+@cli.command('explain')
+@click.option('-v', '--verbose', is_flag=True, help='Print every statement and its plan.')
+@click.argument('db_file', type=click.Path(exists=True, file_okay=True, dir_okay=False))
+def explain(verbose, db_file):
+    """Explain the queries of the read-only views, flag full table scans."""
+    db_path = Path(db_file).resolve().absolute()
+    app = create_app(os.getenv('FLASK_ENV', 'production'))
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
+    with app.app_context():
+        reports = audit(app)
+
+    scan_count = 0
+    for report in reports:
+        scan_count += len(report['full_scans'])
+        if not verbose and not report['full_scans']:
+            continue
+        print(f'GET {report["url"]}')
+        print(f'  {report["statement"]}')
+        for detail in report['plan']:
+            print(f'    {detail}')
+        for table in report['full_scans']:
+            print(f'  Warning: full scan of table {table}.')
+    print(f'Total explain {len(reports)} queries, {scan_count} full scans.')
+
+
 @cli.command('run')
 @click.option('--port', default=5000, help='Network port to listen to.')
 @click.argument('db_file', default='memes.sqlite')
@@ -45,28 +202,12 @@ def run(port, db_file):
 
     app = create_app(os.getenv('FLASK_ENV', 'production'))
     app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{fp}'
+    with app.app_context():
+        report_pragmas(db.engine, app.config['SQLITE_PRAGMAS'])
     webbrowser.open(f'http://127.0.0.1:{port}/index.html')
     serve(app, host='127.0.0.1', port=port)
 
 
-def file2image(file, group_id=None):
-    """
-    Params:
-        file [Path]
-    Return:
-        image [Image]
-    """
-    if not file.is_file():
-        raise Exception(f'file2image parameter {file} must be a regular file.')
-
-    return Image(
-        data=file.read_bytes(),
-        img_type=file.suffix[1:],
-        tags=[file.stem],
-        group_id=group_id,
-    )
-
-
 def assert_group(name):
     """
     Params:
@@ -84,96 +225,95 @@ def assert_group(name):
         return group.id
 
 
-def import_flat_dir(dir_, group):
+def import_flat_dir(dir_, group, importer):
     """
     Params:
         dir_ [Path]
         group [str]
-    Return:
-        count [int]: images num.
+        importer [Importer]
     """
     print(f'Group: {group}')
-    count = 0
     group_id = assert_group(group)
-    
+
     for f in dir_.iterdir():
         if f.is_file():
-            image = file2image(f, group_id)
-            db.session.add(image)
-            count += 1
-            print(f'Add image {f} done.')
-    db.session.commit()
-    return count
+            importer.add(f, group_id)
 
 
-def import_struct_dir(dir_):
+def import_struct_dir(dir_, importer):
     """
     Params:
         dir_ [Path]
-        group [str]
+        importer [Importer]
     Return:
-        group_count [int], file_count [int]
+        group_count [int]
     """
     gcount = 0
-    fcount = 0
     for p in dir_.iterdir():
         if p.is_file():
-            image = file2image(p)
-            db.session.add(image)
-            fcount += 1
-            print(f'Add image {p} done.')
+            importer.add(p)
         elif p.is_dir():
-            fc = import_flat_dir(p, p.name)
+            import_flat_dir(p, p.name, importer)
             gcount += 1
-            fcount += fc
-    db.session.commit()
-    return gcount, fcount
+    return gcount
 
 
 @cli.command('import')
 @click.option('-g', '--group', help='Set group.')
+@click.option('-j', '--jobs', default=4, type=click.IntRange(min=1),
+    help='Number of threads reading files.')
+@click.option('--batch-size', default=500, type=click.IntRange(min=1),
+    help='Images inserted per transaction.')
+@click.option('--dedup', type=click.Choice(POLICIES),
+    help='What to do with images already in the database, default to DEDUP_POLICY config.')
 @click.argument('src', type=click.Path(exists=True))
 @click.argument('db_file', type=click.Path(exists=True, file_okay=True, dir_okay=False))
-def import_(group, src, db_file):
+def import_(group, jobs, batch_size, dedup, src, db_file):
     """Import image file or directory."""
     src_path = Path(src)
     db_path = Path(db_file).resolve().absolute()
     app = create_app(os.getenv('FLASK_ENV', 'production'))
     app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
-    if src_path.is_file():
-        with app.app_context():
+    if not (src_path.is_file() or src_path.is_dir()):
+        print(f'Error: {src_path} is not a regular file nor a directory.')
+        return
+
+    with app.app_context(), Importer(jobs=jobs, batch_size=batch_size, dedup=dedup) as importer:
+        if src_path.is_file():
             # import <file>
             # import -g <file>
             group_id = assert_group(group) if group else None
-            image = file2image(src_path, group_id)
-            db.session.add(image)
-            db.session.commit()
-            print(f'Add image {src_path} done.')
-    elif src_path.is_dir():
-        with app.app_context():
-            if group:
-                # import -g <dir>: import dir only contain files.
-                fcount = import_flat_dir(src_path, group)
-                print(f'Total add {fcount} images.')
-            else:
-                # import <dir>: import dir contain files and dirs.
-                gcount, fcount = import_struct_dir(src_path)
-                print(f'Total add {gcount} group, {fcount} images.')
-    else:
-        print(f'Error: {src_path} is not a regular file nor a directory.')
-        return
+            importer.add(src_path, group_id)
+            gcount = 0
+        elif group:
+            # import -g <dir>: import dir only contain files.
+            import_flat_dir(src_path, group, importer)
+            gcount = 0
+        else:
+            # import <dir>: import dir contain files and dirs.
+            gcount = import_struct_dir(src_path, importer)
+
+    if src_path.is_dir():
+        if group:
+            print(f'Total add {importer.count} images.')
+        else:
+            print(f'Total add {gcount} group, {importer.count} images.')
+    if importer.dup_count:
+        print(f'Duplicate: {importer.dup_count}')
+    if importer.fail_count:
+        print(f'Failed: {importer.fail_count}')
 
 
 def image2filename(image, name_pattern):
     """
     Params:
-        image [Image]:
+        image: row with id, tag (first tag or None) and img_type.
         name_pattern [str]
     Return:
         filename [str]
     """
     if name_pattern == 'tag':
-        filename = image.tags[0] if image.tags else str(uuid.uuid4())
+        filename = image.tag if image.tag else str(uuid.uuid4())
     elif name_pattern == 'id':
         filename = str(image.id)
     else:
@@ -182,27 +322,37 @@ def image2filename(image, name_pattern):
     return filename
 
 
-def assert_safe_filepath(filepath):
-    """if filepath exists, generate a uuid filename replact it.
-    Params:
-        filepath [Path]
+def image_rows():
+    """Stream the columns needed by export, in batches.
     Return:
-        filepath [Path]
+        query [Query]: rows of (id, digest, img_type, tag, group).
     """
-    if filepath.exists():
-        return filepath.with_name(str(uuid.uuid4()) + filepath.suffix)
-    else:
-        return filepath
-
-
-def export_group(dest_dir, group, name_pattern):
+    # the tag added first, the file stem for imported images: export then
+    # import keeps the names.
+    first_tag = select(Tag.name)\
+        .join(image_tag, image_tag.c.tag_id == Tag.id)\
+        .where(image_tag.c.image_id == Image.id)\
+        .order_by(IMAGE_TAG_ORDER)\
+        .limit(1)\
+        .scalar_subquery()
+    return db.session.query(
+        Image.id,
+        Image.digest,
+        Image.img_type,
+        first_tag.label('tag'),
+        Group.name.label('group'),
+    ).outerjoin(Image.group).order_by(Image.id).yield_per(EXPORT_BATCH_SIZE)
+
+
+def export_group(dest_dir, group, name_pattern, jobs):
     """
     Params:
         dest_dir [Path]:
         group [str]:
         name_pattern [str]
+        jobs [int]
     Return:
-        ok_count, fail_count
+        ok_count, fail_count; or None if failed to start.
     """
     grecord = Group.query.filter_by(name=group).first()
     if not grecord:
@@ -220,31 +370,22 @@ def export_group(dest_dir, group, name_pattern):
         print(f'Error: {e}')
         return
 
-    ok_count = 0
-    fail_count = 0
-    for image in grecord.images:
-        filename = image2filename(image, name_pattern)
-        filepath = group_dir/filename
-        filepath = assert_safe_filepath(filepath)
-        try:
-            with open(filepath, 'wb') as fh:
-                fh.write(image.data)
-        except OSError:
-            print(f'Error: {filepath} write failed.')
-            fail_count += 1
-        else:
-            print(f'export {filepath} done.')
-            ok_count +=1
-    return ok_count, fail_count
+    names = UniqueNames()
+    with Exporter(jobs=jobs) as exporter:
+        for image in image_rows().filter(Image.group_id == grecord.id):
+            filepath = names.pick(group_dir, image2filename(image, name_pattern))
+            exporter.add(image.digest, filepath)
+    return exporter.ok_count, exporter.fail_count
 
 
-def export_all(dest_dir, name_pattern):
+def export_all(dest_dir, name_pattern, jobs):
     """
     Params:
         dest_dir [Path]:
         name_pattern [str]:
+        jobs [int]
     Return:
-        ok_count, fail_count
+        ok_count, fail_count; or None if failed to start.
     """
     # groups
     for group in Group.query.all():
@@ -259,22 +400,13 @@ def export_all(dest_dir, name_pattern):
             print(f'Error: {e}')
 
     # images
-    ok_count = 0
-    fail_count = 0
-    for image in Image.query.all():
-        filename = image2filename(image, name_pattern)
-        filepath = dest_dir/image.group.name/filename if image.group else dest_dir/filename
-        filepath = assert_safe_filepath(filepath)
-        try:
-            with open(filepath, 'wb') as fh:
-                fh.write(image.data)
-        except OSError:
-            print(f'Error: {filepath} write failed.')
-            fail_count += 1
-        else:
-            print(f'export {filepath} done.')
-            ok_count +=1
-    return ok_count, fail_count
+    names = UniqueNames()
+    with Exporter(jobs=jobs) as exporter:
+        for image in image_rows():
+            dir_ = dest_dir/image.group if image.group else dest_dir
+            filepath = names.pick(dir_, image2filename(image, name_pattern))
+            exporter.add(image.digest, filepath)
+    return exporter.ok_count, exporter.fail_count
 
 
 @cli.command('export')
@@ -283,9 +415,11 @@ def export_all(dest_dir, name_pattern):
     type=click.Choice(('tag', 'id')),
     help='Specify export filename pattern: tag(default), id.'
 )
+@click.option('-j', '--jobs', default=4, type=click.IntRange(min=1),
+    help='Number of threads writing files.')
 @click.argument('db_file', type=click.Path(exists=True, file_okay=True, dir_okay=False))
 @click.argument('dest', type=click.Path(exists=True, file_okay=False, dir_okay=True))
-def export_(group, name_pattern, db_file, dest):
+def export_(group, name_pattern, jobs, db_file, dest):
     """Export db images to a directory."""
     db_path = Path(db_file).resolve().absolute()
     dest_path = Path(dest)
@@ -294,11 +428,14 @@ def export_(group, name_pattern, db_file, dest):
     with app.app_context():
         if group:
             # export -g <dir>
-            ok_count, fail_count = export_group(dest_path, group, name_pattern)
+            rv = export_group(dest_path, group, name_pattern, jobs)
         else:
             # export <dir>
-            ok_count, fail_count = export_all(dest_path, name_pattern)
+            rv = export_all(dest_path, name_pattern, jobs)
+    if rv is None:
+        return
 
+    ok_count, fail_count = rv
     print(f'Total export {ok_count + fail_count} images.')
     print(f'Success: {ok_count}')
     print(f'Failed: {fail_count}')
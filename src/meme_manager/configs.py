@@ -6,7 +6,54 @@ from logging.handlers import TimedRotatingFileHandler
 
 class Config(object):
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # encode JSON with orjson when it is installed.
+    FAST_JSON = True
     SQLALCHEMY_DATABASE_URI = f'sqlite:///{Path.cwd().joinpath("memes.sqlite")}'
+    # waitress serves with 4 threads by default, the import pipeline and CLI
+    # commands use one connection.
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': 8,
+        'max_overflow': 8,
+        'pool_timeout': 30,
+        # pooled connections move between waitress threads.
+        'connect_args': {'check_same_thread': False},
+    }
+    # applied in order on every new connection, see sqlite.py.
+    SQLITE_PRAGMAS = {
+        'busy_timeout': 5000,
+        'journal_mode': 'wal',
+        'synchronous': 'normal',
+        'temp_store': 'memory',
+        # negative: KiB, ie: 64MB page cache per connection.
+        'cache_size': -64000,
+        'mmap_size': 256 * 2**20,
+    }
+    # 'filesystem' | 'memory'
+    BLOB_BACKEND = 'filesystem'
+    # None: use a directory next to the sqlite file, eg: memes.sqlite -> memes.blobs/
+    BLOB_DIR = None
+    # thumbnail sizes generated when an image is added.
+    THUMBNAIL_SIZES = (200,)
+    THUMBNAIL_MAX_SIZE = 1024
+    # bound of the in-process cache of thumbnails of other sizes.
+    THUMBNAIL_CACHE_BYTES = 64 * 2**20
+    # what to do when an added image already exists: 'reject' | 'merge' | 'link'
+    DEDUP_POLICY = 'merge'
+    # default hamming distance (of 64 bits perceptual hashes) of similar images.
+    SIMILAR_DISTANCE = 10
+    # bound of the in-process cache of list responses, 0 to disable.
+    RESPONSE_CACHE_BYTES = 16 * 2**20
+    # seconds a cached response is served at most, bounds how long changes
+    # made by other processes (eg: CLI import) go unnoticed. None: no limit.
+    RESPONSE_CACHE_TTL = 30
+    # default number of tag suggestions of /api/tags/suggest.
+    TAG_SUGGEST_LIMIT = 10
+    # request timing and SQL counting, served by /api/metrics.
+    METRICS = True
+    # seconds from which a request is logged with its SQL statements, None to disable.
+    METRICS_SLOW_REQUEST = 0.5
+    # slow requests kept for /api/metrics/slow.
+    METRICS_SLOW_LOG_SIZE = 100
 
     @classmethod
     def init_app(cls, app):
@@ -20,6 +67,7 @@ class DevelopmentConfig(Config):
 class TestingConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
+    BLOB_BACKEND = 'memory'
 
 
 class ProductionConfig(Config):
@@ -13,14 +13,38 @@ def create_app(config_name='production'):
     app.config.from_object(config)
     config.init_app(app)
 
+    from . import fastjson
+    fastjson.init_app(app)
+
+    from .metrics import metrics
+    metrics.init_app(app)
+
     from .views import bp_main
     app.register_blueprint(bp_main)
 
-    from .models import db, Image, Group
+    from .models import db, Image, Group, Tag
     db.init_app(app)
 
+    from .storage import blobs
+    blobs.init_app(app)
+
+    from .thumbnails import thumbnails
+    thumbnails.init_app(app)
+
+    from .similar import similar
+    similar.init_app(app)
+
+    from .cache import response_cache
+    response_cache.init_app(app)
+
+    from .suggest import tag_index
+    tag_index.init_app(app)
+
+    # register search index hooks.
+    from . import search
+
     def make_shell_context():
-        return dict(db=db, Image=Image, Group=Group)
+        return dict(db=db, Image=Image, Group=Group, Tag=Tag)
 
     app.shell_context_processor(make_shell_context)
 
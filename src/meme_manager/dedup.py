@@ -0,0 +1,79 @@
+"""Deduplication of images by content digest.
+
+`image.digest` has a unique index, so every content is stored once. When the
+same content is added again, the dedup policy decides what happens:
+- 'reject': refuse the new image.
+- 'merge': add the new image's tags to the existing image (and its group, if
+  the existing image has none).
+- 'link': keep the existing image unchanged and report it.
+"""
+from sqlalchemy import text
+
+from .models import bump_versions
+from .search import reindex_images, unindex_images
+
+POLICIES = ('reject', 'merge', 'link')
+
+
+def id_list(ids):
+    return ','.join(str(int(i)) for i in ids)
+
+
+def merge_image(image, tags, group_id=None):
+    """Merge the metadata of a duplicate into an existing image.
+    Params:
+        image [Image]
+        tags [list[str]]
+        group_id [int] or None
+    """
+    image.tags = [*image.tags, *tags]
+    if image.group_id is None and group_id is not None:
+        image.group_id = group_id
+
+
+def collapse_duplicates(session, batch_size=100, echo=print):
+    """Collapse images sharing a digest into the oldest one, merging tags (and
+    group, if the oldest one has none) with set-based statements.
+    Duplicates are found in a single pass over the image table.
+    Params:
+        session [Session]
+        batch_size [int]: duplicate sets per transaction.
+        echo [Callable[[str], None]]: progress reporter.
+    Return:
+        count [int] or None: images removed, None if there is no duplicate.
+    """
+    dup_sets = session.execute(text(
+        'SELECT group_concat(id) FROM image GROUP BY digest HAVING count(*) > 1'
+    )).scalars().all()
+    if not dup_sets:
+        return None
+
+    count = 0
+    for i in range(0, len(dup_sets), batch_size):
+        keep_ids = []
+        remove_ids = []
+        for dup_set in dup_sets[i:i + batch_size]:
+            keep, *dups = sorted(int(image_id) for image_id in dup_set.split(','))
+            params = {'keep': keep}
+            session.execute(text(
+                'INSERT OR IGNORE INTO image_tag (tag_id, image_id) '
+                f'SELECT tag_id, :keep FROM image_tag WHERE image_id IN ({id_list(dups)})'
+            ), params)
+            session.execute(text(
+                'UPDATE image SET group_id = ('
+                f'  SELECT group_id FROM image WHERE id IN ({id_list(dups)}) AND group_id IS NOT NULL'
+                '   ORDER BY id LIMIT 1'
+                ') WHERE id = :keep AND group_id IS NULL'
+            ), params)
+            keep_ids.append(keep)
+            remove_ids += dups
+
+        session.execute(text(f'DELETE FROM image_tag WHERE image_id IN ({id_list(remove_ids)})'))
+        session.execute(text(f'DELETE FROM image WHERE id IN ({id_list(remove_ids)})'))
+        unindex_images(session, remove_ids)
+        reindex_images(session, keep_ids)
+        bump_versions(session, 'images', 'image_deletes')
+        session.commit()
+        count += len(remove_ids)
+        echo(f'Remove duplicate images: {count}')
+    return count
@@ -0,0 +1,110 @@
+"""Query plan audit of the read-only views.
+
+Representative requests are sent through the test client while every SQL
+statement is recorded, then each SELECT is run again under
+`EXPLAIN QUERY PLAN`. A plan step reading a whole table without an index is
+flagged as a full scan.
+"""
+import re
+from contextlib import contextmanager
+
+from sqlalchemy import event, inspect
+
+from .models import db, Image, Group, Tag
+
+# 'SCAN image' (sqlite >= 3.36) or 'SCAN TABLE image', without 'USING ... INDEX'.
+FULL_SCAN = re.compile(r'^SCAN (?:TABLE )?"?(\w+)"?$')
+
+
+def sample_requests():
+    """Requests covering every read-only view and filter, filled with values
+    found in the database.
+    Return:
+        requests [list[tuple[str, dict]]]: (path, query string)
+    """
+    image_id = db.session.query(Image.id).order_by(Image.id).limit(1).scalar() or 1
+    group = db.session.query(Group.name).order_by(Group.id).limit(1).scalar() or 'group'
+    tag = db.session.query(Tag.name).order_by(Tag.id).limit(1).scalar() or 'tag'
+    return [
+        ('/api/images/', {}),
+        ('/api/images/', {'group': group}),
+        ('/api/images/', {'tag': tag}),
+        ('/api/images/', {'tag_prefix': tag[:1]}),
+        ('/api/images/', {'q': tag}),
+        ('/api/images/', {'after': ''}),
+        ('/api/images/', {'after': '2000-01-01 00:00:00,1', 'group': group}),
+        ('/api/images/', {'filter': f'tag:"{tag}" (group:"{group}" OR ungrouped) -type:gif created>=2000'}),
+        ('/api/images/', {'filter': f'NOT group:"{group}"', 'after': ''}),
+        ('/api/images/', {'id': image_id}),
+        ('/api/images/similar', {'id': image_id}),
+        ('/api/tags/', {'image_id': image_id}),
+        ('/api/groups/', {}),
+    ]
+
+
+@contextmanager
+def recording(engine):
+    """Record (statement, parameters) of every statement executed."""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if not executemany:
+            statements.append((statement, parameters))
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def full_scans(plan, tables):
+    """
+    Params:
+        plan [list[str]]: details of EXPLAIN QUERY PLAN rows.
+        tables [set[str]]: real tables, subqueries and views are not flagged.
+    Return:
+        tables [list[str]]: tables read without an index.
+    """
+    scanned = []
+    for detail in plan:
+        m = FULL_SCAN.match(detail)
+        if m and m.group(1) in tables:
+            scanned.append(m.group(1))
+    return scanned
+
+
+def audit(app, requests=None):
+    """Run requests against the app and explain the queries they issue.
+    Need an app context.
+    Params:
+        app [Flask]
+        requests [list[tuple[str, dict]]]: default to sample_requests().
+    Return:
+        reports [list[dict]]: one per SELECT: url, statement, plan [list[str]],
+        full_scans [list[str]].
+    """
+    if requests is None:
+        requests = sample_requests()
+    engine = db.engine
+    tables = set(inspect(engine).get_table_names())
+    client = app.test_client()
+    reports = []
+    for path, query_string in requests:
+        with recording(engine) as statements:
+            # a fresh ETag-less request, never served from a cache.
+            client.get(path, query_string={**query_string, '_explain': len(reports)})
+        url = path + ('?' + '&'.join(f'{k}={v}' for k, v in query_string.items()) if query_string else '')
+        for statement, parameters in statements:
+            if not statement.lstrip().upper().startswith('SELECT'):
+                continue
+            with engine.connect() as conn:
+                rows = conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+            plan = [row[-1] for row in rows]
+            reports.append({
+                'url': url,
+                'statement': statement,
+                'plan': plan,
+                'full_scans': full_scans(plan, tables),
+            })
+    return reports
@@ -0,0 +1,115 @@
+"""Streaming export of images to files.
+
+Rows are streamed from the database (no blob column is involved, blobs are
+read from storage one at a time by the writers), and files are written by a
+thread pool with at most `jobs * 2` files in flight, so memory does not grow
+with the size of the library.
+"""
+import os
+import shutil
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .storage import blobs
+
+
+def copy_blob(backend, digest, filepath):
+    """Write a blob to a new file. Run in worker threads.
+    A file backed blob is copied by the kernel (copy_file_range / sendfile)
+    without passing through Python.
+    Params:
+        backend [BlobBackend]
+        digest [str]
+        filepath [Path]
+    """
+    src = backend.path(digest)
+    if src is not None:
+        shutil.copyfile(src, filepath)
+    else:
+        with backend.open(digest) as fsrc, open(filepath, 'xb') as fdst:
+            shutil.copyfileobj(fsrc, fdst)
+
+
+class UniqueNames(object):
+    """Pick file paths which collide neither with each other nor with files
+    already in the destination directories, without a stat() per file: every
+    directory is listed once.
+    """
+
+    def __init__(self):
+        # dir -> set of used names
+        self.used = {}
+
+    def pick(self, dir_, filename):
+        """
+        Params:
+            dir_ [Path]
+            filename [str]
+        Return:
+            filepath [Path]: dir_/filename, or dir_/<uuid><suffix> if taken.
+        """
+        used = self.used.get(dir_)
+        if used is None:
+            used = self.used[dir_] = set(os.listdir(dir_))
+        if filename in used:
+            filename = str(uuid.uuid4()) + os.path.splitext(filename)[1]
+        used.add(filename)
+        return dir_/filename
+
+
+class Exporter(object):
+    """
+    Usage:
+        with Exporter(jobs=4) as exporter:
+            for digest, filepath in images:
+                exporter.add(digest, filepath)
+        print(exporter.ok_count, exporter.fail_count)
+    """
+
+    def __init__(self, jobs=4, echo=print):
+        self.jobs = jobs
+        self.echo = echo
+        self.ok_count = 0
+        self.fail_count = 0
+        self.backend = blobs.get_backend()
+        self.executor = ThreadPoolExecutor(max_workers=jobs)
+        self.pending = deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.close()
+        finally:
+            for _, future in self.pending:
+                future.cancel()
+            self.executor.shutdown(wait=True)
+
+    def add(self, digest, filepath):
+        """Queue a file, block while too many files are in flight.
+        Params:
+            digest [str]
+            filepath [Path]
+        """
+        future = self.executor.submit(copy_blob, self.backend, digest, filepath)
+        self.pending.append((filepath, future))
+        while len(self.pending) >= self.jobs * 2:
+            self.collect()
+
+    def collect(self):
+        filepath, future = self.pending.popleft()
+        try:
+            future.result()
+        except (OSError, KeyError):
+            self.echo(f'Error: {filepath} write failed.')
+            self.fail_count += 1
+        else:
+            self.echo(f'export {filepath} done.')
+            self.ok_count += 1
+
+    def close(self):
+        while self.pending:
+            self.collect()
@@ -0,0 +1,301 @@
+"""Image filter expressions.
+
+A filter combines predicates on tags, groups, creation time and image type
+with AND, OR, NOT and parentheses, eg:
+
+    tag:cat AND (group:funny OR ungrouped) AND NOT tag:dog* created>=2020-06
+
+Predicates:
+- tag:<name>: images having the tag, `tag:<prefix>*` any tag starting with
+  prefix.
+- group:<name>: images of the group.
+- ungrouped: images of no group.
+- type:<img_type>: eg: type:gif
+- created:<period>, created>=<period>, created<<period>, also > and <=:
+  period is YYYY, YYYY-MM, YYYY-MM-DD or "YYYY-MM-DD HH:MM:SS", created:2020
+  matches the whole year, created>2020 from 2021 on.
+
+Values containing spaces, parentheses or quotes are double quoted, with \\"
+and \\\\ escapes. Adjacent terms are joined by AND, AND binds tighter than
+OR, `-` is a short NOT. Keywords are upper case.
+
+A filter is compiled to a single WHERE condition: tag predicates are
+subqueries on the image_tag primary key, group ones on the group_id index.
+"""
+import re
+from datetime import datetime, timedelta
+
+from sqlalchemy import String, and_, false, func, literal, not_, or_, select, true
+
+from .models import Image, Group
+
+# bound the size of the compiled statement.
+MAX_PREDICATES = 32
+MAX_DEPTH = 16
+
+TOKEN = re.compile(r'''
+    \s*(?:
+        (?P<lparen>\()
+      | (?P<rparen>\))
+      | (?P<minus>-)(?=[^\s)])
+      | (?P<field>[a-z]+)(?P<op>>=|<=|:|>|<)(?P<value>"(?:[^"\\]|\\.)*"|[^\s()"]*)
+      | (?P<word>[^\s()"]+)
+    )''', re.VERBOSE)
+ESCAPE = re.compile(r'\\(.)')
+
+FIELDS = ('tag', 'group', 'type', 'created')
+DATE_FORMATS = (
+    ('%Y-%m-%d %H:%M:%S', 'second'),
+    ('%Y-%m-%d', 'day'),
+    ('%Y-%m', 'month'),
+    ('%Y', 'year'),
+)
+
+
+class FilterError(ValueError):
+    """Malformed filter, the message is shown to the user."""
+
+
+def tokenize(text):
+    """
+    Params:
+        text [str]
+    Return:
+        tokens [list[tuple]]: ('(',) | (')',) | ('-',) | ('word', str, pos)
+        | ('pred', field, op, value, quoted, pos)
+    """
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        m = TOKEN.match(text, pos)
+        if m is None:
+            raise FilterError(f'位置 {pos} 处有未闭合的引号。')
+        start = m.start(m.lastgroup) if m.lastgroup != 'value' else m.start('field')
+        if m.group('lparen'):
+            tokens.append(('(', start))
+        elif m.group('rparen'):
+            tokens.append((')', start))
+        elif m.group('minus'):
+            tokens.append(('-', start))
+        elif m.group('field') is not None:
+            value = m.group('value')
+            quoted = value.startswith('"')
+            if quoted:
+                value = ESCAPE.sub(r'\1', value[1:-1])
+            tokens.append(('pred', m.group('field'), m.group('op'), value, quoted, m.start('field')))
+        else:
+            tokens.append(('word', m.group('word'), start))
+        pos = m.end()
+    return tokens
+
+
+class Parser(object):
+    """Recursive descent parser of:
+        expr   := term ('OR' term)*
+        term   := factor ('AND'? factor)*
+        factor := ('NOT' | '-') factor | '(' expr ')' | predicate
+    """
+
+    def __init__(self, text):
+        self.tokens = tokenize(text)
+        self.i = 0
+        self.predicates = 0
+
+    def peek(self):
+        return self.tokens[self.i] if self.i < len(self.tokens) else None
+
+    def is_word(self, token, word):
+        return token is not None and token[0] == 'word' and token[1] == word
+
+    def parse(self):
+        """
+        Return:
+            node [tuple]: ('and', [node]) | ('or', [node]) | ('not', node)
+            | predicate, see predicate().
+        """
+        if not self.tokens:
+            raise FilterError('筛选条件为空。')
+        node = self.expr(0)
+        token = self.peek()
+        if token is not None:
+            raise FilterError(f'位置 {token[-1]} 处有多余的 {describe(token)}。')
+        return node
+
+    def expr(self, depth):
+        if depth > MAX_DEPTH:
+            raise FilterError(f'括号嵌套超过 {MAX_DEPTH} 层。')
+        nodes = [self.term(depth)]
+        while self.is_word(self.peek(), 'OR'):
+            self.i += 1
+            nodes.append(self.term(depth))
+        return nodes[0] if len(nodes) == 1 else ('or', nodes)
+
+    def term(self, depth):
+        nodes = [self.factor(depth)]
+        while True:
+            token = self.peek()
+            if self.is_word(token, 'AND'):
+                self.i += 1
+            elif token is None or token[0] == ')' or self.is_word(token, 'OR'):
+                break
+            nodes.append(self.factor(depth))
+        return nodes[0] if len(nodes) == 1 else ('and', nodes)
+
+    def factor(self, depth):
+        token = self.peek()
+        if token is None:
+            raise FilterError('筛选条件不完整。')
+        self.i += 1
+        if token[0] == '-' or self.is_word(token, 'NOT'):
+            if depth > MAX_DEPTH:
+                raise FilterError(f'括号嵌套超过 {MAX_DEPTH} 层。')
+            return ('not', self.factor(depth + 1))
+        if token[0] == '(':
+            node = self.expr(depth + 1)
+            closing = self.peek()
+            if closing is None or closing[0] != ')':
+                raise FilterError(f'位置 {token[-1]} 处的括号未闭合。')
+            self.i += 1
+            return node
+        self.predicates += 1
+        if self.predicates > MAX_PREDICATES:
+            raise FilterError(f'条件数超过 {MAX_PREDICATES} 个。')
+        return predicate(token)
+
+
+def describe(token):
+    if token[0] == 'word':
+        return f'"{token[1]}"'
+    if token[0] == 'pred':
+        return f'"{token[1]}{token[2]}"'
+    return f'"{token[0]}"'
+
+
+def predicate(token):
+    """
+    Return:
+        node [tuple]: ('tag', name) | ('tag_prefix', prefix) | ('group', name)
+        | ('ungrouped',) | ('type', img_type) | ('created', op, text)
+    """
+    if token[0] == 'word':
+        if token[1] == 'ungrouped':
+            return ('ungrouped',)
+        raise FilterError(f'位置 {token[-1]} 处无法识别 {describe(token)}。')
+    if token[0] != 'pred':
+        raise FilterError(f'位置 {token[-1]} 处缺少条件。')
+
+    _, field, op, value, quoted, pos = token
+    if field not in FIELDS:
+        raise FilterError(f'位置 {pos} 处不支持的字段 "{field}"，可用：{", ".join(FIELDS)}。')
+    if field != 'created' and op != ':':
+        raise FilterError(f'位置 {pos} 处字段 "{field}" 只支持 ":"。')
+    if not value:
+        raise FilterError(f'位置 {pos} 处 "{field}{op}" 缺少值。')
+    if field == 'tag':
+        if value.endswith('*') and not quoted:
+            return ('tag_prefix', value[:-1])
+        return ('tag', value)
+    if field == 'group':
+        return ('group', value)
+    if field == 'type':
+        return ('type', value.lower())
+    return ('created', op, *period(value, pos))
+
+
+def period(value, pos):
+    """
+    Params:
+        value [str]: YYYY, YYYY-MM, YYYY-MM-DD or YYYY-MM-DD HH:MM:SS
+    Return:
+        start [str], end [str]: bounds of the period, end excluded, None if
+        the period ends after the year 9999.
+    """
+    for fmt, unit in DATE_FORMATS:
+        try:
+            start = datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        try:
+            if unit == 'second':
+                end = start + timedelta(seconds=1)
+            elif unit == 'day':
+                end = start + timedelta(days=1)
+            elif unit == 'month':
+                end = start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+            else:
+                end = start.replace(year=start.year + 1)
+        except (ValueError, OverflowError):
+            end = None
+        # isoformat() pads years before 1000, strftime('%Y') may not.
+        return start.isoformat(' '), end and end.isoformat(' ')
+    raise FilterError(f'位置 {pos} 处时间 "{value}" 格式错误，应为 YYYY[-MM[-DD[ HH:MM:SS]]]。')
+
+
+def parse(text):
+    """
+    Params:
+        text [str]
+    Return:
+        node [tuple]: see Parser.parse().
+    Raise:
+        FilterError
+    """
+    return Parser(text).parse()
+
+
+def compile_node(node, negated=False):
+    """Negations are pushed down to the predicates, whose conditions never
+    evaluate to NULL: NOT group:x includes the ungrouped images.
+    """
+    kind = node[0]
+    if kind == 'not':
+        return compile_node(node[1], not negated)
+    if kind in ('and', 'or'):
+        conditions = [compile_node(n, negated) for n in node[1]]
+        # De Morgan
+        return (and_ if (kind == 'and') != negated else or_)(*conditions)
+
+    if kind == 'tag':
+        condition = Image.tag_filter(tag=node[1])
+    elif kind == 'tag_prefix':
+        condition = Image.tag_filter(prefix=node[1])
+    elif kind == 'group':
+        group_ids = select(Group.id).where(Group.name == node[1])
+        if negated:
+            return or_(Image.group_id.is_(None), Image.group_id.notin_(group_ids))
+        return Image.group_id.in_(group_ids)
+    elif kind == 'ungrouped':
+        return Image.group_id.isnot(None) if negated else Image.group_id.is_(None)
+    elif kind == 'type':
+        # imported files keep the case of their suffix, eg: 'JPG'.
+        condition = func.lower(Image.img_type) == node[1]
+    else:
+        _, op, start, end = node
+        lower = {':': start, '>=': start, '>': end}.get(op)
+        upper = {':': end, '<=': end, '<': start}.get(op)
+        if op == '>' and end is None:
+            # after the year 9999
+            condition = false()
+        else:
+            # compare with the text sqlite stores, not a bound datetime.
+            # no upper bound: the period ends after the year 9999.
+            bounds = []
+            if lower is not None:
+                bounds.append(Image.create_at >= literal(lower, String))
+            if upper is not None:
+                bounds.append(Image.create_at < literal(upper, String))
+            condition = and_(*bounds) if bounds else true()
+    return not_(condition) if negated else condition
+
+
+def compile_filter(text):
+    """
+    Params:
+        text [str]: filter expression, see the module doc.
+    Return:
+        condition [ColumnElement]: on Image.
+    Raise:
+        FilterError
+    """
+    return compile_node(parse(text))
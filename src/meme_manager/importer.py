@@ -0,0 +1,211 @@
+"""Pipelined bulk import of image files.
+
+A thread pool copies files into blob storage (hashing them on the way) and
+generates thumbnails, while the calling thread is the single database writer:
+it inserts finished rows in batches with executemany and commits once per
+batch. At most `jobs * 2` files are in flight and at most `batch_size` rows
+are buffered, so memory does not grow with the number of files.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+from sqlalchemy import select, text
+
+from .models import db, Image, bump_versions
+from .search import reindex_images
+from .similar import dhash
+from .storage import blobs
+from .thumbnails import store_thumbnails
+
+DEDUP_DONE = {'reject': 'rejected', 'merge': 'merged', 'link': 'linked'}
+
+
+def read_image_file(backend, file, group_id, thumbnail_sizes):
+    """Copy an image file into blob storage and hash it. Run in worker threads.
+    Params:
+        backend [BlobBackend]
+        file [Path]
+        group_id [int] or None
+        thumbnail_sizes [Iterable[int]]
+    Return:
+        row [dict]: values of an image row, plus 'tags'.
+    """
+    with open(file, 'rb') as fh:
+        digest, size = backend.put_stream(fh)
+        fh.seek(0)
+        phash = dhash(fh)
+    store_thumbnails(backend, digest, thumbnail_sizes)
+    return {
+        'digest': digest,
+        'size': size,
+        'phash': phash,
+        'img_type': file.suffix[1:],
+        'filename': file.name,
+        'group_id': group_id,
+        'tags': [file.stem],
+    }
+
+
+def insert_images(session, rows, dedup='merge'):
+    """Insert images with set-based statements in the current transaction.
+    Rows whose digest already exists, in the database or earlier in rows, are
+    handled by the dedup policy instead of being inserted.
+    Params:
+        session [Session]
+        rows [list[dict]]: values of image rows, plus 'tags' [list[str]].
+        dedup [str]: 'reject' | 'merge' | 'link'
+    Return:
+        results [list[tuple[int, str]]]: (image_id, status) in the same order
+        of rows, status is 'added' or the dedup policy applied; image_id is
+        the existing image for duplicates.
+    """
+    if not rows:
+        return []
+
+    # digest -> index of the first row with it
+    first = {}
+    for i, row in enumerate(rows):
+        first.setdefault(row['digest'], i)
+    image_ids = dict(session.execute(
+        select(Image.digest, Image.id).where(Image.digest.in_(list(first)))
+    ).all())
+    new_rows = [rows[i] for digest, i in first.items() if digest not in image_ids]
+
+    added_ids = []
+    if new_rows:
+        columns = ('digest', 'size', 'phash', 'img_type', 'filename', 'group_id')
+        session.execute(
+            Image.__table__.insert(),
+            [{c: row.get(c) for c in columns} for row in new_rows],
+        )
+        # the transaction holds sqlite's write lock, so the rowids just assigned
+        # are consecutive and end at last_insert_rowid().
+        last_id = session.execute(text('SELECT last_insert_rowid()')).scalar()
+        added_ids = list(range(last_id - len(new_rows) + 1, last_id + 1))
+        image_ids.update(zip((row['digest'] for row in new_rows), added_ids))
+
+    added = set(added_ids)
+    results = []
+    tagged = []
+    merged = []
+    for i, row in enumerate(rows):
+        image_id = image_ids[row['digest']]
+        if image_id in added and first[row['digest']] == i:
+            results.append((image_id, 'added'))
+            tagged.append((image_id, row))
+        else:
+            results.append((image_id, dedup))
+            if dedup == 'merge':
+                tagged.append((image_id, row))
+                merged.append((image_id, row))
+
+    for image_id, row in merged:
+        if row.get('group_id') is not None:
+            session.execute(
+                text('UPDATE image SET group_id = :group_id WHERE id = :id AND group_id IS NULL'),
+                {'id': image_id, 'group_id': row['group_id']},
+            )
+
+    pairs = [
+        {'image_id': image_id, 'name': name}
+        for image_id, row in tagged
+        for name in dict.fromkeys(row['tags'])
+    ]
+    if pairs:
+        session.execute(
+            text('INSERT OR IGNORE INTO tag (name) VALUES (:name)'),
+            [{'name': name} for name in {p['name'] for p in pairs}],
+        )
+        session.execute(
+            text('INSERT OR IGNORE INTO image_tag (tag_id, image_id) '
+                 'SELECT id, :image_id FROM tag WHERE name = :name'),
+            pairs,
+        )
+    changed_ids = {image_id for image_id, _ in tagged}
+    if changed_ids:
+        reindex_images(session, changed_ids)
+        bump_versions(session, 'images')
+    return results
+
+
+class Importer(object):
+    """
+    Usage:
+        with Importer(jobs=4, batch_size=500) as importer:
+            for file in files:
+                importer.add(file, group_id)
+        print(importer.count, importer.dup_count)
+    """
+
+    def __init__(self, jobs=4, batch_size=500, dedup=None, echo=print):
+        self.jobs = jobs
+        self.batch_size = batch_size
+        self.dedup = dedup or current_app.config['DEDUP_POLICY']
+        self.echo = echo
+        self.count = 0
+        self.dup_count = 0
+        self.fail_count = 0
+        self.backend = blobs.get_backend()
+        self.thumbnail_sizes = current_app.config['THUMBNAIL_SIZES']
+        self.executor = ThreadPoolExecutor(max_workers=jobs)
+        self.pending = deque()
+        self.files = []
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.close()
+        finally:
+            for _, future in self.pending:
+                future.cancel()
+            self.executor.shutdown(wait=True)
+
+    def add(self, file, group_id=None):
+        """Queue a file, block while too many files are in flight.
+        Params:
+            file [Path]
+            group_id [int] or None
+        """
+        future = self.executor.submit(
+            read_image_file, self.backend, file, group_id, self.thumbnail_sizes,
+        )
+        self.pending.append((file, future))
+        while len(self.pending) >= self.jobs * 2:
+            self.collect()
+
+    def collect(self):
+        file, future = self.pending.popleft()
+        try:
+            row = future.result()
+        except OSError as e:
+            self.echo(f'Error: {file} read failed: {e}')
+            self.fail_count += 1
+            return
+
+        self.files.append(file)
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        results = insert_images(db.session, self.rows, self.dedup)
+        db.session.commit()
+        for file, (image_id, status) in zip(self.files, results):
+            if status == 'added':
+                self.echo(f'Add image {file} done.')
+                self.count += 1
+            else:
+                self.echo(f'Image {file} already exists (id={image_id}), {DEDUP_DONE[status]}.')
+                self.dup_count += 1
+        self.files = []
+        self.rows = []
+
+    def close(self):
+        while self.pending:
+            self.collect()
+        self.flush()
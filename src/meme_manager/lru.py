@@ -0,0 +1,34 @@
+"""Size bounded in-process cache, shared by thumbnails and list responses."""
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """Thread safe LRU cache bounded by the total size of its values.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                self.items.move_to_end(key)
+            except KeyError:
+                return default
+            return self.items[key][0]
+
+    def set(self, key, value, nbytes):
+        if nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.items:
+                self.nbytes -= self.items.pop(key)[1]
+            self.items[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, n) = self.items.popitem(last=False)
+                self.nbytes -= n
@@ -0,0 +1,255 @@
+"""Request timing, SQL statement counting and slow request log.
+
+Every request is timed and labelled by its URL rule, the SQL statements it
+issues are counted and timed through engine events. The totals are rendered in
+the Prometheus text format by `/api/metrics`. Requests slower than
+METRICS_SLOW_REQUEST are logged together with their statements, and kept for
+`/api/metrics/slow`.
+"""
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict, deque
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# statements per request, an N+1 load shows up in the upper buckets.
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+# statements kept for the slow request log, others are only counted.
+MAX_RECORDED_QUERIES = 50
+
+
+class Histogram(object):
+    """Cumulative histogram, as Prometheus exposes it."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # the last one is +Inf.
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """
+        Return:
+            buckets [list[tuple[str, int]]]: (le, count of observations <= le).
+        """
+        total = 0
+        rv = []
+        for le, count in zip((*self.buckets, '+Inf'), self.counts):
+            total += count
+            rv.append((str(le), total))
+        return rv
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    """
+    Params:
+        labels [Iterable[tuple[str, str]]]
+    Return:
+        labels [str]: eg: '{method="GET",endpoint="/api/images/"}'
+    """
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels) + '}'
+
+
+def format_number(value):
+    if isinstance(value, float):
+        return repr(round(value, 6))
+    return str(value)
+
+
+class Metrics(object):
+    """Flask extension instrumenting requests.
+    Config:
+    - METRICS: enable instrumentation, default True.
+    - METRICS_SLOW_REQUEST: seconds from which a request is logged as slow,
+      default 0.5, None to disable.
+    - METRICS_SLOW_LOG_SIZE: slow requests kept for /api/metrics/slow,
+      default 100.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS', True)
+        app.config.setdefault('METRICS_SLOW_REQUEST', 0.5)
+        app.config.setdefault('METRICS_SLOW_LOG_SIZE', 100)
+        if not app.config['METRICS']:
+            return
+
+        app.extensions['metrics'] = {
+            'lock': threading.Lock(),
+            # (method, endpoint) -> Histogram
+            'latency': defaultdict(lambda: Histogram(LATENCY_BUCKETS)),
+            'query_count': defaultdict(lambda: Histogram(QUERY_COUNT_BUCKETS)),
+            # (method, endpoint) -> seconds
+            'query_time': defaultdict(float),
+            # (method, endpoint) -> bytes
+            'bytes': defaultdict(int),
+            # (method, endpoint, status) -> count
+            'responses': defaultdict(int),
+            'slow': deque(maxlen=app.config['METRICS_SLOW_LOG_SIZE']),
+        }
+        app.before_request(start_request)
+        app.after_request(self.finish_request)
+
+    @property
+    def state(self):
+        return current_app.extensions['metrics']
+
+    def finish_request(self, response):
+        stats = g.pop('metrics', None)
+        if stats is None:
+            return response
+
+        duration = time.perf_counter() - stats['start']
+        rule = request.url_rule
+        key = (request.method, rule.rule if rule is not None else '<unmatched>')
+        size = response.calculate_content_length()
+        if size is None:
+            # streamed: a blob sent with send_file() has its length set.
+            size = response.content_length or 0
+
+        state = self.state
+        with state['lock']:
+            state['latency'][key].observe(duration)
+            state['query_count'][key].observe(stats['query_count'])
+            state['query_time'][key] += stats['query_time']
+            state['bytes'][key] += size
+            state['responses'][(*key, response.status_code)] += 1
+
+        threshold = current_app.config['METRICS_SLOW_REQUEST']
+        if threshold is not None and duration >= threshold:
+            self.log_slow_request(response, duration, stats)
+        return response
+
+    def log_slow_request(self, response, duration, stats):
+        entry = {
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'method': request.method,
+            'url': request.full_path.rstrip('?'),
+            'status': response.status_code,
+            'duration': round(duration, 6),
+            'query_count': stats['query_count'],
+            'query_time': round(stats['query_time'], 6),
+            'queries': [
+                {'statement': statement, 'duration': round(elapsed, 6)}
+                for statement, elapsed in stats['queries']
+            ],
+        }
+        with self.state['lock']:
+            self.state['slow'].append(entry)
+        lines = [
+            f'Slow request: {entry["method"]} {entry["url"]} {entry["status"]} '
+            f'{duration:.3f}s, {entry["query_count"]} queries in {stats["query_time"]:.3f}s'
+        ]
+        lines += [f'  {elapsed:.3f}s {statement}' for statement, elapsed in stats['queries']]
+        current_app.logger.warning('\n'.join(lines))
+
+    def slow_requests(self):
+        """
+        Return:
+            entries [list[dict]]: most recent first.
+        """
+        with self.state['lock']:
+            return list(reversed(self.state['slow']))
+
+    def render(self):
+        """
+        Return:
+            text [str]: metrics in the Prometheus text exposition format.
+        """
+        state = self.state
+        lines = []
+
+        def histogram(name, help_, histograms):
+            lines.append(f'# HELP {name} {help_}')
+            lines.append(f'# TYPE {name} histogram')
+            for (method, endpoint), h in sorted(histograms.items()):
+                labels = (('method', method), ('endpoint', endpoint))
+                for le, count in h.cumulative():
+                    lines.append(f'{name}_bucket{format_labels((*labels, ("le", le)))} {count}')
+                lines.append(f'{name}_sum{format_labels(labels)} {format_number(h.sum)}')
+                lines.append(f'{name}_count{format_labels(labels)} {h.count}')
+
+        def counter(name, help_, values, label_names):
+            lines.append(f'# HELP {name} {help_}')
+            lines.append(f'# TYPE {name} counter')
+            for key, value in sorted(values.items()):
+                lines.append(f'{name}{format_labels(zip(label_names, key))} {format_number(value)}')
+
+        with state['lock']:
+            histogram('meme_http_request_duration_seconds',
+                      'Time spent serving requests.', state['latency'])
+            counter('meme_http_responses_total', 'Responses sent.',
+                    state['responses'], ('method', 'endpoint', 'status'))
+            counter('meme_http_response_bytes_total', 'Bytes of response bodies.',
+                    state['bytes'], ('method', 'endpoint'))
+            histogram('meme_sql_queries_per_request',
+                      'SQL statements executed by a request.', state['query_count'])
+            counter('meme_sql_query_duration_seconds_total',
+                    'Time spent executing SQL statements.',
+                    state['query_time'], ('method', 'endpoint'))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+def start_request():
+    g.metrics = {
+        'start': time.perf_counter(),
+        'query_count': 0,
+        'query_time': 0.0,
+        # (statement, seconds), the first MAX_RECORDED_QUERIES ones.
+        'queries': [],
+    }
+
+
+def request_stats():
+    if has_request_context():
+        return g.get('metrics')
+    return None
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query(conn, cursor, statement, parameters, context, executemany):
+    if request_stats() is not None:
+        conn.info.setdefault('metrics_query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def finish_query(conn, cursor, statement, parameters, context, executemany):
+    stats = request_stats()
+    starts = conn.info.get('metrics_query_start')
+    if stats is None or not starts:
+        return
+
+    elapsed = time.perf_counter() - starts.pop()
+    stats['query_count'] += 1
+    stats['query_time'] += elapsed
+    if len(stats['queries']) < MAX_RECORDED_QUERIES:
+        stats['queries'].append((statement, elapsed))
+
+
+@event.listens_for(Engine, 'handle_error')
+def forget_failed_query(exception_context):
+    conn = exception_context.connection
+    starts = conn.info.get('metrics_query_start') if conn is not None else None
+    if starts:
+        starts.pop()
@@ -0,0 +1,525 @@
+"""Versioned migrations of sqlite databases created by older versions of
+meme-manager.
+
+Applied migrations are recorded in the schema_migration table. Every step is
+idempotent: it inspects the schema, does nothing if the database is already up
+to date, and commits its work in batches so that an interrupted migration can
+be resumed by simply running it again. Rows are rewritten in place, batch by
+batch, so a migration never holds a long transaction nor a second copy of the
+data.
+"""
+import re
+import sqlite3
+from io import BytesIO
+
+from sqlalchemy import inspect, text
+
+from .models import db, SchemaMigration, TAG_COUNT_TRIGGERS
+from .dedup import collapse_duplicates
+from .storage import blobs
+
+# ALTER TABLE ... DROP COLUMN needs sqlite >= 3.35, older ones rebuild the table.
+DROP_COLUMN = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+
+class MigrationDeferred(Exception):
+    """Raised by a step which can not complete now (eg: an optional
+    dependency is missing). The migration is not recorded, so the next run
+    tries it again.
+    """
+
+
+def table_columns(table):
+    """
+    Params:
+        table [str]
+    Return:
+        columns [set[str]]
+    """
+    return {c['name'] for c in inspect(db.engine).get_columns(table)}
+
+
+def rebuild_table_sql(dbapi_conn, table, name, column):
+    """
+    Params:
+        dbapi_conn: raw sqlite3 connection.
+        table [str]: existing table.
+        name [str]: name of the new table.
+        column [str]: column left out.
+    Return:
+        sql [str]: CREATE TABLE statement of a copy of table without column.
+        columns [list[str]]: columns of the copy.
+    """
+    definitions = []
+    columns = []
+    primary_key = []
+    for _, col, col_type, notnull, default, pk in dbapi_conn.execute(f'PRAGMA table_info("{table}")'):
+        if col == column:
+            continue
+        columns.append(col)
+        definition = f'"{col}" {col_type}'
+        if notnull:
+            definition += ' NOT NULL'
+        if default is not None:
+            definition += f' DEFAULT ({default})'
+        definitions.append(definition)
+        if pk:
+            primary_key.append((pk, col))
+    if primary_key:
+        definitions.append('PRIMARY KEY (%s)' % ', '.join(f'"{c}"' for _, c in sorted(primary_key)))
+
+    foreign_keys = {}
+    for fk_id, _, ref_table, from_col, to_col, *_ in dbapi_conn.execute(f'PRAGMA foreign_key_list("{table}")'):
+        foreign_keys.setdefault((fk_id, ref_table), []).append((from_col, to_col))
+    for (_, ref_table), pairs in foreign_keys.items():
+        if any(from_col == column for from_col, _ in pairs):
+            continue
+        from_cols = ', '.join(f'"{f}"' for f, _ in pairs)
+        to_cols = ', '.join(f'"{t}"' for _, t in pairs)
+        definitions.append(f'FOREIGN KEY ({from_cols}) REFERENCES "{ref_table}" ({to_cols})')
+    return f'CREATE TABLE "{name}" ({", ".join(definitions)})', columns
+
+
+def drop_column(table, column):
+    """Drop a column and commit. Without ALTER TABLE ... DROP COLUMN, the
+    table is rebuilt the way the sqlite documentation describes: copy the rows
+    into a new table without the column, drop the old one, rename the new one
+    and recreate the indexes and triggers of the old one.
+    Params:
+        table [str]
+        column [str]
+    """
+    if DROP_COLUMN:
+        db.session.execute(text(f'ALTER TABLE "{table}" DROP COLUMN "{column}"'))
+        db.session.commit()
+        return
+
+    db.session.commit()
+    mentions = re.compile(rf'\b{re.escape(column)}\b')
+    with db.engine.connect() as conn:
+        dbapi_conn = conn.connection
+        create, columns = rebuild_table_sql(dbapi_conn, table, f'{table}_rebuild', column)
+        columns = ', '.join(f'"{c}"' for c in columns)
+        schema = [sql for sql, in dbapi_conn.execute(
+            "SELECT sql FROM sqlite_master WHERE tbl_name = ? AND type IN ('index', 'trigger') "
+            'AND sql IS NOT NULL', (table,)
+        )]
+        # can only be switched outside of a transaction.
+        foreign_keys = dbapi_conn.execute('PRAGMA foreign_keys').fetchone()[0]
+        dbapi_conn.execute('PRAGMA foreign_keys = OFF')
+        try:
+            dbapi_conn.execute('BEGIN')
+            dbapi_conn.execute(create)
+            dbapi_conn.execute(f'INSERT INTO "{table}_rebuild" ({columns}) SELECT {columns} FROM "{table}"')
+            dbapi_conn.execute(f'DROP TABLE "{table}"')
+            dbapi_conn.execute(f'ALTER TABLE "{table}_rebuild" RENAME TO "{table}"')
+            for sql in schema:
+                if not mentions.search(sql):
+                    dbapi_conn.execute(sql)
+            dbapi_conn.execute('COMMIT')
+        except BaseException:
+            dbapi_conn.execute('ROLLBACK')
+            raise
+        finally:
+            dbapi_conn.execute(f'PRAGMA foreign_keys = {int(foreign_keys)}')
+
+
+def vacuum():
+    """Give the pages freed by a migration back to the file system."""
+    with db.engine.connect() as conn:
+        conn.execution_options(isolation_level='AUTOCOMMIT').execute(text('VACUUM'))
+
+
+def open_legacy_blob(dbapi_conn, image_id):
+    """Open `image.data` of one row for reading.
+    Use sqlite incremental blob I/O when available (Python 3.11+), so a blob
+    is never loaded into memory as a whole.
+    Params:
+        dbapi_conn: raw sqlite3 connection.
+        image_id [int]
+    Return:
+        fileobj [BinaryIO]
+    """
+    if hasattr(dbapi_conn, 'blobopen'):
+        return dbapi_conn.blobopen('image', 'data', image_id, readonly=True)
+    else:
+        row = dbapi_conn.execute('SELECT data FROM image WHERE id = ?', (image_id,)).fetchone()
+        return BytesIO(row[0])
+
+
+def create_tables(batch_size=100, echo=print):
+    """Create tables added by newer versions.
+    Return:
+        tables [list[str]] or None: created tables, None if there is nothing to upgrade.
+    """
+    existing = set(inspect(db.engine).get_table_names())
+    missing = [t for t in db.metadata.sorted_tables if t.name not in existing]
+    if not missing:
+        return None
+
+    db.metadata.create_all(bind=db.engine, tables=missing)
+    return [t.name for t in missing]
+
+
+def add_columns(batch_size=100, echo=print):
+    """Add nullable columns added by newer versions to existing tables.
+    Return:
+        columns [list[str]] or None: added columns, None if there is nothing to upgrade.
+    """
+    added = []
+    for t in db.metadata.sorted_tables:
+        existing = table_columns(t.name)
+        for c in t.columns:
+            if c.name in existing or not c.nullable:
+                continue
+            col_type = c.type.compile(dialect=db.engine.dialect)
+            db.session.execute(text(f'ALTER TABLE "{t.name}" ADD COLUMN "{c.name}" {col_type}'))
+            added.append(f'{t.name}.{c.name}')
+    db.session.commit()
+    return added or None
+
+
+def create_indexes(batch_size=100, echo=print):
+    """Create indexes added by newer versions on existing tables.
+    Return:
+        indexes [list[str]] or None: created indexes, None if there is nothing to upgrade.
+    """
+    inspector = inspect(db.engine)
+    created = []
+    for t in db.metadata.sorted_tables:
+        existing = {i['name'] for i in inspector.get_indexes(t.name)}
+        columns = table_columns(t.name)
+        for index in t.indexes:
+            # columns added by a later migration, which creates the index.
+            if not {c.name for c in index.columns} <= columns:
+                continue
+            if index.name not in existing:
+                echo(f'Create index {index.name}')
+                index.create(bind=db.engine)
+                created.append(index.name)
+    return created or None
+
+
+def migrate_blobs(batch_size=100, echo=print):
+    """Move image data out of the legacy `image.data` column into blob storage.
+    Params:
+        batch_size [int]: rows per transaction.
+        echo [Callable[[str], None]]: progress reporter.
+    Return:
+        count [int] or None: images moved, None if there is nothing to upgrade.
+    """
+    columns = table_columns('image')
+    if 'data' not in columns:
+        return None
+
+    if 'digest' not in columns:
+        db.session.execute(text('ALTER TABLE image ADD COLUMN digest VARCHAR(64)'))
+    if 'size' not in columns:
+        db.session.execute(text('ALTER TABLE image ADD COLUMN size INTEGER'))
+    db.session.commit()
+
+    total = db.session.execute(
+        text('SELECT count(*) FROM image WHERE digest IS NULL')
+    ).scalar()
+    backend = blobs.get_backend()
+    count = 0
+    # keyset progress: a batch never scans the rows done by the previous ones.
+    last_id = 0
+    while True:
+        ids = db.session.execute(
+            text('SELECT id FROM image WHERE id > :last_id AND digest IS NULL ORDER BY id LIMIT :limit'),
+            {'last_id': last_id, 'limit': batch_size},
+        ).scalars().all()
+        if not ids:
+            break
+
+        dbapi_conn = db.session.connection().connection
+        for image_id in ids:
+            with open_legacy_blob(dbapi_conn, image_id) as fh:
+                digest, size = backend.put_stream(fh)
+            # empty the legacy column right away, so the file does not need
+            # room for a second copy of every image.
+            db.session.execute(
+                text("UPDATE image SET digest = :digest, size = :size, data = x'' WHERE id = :id"),
+                {'digest': digest, 'size': size, 'id': image_id},
+            )
+        db.session.commit()
+        last_id = ids[-1]
+        count += len(ids)
+        echo(f'Move image blobs: {count}/{total}')
+
+    drop_column('image', 'data')
+    return count
+
+
+def migrate_tags(batch_size=100, echo=print):
+    """Move tags out of the legacy comma joined `image.tags` column into the
+    tag and image_tag tables.
+    Params:
+        batch_size [int]: rows per transaction.
+        echo [Callable[[str], None]]: progress reporter.
+    Return:
+        count [int] or None: images moved, None if there is nothing to upgrade.
+    """
+    if 'tags' not in table_columns('image'):
+        return None
+
+    total = db.session.execute(text("SELECT count(*) FROM image WHERE tags != ''")).scalar()
+    count = 0
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            text("SELECT id, tags FROM image WHERE id > :last_id AND tags != '' ORDER BY id LIMIT :limit"),
+            {'last_id': last_id, 'limit': batch_size},
+        ).all()
+        if not rows:
+            break
+
+        pairs = [(image_id, name) for image_id, tags in rows for name in tags.split(',') if name]
+        names = [{'name': name} for name in {name for _, name in pairs}]
+        if names:
+            db.session.execute(text('INSERT OR IGNORE INTO tag (name) VALUES (:name)'), names)
+            db.session.execute(
+                text('INSERT OR IGNORE INTO image_tag (tag_id, image_id) '
+                     'SELECT id, :image_id FROM tag WHERE name = :name'),
+                [{'image_id': image_id, 'name': name} for image_id, name in pairs],
+            )
+        # mark rows done, so an interrupted upgrade resumes where it stopped.
+        db.session.execute(
+            text("UPDATE image SET tags = '' WHERE id IN (%s)" % ','.join(str(r[0]) for r in rows))
+        )
+        db.session.commit()
+        last_id = rows[-1][0]
+        count += len(rows)
+        echo(f'Move image tags: {count}/{total}')
+
+    drop_column('image', 'tags')
+    return count
+
+
+def build_search_index(batch_size=100, echo=print):
+    """Create the full text search table and index images missing in it.
+    Return:
+        count [int] or None: images indexed, None if there is nothing to upgrade.
+    """
+    from .search import INDEX_SELECT, TOKENIZE
+
+    # a rowid lookup per image, where NOT IN would build the whole rowid set.
+    missing = 'NOT EXISTS (SELECT 1 FROM image_fts WHERE image_fts.rowid = image.id)'
+    db.session.execute(text(
+        'CREATE VIRTUAL TABLE IF NOT EXISTS image_fts '
+        f"USING fts5(tags, group_name, filename, tokenize='{TOKENIZE}')"
+    ))
+    total = db.session.execute(text(f'SELECT count(*) FROM image WHERE {missing}')).scalar()
+    if not total:
+        db.session.commit()
+        return None
+
+    count = 0
+    last_id = 0
+    while True:
+        ids = db.session.execute(text(
+            f'SELECT id FROM image WHERE id > :last_id AND {missing} ORDER BY id LIMIT :limit'
+        ), {'last_id': last_id, 'limit': batch_size}).scalars().all()
+        if not ids:
+            break
+        db.session.execute(text(
+            f'INSERT INTO image_fts (rowid, tags, group_name, filename) {INDEX_SELECT} '
+            'WHERE image.id IN (%s)' % ','.join(str(i) for i in ids)
+        ))
+        db.session.commit()
+        last_id = ids[-1]
+        count += len(ids)
+        echo(f'Build search index: {count}/{total}')
+    return count
+
+
+def collapse_images(batch_size=100, echo=print):
+    """Collapse images with the same digest, which the unique index on
+    `image.digest` forbids.
+    Return:
+        count [int] or None: images removed, None if there is nothing to upgrade.
+    """
+    return collapse_duplicates(db.session, batch_size=batch_size, echo=echo)
+
+
+def compute_phashes(batch_size=100, echo=print):
+    """Compute perceptual hashes of images added before they existed.
+    Deferred without Pillow, images are then hashed by a later migration.
+    Return:
+        count [int] or None: images hashed, None if there is nothing to upgrade.
+    """
+    from .similar import PILImage, dhash
+
+    if PILImage is None:
+        raise MigrationDeferred('Pillow is not installed')
+
+    backend = blobs.get_backend()
+    count = 0
+    last_id = 0
+    while True:
+        rows = db.session.execute(text(
+            'SELECT id, digest FROM image WHERE id > :last_id AND phash IS NULL ORDER BY id LIMIT :limit'
+        ), {'last_id': last_id, 'limit': batch_size}).all()
+        if not rows:
+            break
+        params = []
+        for image_id, digest in rows:
+            try:
+                with backend.open(digest) as fh:
+                    phash = dhash(fh)
+            except KeyError:
+                phash = ''
+            params.append({'id': image_id, 'phash': phash})
+        db.session.execute(text('UPDATE image SET phash = :phash WHERE id = :id'), params)
+        db.session.commit()
+        last_id = rows[-1][0]
+        count += len(rows)
+        echo(f'Hash images: {count}')
+    return count or None
+
+
+def count_tag_images(batch_size=100, echo=print):
+    """Add tag.image_count and the triggers maintaining it, then count the
+    images of existing tags.
+    Return:
+        count [int] or None: tags counted, None if there is nothing to upgrade.
+    """
+    if 'image_count' not in table_columns('tag'):
+        db.session.execute(text('ALTER TABLE tag ADD COLUMN image_count INTEGER NOT NULL DEFAULT 0'))
+    # triggers first: the images tagged while counting are not missed.
+    for trigger in TAG_COUNT_TRIGGERS:
+        db.session.execute(text(trigger))
+    db.session.commit()
+    create_indexes(echo=echo)
+
+    total = db.session.execute(text('SELECT count(*) FROM tag')).scalar()
+    count = 0
+    last_id = 0
+    while True:
+        ids = db.session.execute(
+            text('SELECT id FROM tag WHERE id > :last_id ORDER BY id LIMIT :limit'),
+            {'last_id': last_id, 'limit': batch_size},
+        ).scalars().all()
+        if not ids:
+            break
+        db.session.execute(text(
+            'UPDATE tag SET image_count = (SELECT count(*) FROM image_tag WHERE tag_id = tag.id) '
+            'WHERE id BETWEEN :first AND :last'
+        ), {'first': ids[0], 'last': ids[-1]})
+        db.session.commit()
+        last_id = ids[-1]
+        count += len(ids)
+        echo(f'Count tag images: {count}/{total}')
+    return count or None
+
+
+# (version, name, step), in the order they are applied. Append a new
+# migration for every schema change, never renumber or remove one: the
+# database records the versions applied. Steps may be run again on a database
+# already migrated by hand, so each of them checks the schema first.
+MIGRATIONS = [
+    (1, 'create new tables', create_tables),
+    (2, 'add new columns', add_columns),
+    (3, 'move image data to blob storage', migrate_blobs),
+    (4, 'move image tags to tag table', migrate_tags),
+    (5, 'build search index', build_search_index),
+    (6, 'collapse duplicate images', collapse_images),
+    (7, 'compute perceptual hashes', compute_phashes),
+    (8, 'create indexes', create_indexes),
+    (9, 'count images of tags', count_tag_images),
+]
+
+
+def create_migration_table():
+    SchemaMigration.__table__.create(bind=db.engine, checkfirst=True)
+
+
+def applied_versions():
+    """
+    Return:
+        versions [set[int]]: migrations recorded in the database file, empty
+        for files created before migrations were versioned.
+    """
+    create_migration_table()
+    return {version for version, in db.session.query(SchemaMigration.version)}
+
+
+def pending_migrations():
+    """
+    Return:
+        migrations [list[tuple[int, str, Callable]]]: in order.
+    """
+    applied = applied_versions()
+    return [m for m in MIGRATIONS if m[0] not in applied]
+
+
+def version_of(step):
+    """
+    Params:
+        step [Callable]: step of MIGRATIONS.
+    Return:
+        version [int]
+    """
+    return next(version for version, _, s in MIGRATIONS if s is step)
+
+
+def forget(versions):
+    """Mark migrations not applied, so that the next run applies them again.
+    Params:
+        versions [Iterable[int]]
+    """
+    create_migration_table()
+    db.session.query(SchemaMigration)\
+        .filter(SchemaMigration.version.in_(list(versions)))\
+        .delete(synchronize_session=False)
+    db.session.commit()
+
+
+def record(version, name):
+    """Mark a migration applied, once its step completed."""
+    db.session.add(SchemaMigration(version=version, name=name))
+    db.session.commit()
+
+
+def stamp():
+    """Record every migration as applied, for a database just created from
+    the models.
+    """
+    applied = applied_versions()
+    for version, name, _ in MIGRATIONS:
+        if version not in applied:
+            db.session.add(SchemaMigration(version=version, name=name))
+    db.session.commit()
+
+
+def migrate(batch_size=100, echo=print, vacuum_after=False):
+    """Apply pending migrations in order.
+    Every step commits in batches of batch_size rows and a migration is
+    recorded once its step completes: an interrupted migration resumes from
+    its last committed batch when run again.
+    Params:
+        batch_size [int]: rows per transaction.
+        echo [Callable[[str], None]]: progress reporter.
+        vacuum_after [bool]: VACUUM once done, it needs free disk space as
+            large as the database file. Otherwise the freed pages are reused
+            by later inserts.
+    Return:
+        versions [list[int]]: migrations applied, deferred ones excluded.
+    """
+    pending = pending_migrations()
+    applied = []
+    for i, (version, name, step) in enumerate(pending, 1):
+        echo(f'Migration {version} ({i}/{len(pending)}): {name}')
+        try:
+            step(batch_size=batch_size, echo=echo)
+        except MigrationDeferred as e:
+            echo(f'Migration {version}: {name} deferred, {e}.')
+            continue
+        record(version, name)
+        applied.append(version)
+        echo(f'Migration {version}: {name} done.')
+    if applied and vacuum_after:
+        echo('Vacuum database file.')
+        vacuum()
+    return applied
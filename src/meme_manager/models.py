@@ -1,61 +1,205 @@
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.sql import func, operators
-from sqlalchemy import String
-import sqlalchemy.types as types
+from sqlalchemy.sql import func
+from sqlalchemy import DDL, String, and_, bindparam, event, literal_column, select, text, type_coerce
+from sqlalchemy.orm import object_session
+
+from .sqlite import SQLAlchemy
+from .storage import blobs
 
 db = SQLAlchemy()
 
 
-class Array(types.TypeDecorator):
-    """Store as TEXT, seperated by comma.
-    """
+class Group(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(64), unique=True)
+    create_at = db.Column(db.DateTime(), nullable=False, server_default=func.now())
+
+    def __repr__(self):
+        return '<Group %r>' % self.id
 
-    impl = types.Text
 
-    def coerce_compared_value(self, op, value):
-        # support <column>.contains(<str>)
-        if op in (operators.contains_op, operators.like_op, operators.notlike_op):
-            return String()
-        else:
-            return self
+class Tag(db.Model):
+    __table_args__ = (
+        # most used tags: ORDER BY image_count DESC LIMIT n
+        db.Index('ix_tag_image_count', 'image_count'),
+    )
 
-    def process_bind_param(self, value, dialect):
+    id = db.Column(db.Integer, primary_key=True)
+    # the unique index serves both exact and prefix lookups.
+    name = db.Column(db.String(64), unique=True, nullable=False)
+    # number of images having the tag, maintained by triggers on image_tag.
+    image_count = db.Column(db.Integer, nullable=False, server_default='0')
+
+    @classmethod
+    def get_or_create(cls, names):
         """
-        value [list]
-        return text [str]
+        Params:
+            names [list[str]]
+        Return:
+            tags [list[Tag]]: in the same order of names.
         """
-        return ','.join(value)
+        session = db.session()
+        # tags created but not flushed yet in current transaction.
+        pending = session.info.setdefault('pending_tags', {})
+        missing = [n for n in names if n not in pending]
+        with session.no_autoflush:
+            found = {t.name: t for t in cls.query.filter(cls.name.in_(missing))} if missing else {}
+        tags = []
+        for name in names:
+            tag = pending.get(name) or found.get(name)
+            if tag is None:
+                tag = pending[name] = cls(name=name)
+            tags.append(tag)
+        return tags
 
-    def process_result_value(self, value, dialect):
-        """
-        value [str]
-        return array [list]
+    @classmethod
+    def prefix_filter(cls, prefix):
+        """Range condition equal to `name LIKE '<prefix>%'` which sqlite can
+        answer with the index on tag.name.
+        Params:
+            prefix [str]
+        Return:
+            condition [ColumnElement]
         """
-        rv = value.split(',') if value else []
-        return rv
+        if not prefix:
+            return cls.name.isnot(None)
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1) if ord(prefix[-1]) < 0x10ffff else None
+        if upper is None:
+            return cls.name >= prefix
+        return and_(cls.name >= prefix, cls.name < upper)
 
-    def copy(self, **kw):
-        return Array(self.impl.length)
+    def __repr__(self):
+        return '<Tag %r>' % self.name
 
 
-class Group(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(64), unique=True)
-    create_at = db.Column(db.DateTime(), nullable=False, server_default=func.now())
+# inverted index: the primary key (tag_id, image_id) maps a tag to its images.
+image_tag = db.Table(
+    'image_tag',
+    db.Column('tag_id', db.Integer, db.ForeignKey(Tag.id), primary_key=True),
+    db.Column('image_id', db.Integer, db.ForeignKey('image.id'), primary_key=True),
+    db.Index('ix_image_tag_image_id', 'image_id'),
+)
 
-    def __repr__(self):
-        return '<Group %r>' % self.id
+
+# tag.image_count follows every change of image_tag in the same transaction,
+# whoever makes it: ORM flushes, set-based statements and other processes.
+TAG_COUNT_TRIGGERS = (
+    'CREATE TRIGGER IF NOT EXISTS image_tag_count_insert AFTER INSERT ON image_tag BEGIN '
+    'UPDATE tag SET image_count = image_count + 1 WHERE id = NEW.tag_id; END',
+    'CREATE TRIGGER IF NOT EXISTS image_tag_count_delete AFTER DELETE ON image_tag BEGIN '
+    'UPDATE tag SET image_count = image_count - 1 WHERE id = OLD.tag_id; END',
+    'CREATE TRIGGER IF NOT EXISTS image_tag_count_update AFTER UPDATE OF tag_id ON image_tag BEGIN '
+    'UPDATE tag SET image_count = image_count - 1 WHERE id = OLD.tag_id; '
+    'UPDATE tag SET image_count = image_count + 1 WHERE id = NEW.tag_id; END',
+)
+for trigger in TAG_COUNT_TRIGGERS:
+    event.listen(image_tag, 'after_create', DDL(trigger))
+
+# tags of an image in the order they were added: image_tag rows get
+# increasing rowids, which VACUUM renumbers but keeps in order.
+IMAGE_TAG_ORDER = literal_column('image_tag.rowid')
 
 
 class Image(db.Model):
+    __table_args__ = (
+        # keyset pagination: ORDER BY create_at, id
+        db.Index('ix_image_create_at_id', 'create_at', 'id'),
+        # list of a group in page order, group deletion and export.
+        db.Index('ix_image_group_id_create_at_id', 'group_id', 'create_at', 'id'),
+        # content dedup: every blob is referenced by one image.
+        db.Index('ix_image_digest', 'digest', unique=True),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
-    data = db.Column(db.LargeBinary(length=2**24-1), nullable=False) # max size: 16MB
+    # image data lives in blob storage, addressed by its sha256 hex digest.
+    digest = db.Column(db.String(64), nullable=False)
+    size = db.Column(db.Integer, nullable=False)
     img_type = db.Column(db.String(64), nullable=False)
-    tags = db.Column(Array(), nullable=False)
+    # perceptual hash (hex), see similar.py. None: not computed, '': undecodable.
+    phash = db.Column(db.String(16))
+    # name of the uploaded or imported file.
+    filename = db.Column(db.String(255))
+    tag_records = db.relationship(Tag, secondary=image_tag, order_by=IMAGE_TAG_ORDER,
+                                  backref=db.backref('images', lazy='dynamic'))
     group_id = db.Column(db.Integer, db.ForeignKey(Group.id))
     group = db.relationship(Group, backref=db.backref('images', lazy=True, cascade="all,delete"))
     create_at = db.Column(db.DateTime(), nullable=False, server_default=func.now())
 
+    @property
+    def tags(self):
+        return [t.name for t in self.tag_records]
+
+    @tags.setter
+    def tags(self, names):
+        self.tag_records = Tag.get_or_create(list(dict.fromkeys(names)))
+
+    @classmethod
+    def tag_filter(cls, tag=None, prefix=None):
+        """Images having the tag, or any tag starts with prefix.
+        Params:
+            tag [str]
+            prefix [str]
+        Return:
+            condition [ColumnElement]
+        """
+        condition = Tag.name == tag if tag is not None else Tag.prefix_filter(prefix)
+        return cls.id.in_(
+            select(image_tag.c.image_id)
+            .join(Tag, Tag.id == image_tag.c.tag_id)
+            .where(condition)
+        )
+
+    @classmethod
+    def list_query(cls, datetime_format):
+        """Project the columns shown in image lists, group name included by
+        a join, so rows are served without loading Image instances.
+        create_at is formatted by sqlite, no datetime object is created.
+        Params:
+            datetime_format [str]: codes shared by datetime.strftime() and
+            sqlite strftime(), eg: '%Y-%m-%d %H:%M:%S'
+        Return:
+            query [Query]: rows of (id, img_type, group, create_at [str],
+            sort_key [str]), sort_key: create_at as stored, with fractions
+            of a second if any.
+        """
+        return db.session.query(
+            cls.id,
+            cls.img_type,
+            Group.name.label('group'),
+            func.strftime(datetime_format, cls.create_at).label('create_at'),
+            type_coerce(cls.create_at, String).label('sort_key'),
+        ).outerjoin(Group, Group.id == cls.group_id)
+
+    @classmethod
+    def tags_of(cls, image_ids):
+        """Tag names of many images with a single query.
+        Params:
+            image_ids [Iterable[int]]
+        Return:
+            tags [dict[int, list[str]]]: image id -> tag names in the order
+            they were added.
+        """
+        image_ids = ','.join(str(int(i)) for i in image_ids)
+        if not image_ids:
+            return {}
+        # ids inlined: compiling a bound parameter per id costs more than the query.
+        rows = db.session.execute(text(
+            'SELECT image_tag.image_id, tag.name FROM image_tag JOIN tag ON tag.id = image_tag.tag_id '
+            f'WHERE image_tag.image_id IN ({image_ids}) ORDER BY image_tag.rowid'
+        ))
+        tags = {}
+        for image_id, name in rows:
+            tags.setdefault(image_id, []).append(name)
+        return tags
+
+    @property
+    def data(self):
+        return blobs.read(self.digest)
+
+    @data.setter
+    def data(self, value):
+        self.digest = blobs.put(value)
+        self.size = len(value)
+
     def readyToJSON(self, keys, datetime_format):
         """
         Params:
@@ -75,3 +219,124 @@ class Image(db.Model):
 
     def __repr__(self):
         return '<Image %r>' % self.id
+
+
+class Version(db.Model):
+    """Change counter of a table, used as HTTP cache validator (ETag).
+    Bumped by every flush that changes the table.
+    """
+    name = db.Column(db.String(64), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return '<Version %r=%r>' % (self.name, self.value)
+
+
+class SchemaMigration(db.Model):
+    """Migration applied to the database file, see migrations.MIGRATIONS."""
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.String(128), nullable=False)
+    applied_at = db.Column(db.DateTime(), nullable=False, server_default=func.now())
+
+    def __repr__(self):
+        return '<SchemaMigration %r>' % self.version
+
+
+def bump_versions(session, *names):
+    """Increase version counters in the current transaction.
+    Set-based statements bypass the session, their callers must call this.
+    Params:
+        session [Session]
+        names [str]: 'images' | 'groups' | 'image_deletes' (images deleted)
+    """
+    # read by the response cache once the transaction commits.
+    session.info.setdefault('bumped_versions', set()).update(names)
+    for name in names:
+        session.execute(
+            text('INSERT INTO version (name, value) VALUES (:name, 1) '
+                 'ON CONFLICT (name) DO UPDATE SET value = value + 1'),
+            {'name': name},
+        )
+
+
+GET_VERSIONS = text('SELECT name, value FROM version WHERE name IN :names')\
+    .bindparams(bindparam('names', expanding=True))
+
+
+def get_versions(*names):
+    """
+    Params:
+        names [str]
+    Return:
+        versions [list[int]]: in the same order of names, 0 if never bumped.
+    """
+    # read on every list and suggest request: a plain statement skips the
+    # ORM query compilation.
+    values = dict(db.session.execute(GET_VERSIONS, {'names': list(names)}).all())
+    return [values.get(name, 0) for name in names]
+
+
+@event.listens_for(db.session, 'after_flush')
+def bump_changed_versions(session, flush_context):
+    names = set()
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(obj, Image):
+            names.add('images')
+            if obj in session.deleted:
+                names.add('image_deletes')
+        elif isinstance(obj, Group):
+            # image list shows group names.
+            names.update(('groups', 'images'))
+    if names:
+        bump_versions(session, *sorted(names))
+
+
+# Blob garbage collection: the blob of a deleted image is removed from storage
+# once the transaction commits, unless another image still references it.
+@event.listens_for(Image, 'after_delete')
+def collect_deleted_digest(mapper, connection, target):
+    session = object_session(target)
+    session.info.setdefault('deleted_digests', set()).add(target.digest)
+
+
+@event.listens_for(db.session, 'after_flush')
+def find_orphan_blobs(session, flush_context):
+    digests = session.info.pop('deleted_digests', None)
+    if not digests:
+        return
+
+    referenced = set(session.execute(
+        select(Image.digest).where(Image.digest.in_(digests))
+    ).scalars())
+    session.info.setdefault('orphan_digests', set()).update(digests - referenced)
+
+
+@event.listens_for(db.session, 'after_commit')
+def delete_orphan_blobs(session):
+    digests = session.info.pop('orphan_digests', None)
+    if not digests:
+        return
+
+    # another session may have committed an image of the same content since
+    # the flush, its put() found the blob present: check again right before
+    # deleting. Puts rewrite existing files (see FileSystemBackend.commit_tmp),
+    # so a put after the unlink brings the blob back. Only a put done before
+    # the unlink, whose row commits after this check, still loses its blob.
+    with session.get_bind().connect() as conn:
+        referenced = set(conn.execute(
+            select(Image.digest).where(Image.digest.in_(digests))
+        ).scalars())
+    for digest in digests - referenced:
+        blobs.delete(digest)
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def forget_orphan_blobs(session, previous_transaction):
+    session.info.pop('deleted_digests', None)
+    session.info.pop('orphan_digests', None)
+
+
+@event.listens_for(db.session, 'after_commit')
+@event.listens_for(db.session, 'after_soft_rollback')
+def forget_pending_tags(session, *args):
+    session.info.pop('pending_tags', None)
@@ -0,0 +1,150 @@
+"""Full text search over image tags, group names and filenames.
+
+An FTS5 table `image_fts` (rowid = image.id) mirrors the searchable text of
+every image. It is kept in sync by a session hook on every flush, set-based
+statements that bypass the session must call `reindex_images()` themselves.
+"""
+import sqlite3
+
+from sqlalchemy import DDL, and_, event, func, inspect, literal_column, or_, select, text
+from sqlalchemy.sql import column, table
+
+from .models import db, Image, Group
+
+# trigram tokenizer matches any fragment of a word (sqlite >= 3.34), it also
+# works for CJK text which has no word separators.
+TRIGRAM = sqlite3.sqlite_version_info >= (3, 34, 0)
+TOKENIZE = 'trigram' if TRIGRAM else 'unicode61'
+# bm25 column weights: tags, group_name, filename.
+BM25_WEIGHTS = (10.0, 5.0, 1.0)
+
+image_fts = table(
+    'image_fts',
+    column('rowid'),
+    column('tags'),
+    column('group_name'),
+    column('filename'),
+)
+
+event.listen(db.metadata, 'after_create', DDL(
+    "CREATE VIRTUAL TABLE IF NOT EXISTS image_fts "
+    f"USING fts5(tags, group_name, filename, tokenize='{TOKENIZE}')"
+))
+event.listen(db.metadata, 'before_drop', DDL('DROP TABLE IF EXISTS image_fts'))
+
+
+INDEX_SELECT = """
+SELECT image.id,
+    (SELECT group_concat(tag.name, ' ') FROM image_tag JOIN tag ON tag.id = image_tag.tag_id
+     WHERE image_tag.image_id = image.id),
+    "group".name,
+    image.filename
+FROM image LEFT JOIN "group" ON "group".id = image.group_id
+"""
+
+
+def reindex_images(session, image_ids=(), group_ids=()):
+    """Rebuild the index rows of images with set-based statements.
+    Params:
+        session [Session]
+        image_ids [Iterable[int]]
+        group_ids [Iterable[int]]: reindex every image in these groups.
+    """
+    conditions = []
+    if image_ids:
+        conditions.append('image.id IN (%s)' % ','.join(str(int(i)) for i in image_ids))
+    if group_ids:
+        conditions.append('image.group_id IN (%s)' % ','.join(str(int(i)) for i in group_ids))
+    if not conditions:
+        return
+
+    where = ' OR '.join(conditions)
+    if group_ids:
+        session.execute(text(
+            f'DELETE FROM image_fts WHERE rowid IN (SELECT image.id FROM image WHERE {where})'
+        ))
+    else:
+        unindex_images(session, image_ids)
+    session.execute(text(
+        f'INSERT INTO image_fts (rowid, tags, group_name, filename) {INDEX_SELECT} WHERE {where}'
+    ))
+
+
+def unindex_images(session, image_ids):
+    """
+    Params:
+        session [Session]
+        image_ids [Iterable[int]]
+    """
+    if image_ids:
+        session.execute(text(
+            'DELETE FROM image_fts WHERE rowid IN (%s)' % ','.join(str(int(i)) for i in image_ids)
+        ))
+
+
+@event.listens_for(db.session, 'after_flush')
+def sync_search_index(session, flush_context):
+    image_ids = set()
+    deleted_ids = set()
+    group_ids = set()
+    for obj in session.new:
+        if isinstance(obj, Image):
+            image_ids.add(obj.id)
+    for obj in session.dirty:
+        if isinstance(obj, Image):
+            image_ids.add(obj.id)
+        elif isinstance(obj, Group) and inspect(obj).attrs.name.history.has_changes():
+            group_ids.add(obj.id)
+    for obj in session.deleted:
+        if isinstance(obj, Image):
+            deleted_ids.add(obj.id)
+    unindex_images(session, deleted_ids)
+    reindex_images(session, image_ids - deleted_ids, group_ids)
+
+
+def quote(term):
+    return '"%s"' % term.replace('"', '""')
+
+
+def search(q):
+    """Compile a user query into a subquery of matched images.
+    Every whitespace separated term must appear in the tags, group name or
+    filename of an image. With trigram tokenizer, terms shorter than 3
+    characters can not use the index and fall back to LIKE on the fts table.
+    Params:
+        q [str]
+    Return:
+        subquery [Subquery] or None: columns (image_id, rank), lower rank is
+        better; None if q has no term.
+    """
+    terms = q.split()
+    if not terms:
+        return None
+
+    if TRIGRAM:
+        indexed = [t for t in terms if len(t) >= 3]
+        scanned = [t for t in terms if len(t) < 3]
+    else:
+        indexed = terms
+        scanned = []
+
+    conditions = []
+    if indexed:
+        if TRIGRAM:
+            expr = ' '.join(quote(t) for t in indexed)
+        else:
+            expr = ' '.join(quote(t) + '*' for t in indexed)
+        conditions.append(literal_column('image_fts').op('MATCH')(expr))
+        rank = func.bm25(literal_column('image_fts'), *BM25_WEIGHTS)
+    else:
+        rank = literal_column('0')
+    for term in scanned:
+        pattern = '%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        conditions.append(or_(*(
+            image_fts.c[c].like(pattern, escape='\\') for c in ('tags', 'group_name', 'filename')
+        )))
+
+    return select(
+        image_fts.c.rowid.label('image_id'),
+        rank.label('rank'),
+    ).select_from(image_fts).where(and_(*conditions)).subquery()
@@ -0,0 +1,241 @@
+"""Near-duplicate detection with perceptual hashes.
+
+Every image gets a 64 bit difference hash (dHash) when it is added, which
+survives re-encoding, resizing and re-compression: similar images have hashes
+with a small hamming distance. Hashes are kept in an in-process BK-tree, so a
+radius query visits only a small part of the library instead of comparing
+every pair of images.
+
+Computing hashes needs Pillow (`pip install meme-manager[thumbnails]`).
+`image.phash` is NULL if it has not been computed, '' if the data can not be
+decoded.
+"""
+import threading
+
+from flask import current_app
+from sqlalchemy import func
+
+from .models import db, Image, get_versions
+
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    PILImage = None
+
+HASH_SIZE = 8
+
+
+def dhash(fileobj):
+    """Difference hash: compare every pixel of a shrunk grayscale image with
+    its right neighbour.
+    Params:
+        fileobj [BinaryIO]
+    Return:
+        phash [str]: 16 hex digits; '' if the data can not be decoded; None
+        if Pillow is missing.
+    """
+    if PILImage is None:
+        return None
+
+    try:
+        with PILImage.open(fileobj) as im:
+            im.seek(0)
+            im.draft('L', (HASH_SIZE * 4, HASH_SIZE * 4))
+            im = im.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), PILImage.LANCZOS)
+            pixels = im.tobytes()
+    except (OSError, ValueError, SyntaxError, PILImage.DecompressionBombError):
+        return ''
+
+    value = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            i = row * (HASH_SIZE + 1) + col
+            value = value << 1 | (pixels[i] > pixels[i + 1])
+    return f'{value:016x}'
+
+
+def distance(a, b):
+    """Hamming distance of two hashes as int."""
+    return bin(a ^ b).count('1')
+
+
+class BKTree(object):
+    """Burkhard-Keller tree over hamming distance. Children of a node are
+    keyed by their distance to it, so by the triangle inequality a query of
+    radius r only descends into children keyed d - r .. d + r.
+    """
+
+    def __init__(self):
+        # node: [hash, ids, children {distance: node}]
+        self.root = None
+        self.size = 0
+
+    def add(self, value, item):
+        """
+        Params:
+            value [int]: hash.
+            item: eg: image id.
+        """
+        self.size += 1
+        if self.root is None:
+            self.root = [value, [item], {}]
+            return
+
+        node = self.root
+        while True:
+            d = distance(value, node[0])
+            if d == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [value, [item], {}]
+                return
+            node = child
+
+    def search(self, value, radius):
+        """
+        Params:
+            value [int]: hash.
+            radius [int]
+        Return:
+            results [list[tuple[int, item]]]: (distance, item), nearest first.
+        """
+        results = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            d = distance(value, node[0])
+            if d <= radius:
+                results += [(d, item) for item in node[1]]
+            for child_d, child in node[2].items():
+                if d - radius <= child_d <= d + radius:
+                    stack.append(child)
+        results.sort(key=lambda r: r[0])
+        return results
+
+
+def build_tree(rows):
+    """
+    Params:
+        rows [Iterable[tuple[int, str]]]: (image id, phash)
+    Return:
+        tree [BKTree]
+    """
+    tree = BKTree()
+    for image_id, phash in rows:
+        if phash:
+            tree.add(int(phash, 16), image_id)
+    return tree
+
+
+def find_clusters(rows, radius):
+    """Group images whose hashes are within radius of each other.
+    Params:
+        rows [list[tuple[int, str]]]: (image id, phash)
+        radius [int]
+    Return:
+        clusters [list[list[int]]]: image ids of every cluster with more than
+        one image, ordered by their smallest id.
+    """
+    tree = build_tree(rows)
+    hashes = dict(rows)
+    seen = set()
+    clusters = []
+    for image_id, phash in sorted(rows):
+        if not phash or image_id in seen:
+            continue
+        # expand the cluster transitively from its first image.
+        cluster = {image_id}
+        queue = [image_id]
+        while queue:
+            value = int(hashes[queue.pop()], 16)
+            for _, other in tree.search(value, radius):
+                if other not in cluster:
+                    cluster.add(other)
+                    queue.append(other)
+        seen |= cluster
+        if len(cluster) > 1:
+            clusters.append(sorted(cluster))
+    return clusters
+
+
+class SimilarIndex(object):
+    """Flask extension holding the BK-tree of the images of an app.
+    The tree is built on first use and catches up with images added since,
+    deleted images are filtered out when querying. It is rebuilt once images
+    are deleted: sqlite gives the id of a deleted newest image to the next
+    one, which catching up from the last id would miss.
+    Config:
+    - SIMILAR_DISTANCE: default hamming radius of queries, default 10.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SIMILAR_DISTANCE', 10)
+        app.extensions['similar'] = {
+            'tree': BKTree(),
+            'last_id': 0,
+            'version': None,
+            'deletes': None,
+            'lock': threading.Lock(),
+        }
+
+    @property
+    def state(self):
+        return current_app.extensions['similar']
+
+    def refresh(self):
+        """Add images inserted since the last call to the tree. Rebuild it if
+        images were deleted or the database went backwards (eg: recreated).
+        """
+        state = self.state
+        version, deletes = get_versions('images', 'image_deletes')
+        if version == state['version']:
+            return
+        with state['lock']:
+            max_id = db.session.query(func.max(Image.id)).scalar() or 0
+            if (state['version'] is None or version < state['version']
+                    or deletes != state['deletes'] or max_id < state['last_id']):
+                state['tree'] = BKTree()
+                state['last_id'] = 0
+            rows = db.session.query(Image.id, Image.phash)\
+                             .filter(Image.id > state['last_id'], Image.id <= max_id)\
+                             .yield_per(1000)
+            for image_id, phash in rows:
+                if phash:
+                    state['tree'].add(int(phash, 16), image_id)
+            state['last_id'] = max_id
+            state['version'] = version
+            state['deletes'] = deletes
+
+    def search(self, phash, radius=None):
+        """
+        Params:
+            phash [str]
+            radius [int]: default to SIMILAR_DISTANCE.
+        Return:
+            results [list[tuple[int, int]]]: (distance, image id) of existing
+            images, nearest first.
+        """
+        if radius is None:
+            radius = current_app.config['SIMILAR_DISTANCE']
+        self.refresh()
+        results = self.state['tree'].search(int(phash, 16), radius)
+        if not results:
+            return []
+        # drop deleted images, and ids reused by other images.
+        existing = dict(
+            db.session.query(Image.id, Image.phash)
+                      .filter(Image.id.in_([image_id for _, image_id in results]))
+        )
+        return [
+            (d, image_id) for d, image_id in results
+            if existing.get(image_id) and distance(int(existing[image_id], 16), int(phash, 16)) == d
+        ]
+
+
+similar = SimilarIndex()
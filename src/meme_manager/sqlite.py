@@ -0,0 +1,118 @@
+"""SQLite tuning profile applied to every connection.
+
+WAL journaling lets readers go on while a writer (eg: an import) holds the
+write lock, synchronous=NORMAL is durable across application crashes in WAL
+mode, and a larger page cache and memory mapped I/O cut syscalls on reads.
+"""
+import re
+
+from flask_sqlalchemy import SQLAlchemy as _SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool, StaticPool
+
+# pool arguments QueuePool accepts but StaticPool (in-memory database) does not.
+POOL_OPTIONS = ('pool_size', 'max_overflow', 'pool_timeout')
+
+
+def apply_pragmas(dbapi_conn, pragmas):
+    """
+    Params:
+        dbapi_conn: raw sqlite3 connection.
+        pragmas [dict[str, Union[str, int]]]: applied in order.
+    """
+    for name, value in pragmas.items():
+        if not re.fullmatch(r'\w+', name) or not re.fullmatch(r'-?\w+', str(value)):
+            raise ValueError(f'bad sqlite pragma: {name}={value}')
+        dbapi_conn.execute(f'PRAGMA {name} = {value}').fetchall()
+
+
+def effective_pragmas(engine, names):
+    """
+    Params:
+        engine [Engine]
+        names [Iterable[str]]
+    Return:
+        pragmas [dict[str, str]]: current values on a pooled connection.
+    """
+    values = {}
+    with engine.connect() as conn:
+        dbapi_conn = conn.connection
+        for name in names:
+            if not re.fullmatch(r'\w+', name):
+                raise ValueError(f'bad sqlite pragma: {name}')
+            row = dbapi_conn.execute(f'PRAGMA {name}').fetchone()
+            values[name] = None if row is None else str(row[0])
+    return values
+
+
+def mismatched_pragmas(expected, effective):
+    """Pragmas not in effect, eg: WAL is refused on network file systems.
+    Params:
+        expected [dict]: SQLITE_PRAGMAS
+        effective [dict]: result of effective_pragmas()
+    Return:
+        names [list[str]]
+    """
+    # synchronous and temp_store read back as numbers.
+    aliases = {
+        'synchronous': {'off': '0', 'normal': '1', 'full': '2', 'extra': '3'},
+        'temp_store': {'default': '0', 'file': '1', 'memory': '2'},
+    }
+    names = []
+    for name, value in expected.items():
+        value = str(value).lower()
+        value = aliases.get(name, {}).get(value, value)
+        if effective.get(name) is not None and effective[name].lower() != value:
+            names.append(name)
+    return names
+
+
+def report_pragmas(engine, expected, echo=print):
+    """Startup check: print the pragmas in effect, warn about those which
+    could not be applied.
+    Params:
+        engine [Engine]
+        expected [dict]: SQLITE_PRAGMAS
+        echo [Callable[[str], None]]
+    Return:
+        mismatched [list[str]]
+    """
+    effective = effective_pragmas(engine, expected)
+    echo('SQLite: ' + ', '.join(f'{name}={value}' for name, value in effective.items()))
+    mismatched = mismatched_pragmas(expected, effective)
+    for name in mismatched:
+        echo(f'Warning: SQLite pragma {name}={expected[name]} is not in effect ({name}={effective[name]}).')
+    return mismatched
+
+
+class SQLAlchemy(_SQLAlchemy):
+    """Apply SQLITE_PRAGMAS on every new connection, and pool connections to
+    a database file with QueuePool (Flask-SQLAlchemy picks NullPool, which
+    reconnects, and reapplies pragmas, on every checkout).
+    apply_driver_hacks() and create_engine() are hooks of Flask-SQLAlchemy 2.x,
+    setup.py pins it.
+    """
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        sa_url, options = super().apply_driver_hacks(app, sa_url, options)
+        if sa_url.drivername.startswith('sqlite'):
+            options['sqlite_pragmas'] = dict(app.config.get('SQLITE_PRAGMAS') or {})
+        return sa_url, options
+
+    def create_engine(self, sa_url, engine_opts):
+        # SQLALCHEMY_ENGINE_OPTIONS are merged after apply_driver_hacks().
+        engine_opts = dict(engine_opts)
+        pragmas = engine_opts.pop('sqlite_pragmas', None)
+        if pragmas is not None:
+            if engine_opts.get('poolclass') is StaticPool:
+                # in-memory database: one shared connection.
+                for name in POOL_OPTIONS:
+                    engine_opts.pop(name, None)
+            elif engine_opts.get('pool_size'):
+                engine_opts['poolclass'] = QueuePool
+        engine = super().create_engine(sa_url, engine_opts)
+        if pragmas:
+            @event.listens_for(engine, 'connect')
+            def on_connect(dbapi_conn, connection_record):
+                apply_pragmas(dbapi_conn, pragmas)
+        return engine
@@ -0,0 +1,416 @@
+"""Content-addressed blob storage for image data.
+
+Image bytes are kept outside of the sqlite database, addressed by the
+SHA-256 hex digest of their content. The `Image` table only holds the digest
+and the size, so metadata queries never page blob data through the cache.
+"""
+import hashlib
+import os
+import shutil
+import uuid
+from io import BytesIO
+from pathlib import Path
+
+from flask import current_app, request, send_file
+from sqlalchemy.engine.url import make_url
+
+CHUNK_SIZE = 2**16
+# one year, the maximum recommended by RFC 9111.
+IMMUTABLE_MAX_AGE = 31536000
+
+
+class BlobNotFound(KeyError):
+    pass
+
+
+class BlobBackend(object):
+    """Storage backend interface.
+
+    Blobs are immutable and addressed by `digest` [str], the SHA-256 hex
+    digest of their content. A blob may have derivatives (eg: thumbnails),
+    stored alongside it under a `name` [str] and deleted together with it.
+    """
+
+    def put(self, data):
+        """
+        Params:
+            data [bytes]
+        Return:
+            digest [str]
+        """
+        return self.put_stream(BytesIO(data))[0]
+
+    def put_stream(self, fileobj):
+        """Copy a readable binary file object into storage chunk by chunk.
+        Params:
+            fileobj [BinaryIO]
+        Return:
+            digest [str], size [int]
+        """
+        raise NotImplementedError
+
+    def writer(self):
+        """
+        Return:
+            writer [BlobWriter]: a blob written chunk by chunk.
+        """
+        return BlobWriter(self)
+
+    def put_derivative(self, digest, name, data):
+        """
+        Params:
+            digest [str]: digest of the original blob.
+            name [str]
+            data [bytes]
+        """
+        raise NotImplementedError
+
+    def open(self, digest, name=None):
+        """
+        Return:
+            fileobj [BinaryIO]: caller should close it.
+        """
+        raise NotImplementedError
+
+    def read(self, digest, name=None):
+        with self.open(digest, name) as fh:
+            return fh.read()
+
+    def path(self, digest, name=None):
+        """
+        Return:
+            path [Path] or None: None if the backend does not keep blobs as
+            regular files.
+        """
+        return None
+
+    def exists(self, digest, name=None):
+        raise NotImplementedError
+
+    def delete(self, digest):
+        """Delete a blob and all its derivatives."""
+        raise NotImplementedError
+
+
+class BlobWriter(object):
+    """Writable binary file object which stores what is written as a blob,
+    hashing it on the way. Usable as the container of an uploaded file.
+    Usage:
+        writer = backend.writer()
+        writer.write(chunk)
+        ...
+        digest, size = writer.commit()  # or writer.discard()
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hasher = hashlib.sha256()
+        self.size = 0
+        self.buf = BytesIO()
+
+    def write(self, data):
+        self.hasher.update(data)
+        self.size += len(data)
+        return self.buf.write(data)
+
+    def seek(self, offset, whence=0):
+        # rewinding is a no-op: the blob is only readable once committed.
+        return 0
+
+    def close(self):
+        pass
+
+    def commit(self):
+        """
+        Return:
+            digest [str], size [int]
+        """
+        self.buf.seek(0)
+        rv = self.backend.put_stream(self.buf)
+        self.discard()
+        return rv
+
+    def discard(self):
+        self.buf = BytesIO()
+
+
+class FileBlobWriter(BlobWriter):
+    """Write straight to a temporary file of a FileSystemBackend, moved into
+    place on commit.
+    """
+
+    def __init__(self, backend):
+        super().__init__(backend)
+        self.tmp_path = backend.tmp_path()
+        self.fh = open(self.tmp_path, 'wb')
+
+    def write(self, data):
+        self.hasher.update(data)
+        self.size += len(data)
+        return self.fh.write(data)
+
+    def commit(self):
+        self.fh.close()
+        digest = self.hasher.hexdigest()
+        try:
+            self.backend.commit_tmp(self.tmp_path, self.backend.path(digest))
+        except BaseException:
+            self.discard()
+            raise
+        return digest, self.size
+
+    def discard(self):
+        self.fh.close()
+        if self.tmp_path.exists():
+            self.tmp_path.unlink()
+
+
+class FileSystemBackend(BlobBackend):
+    """Store every blob as a regular file: <root>/<d[:2]>/<d[2:4]>/<d>,
+    and its derivatives next to it: <root>/<d[:2]>/<d[2:4]>/<d>.<name>
+
+    Writes go to <root>/tmp first and are moved into place with an atomic
+    rename, so readers never see a partially written blob.
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def path(self, digest, name=None):
+        filename = digest if name is None else f'{digest}.{name}'
+        return self.root/digest[:2]/digest[2:4]/filename
+
+    def tmp_path(self):
+        tmp_dir = self.root/'tmp'
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+        return tmp_dir/uuid.uuid4().hex
+
+    def commit_tmp(self, tmp_path, dest):
+        # replace an existing file too: the blob may be deleted by the
+        # garbage collection of another session meanwhile, see
+        # models.delete_orphan_blobs(). Same content, readers are not affected.
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(tmp_path, dest)
+
+    def put_stream(self, fileobj):
+        tmp_path = self.tmp_path()
+        hasher = hashlib.sha256()
+        size = 0
+        try:
+            with open(tmp_path, 'wb') as fh:
+                for chunk in iter(lambda: fileobj.read(CHUNK_SIZE), b''):
+                    hasher.update(chunk)
+                    fh.write(chunk)
+                    size += len(chunk)
+            digest = hasher.hexdigest()
+            self.commit_tmp(tmp_path, self.path(digest))
+        except BaseException:
+            if tmp_path.exists():
+                tmp_path.unlink()
+            raise
+        return digest, size
+
+    def writer(self):
+        return FileBlobWriter(self)
+
+    def put_derivative(self, digest, name, data):
+        tmp_path = self.tmp_path()
+        try:
+            tmp_path.write_bytes(data)
+            self.commit_tmp(tmp_path, self.path(digest, name))
+        except BaseException:
+            if tmp_path.exists():
+                tmp_path.unlink()
+            raise
+
+    def open(self, digest, name=None):
+        try:
+            return open(self.path(digest, name), 'rb')
+        except FileNotFoundError:
+            raise BlobNotFound(digest)
+
+    def exists(self, digest, name=None):
+        return self.path(digest, name).is_file()
+
+    def delete(self, digest):
+        fp = self.path(digest)
+        for p in (fp, *fp.parent.glob(f'{digest}.*')):
+            try:
+                p.unlink()
+            except FileNotFoundError:
+                pass
+
+
+class MemoryBackend(BlobBackend):
+    """Keep blobs in a dict. Used by tests and `sqlite:///:memory:` databases.
+    """
+
+    def __init__(self):
+        # (digest, name) -> data
+        self.blobs = {}
+
+    def put_stream(self, fileobj):
+        buf = BytesIO()
+        shutil.copyfileobj(fileobj, buf, CHUNK_SIZE)
+        data = buf.getvalue()
+        digest = hashlib.sha256(data).hexdigest()
+        self.blobs.setdefault((digest, None), data)
+        return digest, len(data)
+
+    def put_derivative(self, digest, name, data):
+        self.blobs[(digest, name)] = data
+
+    def open(self, digest, name=None):
+        try:
+            return BytesIO(self.blobs[(digest, name)])
+        except KeyError:
+            raise BlobNotFound(digest)
+
+    def exists(self, digest, name=None):
+        return (digest, name) in self.blobs
+
+    def delete(self, digest):
+        for key in [k for k in self.blobs if k[0] == digest]:
+            del self.blobs[key]
+
+
+def default_blob_dir(database_uri):
+    """<dir>/memes.sqlite -> <dir>/memes.blobs
+    Params:
+        database_uri [str]
+    Return:
+        blob_dir [Path]
+    """
+    database = make_url(database_uri).database
+    if not database or database == ':memory:':
+        raise ValueError(
+            f'can not derive BLOB_DIR from database uri "{database_uri}", please set BLOB_DIR.'
+        )
+    fp = Path(database)
+    return fp.with_name(fp.stem + '.blobs')
+
+
+class BlobStorage(object):
+    """Flask extension giving access to the blob backend of current app.
+
+    The backend is resolved lazily from app config, because the cli sets
+    SQLALCHEMY_DATABASE_URI after `create_app()`:
+    - BLOB_BACKEND: 'filesystem'(default) or 'memory'.
+    - BLOB_DIR: root dir of filesystem backend, default to a directory next to
+      the sqlite file, eg: memes.sqlite -> memes.blobs/
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('BLOB_BACKEND', 'filesystem')
+        app.config.setdefault('BLOB_DIR', None)
+        app.extensions['blob_storage'] = {}
+
+    def get_backend(self, app=None):
+        app = app or current_app
+        config = app.config
+        name = config['BLOB_BACKEND']
+        if name == 'memory':
+            key = (name,)
+        elif name == 'filesystem':
+            blob_dir = config['BLOB_DIR'] or default_blob_dir(config['SQLALCHEMY_DATABASE_URI'])
+            key = (name, str(Path(blob_dir).resolve()))
+        else:
+            raise ValueError(f'BLOB_BACKEND "{name}" is not supported')
+
+        backends = app.extensions['blob_storage']
+        if key not in backends:
+            if name == 'memory':
+                backends[key] = MemoryBackend()
+            else:
+                backends[key] = FileSystemBackend(key[1])
+        return backends[key]
+
+    def put(self, data):
+        return self.get_backend().put(data)
+
+    def put_stream(self, fileobj):
+        return self.get_backend().put_stream(fileobj)
+
+    def writer(self):
+        return self.get_backend().writer()
+
+    def put_derivative(self, digest, name, data):
+        return self.get_backend().put_derivative(digest, name, data)
+
+    def open(self, digest, name=None):
+        return self.get_backend().open(digest, name)
+
+    def read(self, digest, name=None):
+        return self.get_backend().read(digest, name)
+
+    def path(self, digest, name=None):
+        return self.get_backend().path(digest, name)
+
+    def exists(self, digest, name=None):
+        return self.get_backend().exists(digest, name)
+
+    def delete(self, digest):
+        return self.get_backend().delete(digest)
+
+    def send(self, digest, mimetype, last_modified=None, name=None):
+        """Build a streaming response of a blob.
+        A file backed blob is handed to the WSGI server through
+        `wsgi.file_wrapper` instead of being read into memory. Support
+        `Range` requests (206 Partial Content).
+        Params:
+            digest [str]
+            mimetype [str]
+            last_modified [datetime]
+            name [str]: send a derivative of the blob.
+        Return:
+            response [Response]
+        """
+        def open_():
+            backend = self.get_backend()
+            path = backend.path(digest, name)
+            if path is None:
+                return backend.open(digest, name)
+            elif path.is_file():
+                return path
+            else:
+                raise BlobNotFound(digest)
+
+        etag = digest if name is None else f'{digest}.{name}'
+        return send_immutable(etag, open_, mimetype, last_modified)
+
+
+def send_immutable(etag, open_, mimetype, last_modified=None):
+    """Blobs never change, so their digest is a strong ETag and clients may
+    cache the response forever. A matched `If-None-Match` gets a 304 without
+    opening the blob.
+    Params:
+        etag [str]
+        open_ [Callable[[], Path | BinaryIO]]: called only if the body is needed.
+        mimetype [str]
+        last_modified [datetime]
+    Return:
+        response [Response]
+    """
+    if request.if_none_match.contains(etag):
+        rv = current_app.response_class(status=304)
+    else:
+        rv = send_file(
+            open_(),
+            mimetype=mimetype,
+            conditional=True,
+            etag=etag,
+            last_modified=last_modified,
+        )
+
+    rv.set_etag(etag)
+    rv.cache_control.public = True
+    rv.cache_control.max_age = IMMUTABLE_MAX_AGE
+    rv.cache_control.immutable = True
+    return rv
+
+
+blobs = BlobStorage()
@@ -0,0 +1,116 @@
+"""Tag autocomplete served from memory.
+
+Every distinct tag in use is kept in a sorted array with its number of images
+(tag.image_count):
+the tags starting with a prefix are a contiguous slice found by bisection, the
+most used ones are picked from it. The array is built on first use and rebuilt
+once the 'images' version counter moved, which every change of image tags
+bumps, whichever process made it.
+"""
+import heapq
+import threading
+from bisect import bisect_left
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, text
+
+from .models import db, get_versions
+
+# prefix -> suggestions, memoized until the next rebuild.
+MEMO_SIZE = 4096
+# scan the tags in ranked order instead of the prefix slice if the slice
+# holds more than 1/RANKED_SCAN_RATIO of all tags.
+RANKED_SCAN_RATIO = 16
+
+# counts are maintained in tag.image_count: a rebuild reads the tag table only.
+TAG_COUNTS = 'SELECT name, image_count FROM tag WHERE image_count > 0 ORDER BY name'
+
+
+class TagIndex(object):
+    """Flask extension holding the sorted array of tags of an app.
+    Config:
+    - TAG_SUGGEST_LIMIT: default number of suggestions, default 10.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('TAG_SUGGEST_LIMIT', 10)
+        app.extensions['tag_index'] = {
+            # (names, counts, ranked, memo), replaced as a whole by refresh().
+            'index': ([], [], [], {}),
+            'version': None,
+            'lock': threading.Lock(),
+        }
+
+    @property
+    def state(self):
+        return current_app.extensions['tag_index']
+
+    def refresh(self):
+        """Rebuild the array if tags changed since it was built."""
+        state = self.state
+        version = get_versions('images')[0]
+        if version == state['version']:
+            return
+        with state['lock']:
+            if version == state['version']:
+                return
+            rows = db.session.execute(text(TAG_COUNTS)).all()
+            counts = [count for _, count in rows]
+            # positions, most used first.
+            ranked = sorted(range(len(rows)), key=lambda i: -counts[i])
+            state['index'] = ([name for name, _ in rows], counts, ranked, {})
+            state['version'] = version
+
+    def suggest(self, prefix='', limit=None):
+        """
+        Params:
+            prefix [str]: case sensitive, '' for the most used tags.
+            limit [int]: default to TAG_SUGGEST_LIMIT.
+        Return:
+            suggestions [list[tuple[str, int]]]: (name, image count), most
+            used first, then by name.
+        """
+        if limit is None:
+            limit = current_app.config['TAG_SUGGEST_LIMIT']
+        self.refresh()
+        names, counts, ranked, memo = self.state['index']
+        key = (prefix, limit)
+        suggestions = memo.get(key)
+        if suggestions is not None:
+            return suggestions
+
+        lo = bisect_left(names, prefix)
+        hi = len(names)
+        if prefix and ord(prefix[-1]) < 0x10ffff:
+            # same bounds as Tag.prefix_filter().
+            hi = bisect_left(names, prefix[:-1] + chr(ord(prefix[-1]) + 1), lo)
+        if (hi - lo) * RANKED_SCAN_RATIO >= len(names):
+            # short prefix: most used tags are met early in the ranked order.
+            picked = []
+            for i in ranked:
+                if lo <= i < hi:
+                    picked.append(i)
+                    if len(picked) == limit:
+                        break
+        else:
+            picked = heapq.nlargest(limit, range(lo, hi), key=lambda i: (counts[i], -i))
+        suggestions = [(names[i], counts[i]) for i in picked]
+        if len(memo) >= MEMO_SIZE:
+            memo.clear()
+        memo[key] = suggestions
+        return suggestions
+
+
+tag_index = TagIndex()
+
+
+@event.listens_for(db.metadata, 'after_create')
+@event.listens_for(db.metadata, 'after_drop')
+def reset_tag_index(target, connection, **kw):
+    # version counters start over in a new database.
+    if has_app_context() and 'tag_index' in current_app.extensions:
+        current_app.extensions['tag_index']['version'] = None
@@ -0,0 +1,189 @@
+"""Thumbnails of images, stored as derivatives of the original blob.
+
+Sizes listed in THUMBNAIL_SIZES are generated when an image is added and kept
+in blob storage. Other sizes (up to THUMBNAIL_MAX_SIZE) are generated on demand
+and kept in a bounded in-process LRU cache.
+
+Generating thumbnails needs Pillow (`pip install meme-manager[thumbnails]`).
+Without it, or for data Pillow can not decode, the original image is served.
+"""
+from io import BytesIO
+
+from flask import current_app, request
+
+from .storage import blobs, send_immutable
+from .lru import LRUCache
+
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    PILImage = None
+
+JPEG_QUALITY = 85
+FORMATS = ('jpeg', 'png')
+# bytes accounted for every cache entry besides the thumbnail data.
+CACHE_ENTRY_OVERHEAD = 256
+
+
+def derivative_name(size, fmt):
+    """
+    Params:
+        size [int]
+        fmt [str]: 'jpeg' | 'png'
+    Return:
+        name [str]: eg: 'thumb200.jpeg'
+    """
+    return f'thumb{size}.{fmt}'
+
+
+def make_thumbnail(fileobj, size):
+    """Shrink an image to fit in a size x size box, keep aspect ratio.
+    Animated images keep only their first frame. Images with transparency are
+    encoded as PNG, others as JPEG.
+    Params:
+        fileobj [BinaryIO]
+        size [int]
+    Return:
+        data [bytes], fmt [str]; or None if Pillow is missing or can not
+        decode the image.
+    """
+    if PILImage is None:
+        return None
+
+    try:
+        with PILImage.open(fileobj) as im:
+            im.seek(0)
+            im.draft('RGB', (size, size))
+            transparent = im.mode in ('RGBA', 'LA', 'PA') or 'transparency' in im.info
+            im = im.convert('RGBA' if transparent else 'RGB')
+            im.thumbnail((size, size))
+            buf = BytesIO()
+            if transparent:
+                im.save(buf, 'PNG', optimize=True)
+                return buf.getvalue(), 'png'
+            else:
+                im.save(buf, 'JPEG', quality=JPEG_QUALITY, optimize=True)
+                return buf.getvalue(), 'jpeg'
+    except (OSError, ValueError, SyntaxError, PILImage.DecompressionBombError):
+        return None
+
+
+def store_thumbnails(backend, digest, sizes, data=None):
+    """Generate thumbnails of a blob and store them as its derivatives.
+    Need no app context, so it can run in worker threads.
+    Params:
+        backend [BlobBackend]
+        digest [str]
+        sizes [Iterable[int]]
+        data [bytes]: blob data, read from backend if not given.
+    Return:
+        count [int]: thumbnails generated.
+    """
+    if PILImage is None:
+        return 0
+
+    count = 0
+    for size in sizes:
+        if data is None:
+            with backend.open(digest) as fh:
+                rv = make_thumbnail(fh, size)
+        else:
+            rv = make_thumbnail(BytesIO(data), size)
+        if rv is None:
+            break
+        thumb, fmt = rv
+        backend.put_derivative(digest, derivative_name(size, fmt), thumb)
+        count += 1
+    return count
+
+
+class Thumbnails(object):
+    """Flask extension generating and serving thumbnails.
+    Config:
+    - THUMBNAIL_SIZES: sizes generated when an image is added, default (200,).
+    - THUMBNAIL_MAX_SIZE: largest size served, default 1024.
+    - THUMBNAIL_CACHE_BYTES: bound of the cache of other sizes, default 64MB.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('THUMBNAIL_SIZES', (200,))
+        app.config.setdefault('THUMBNAIL_MAX_SIZE', 1024)
+        app.config.setdefault('THUMBNAIL_CACHE_BYTES', 64 * 2**20)
+        app.extensions['thumbnails'] = LRUCache(app.config['THUMBNAIL_CACHE_BYTES'])
+
+    @property
+    def cache(self):
+        return current_app.extensions['thumbnails']
+
+    def generate(self, digest, data=None, sizes=None):
+        """Generate and store thumbnails of an image.
+        Params:
+            digest [str]
+            data [bytes]: image data, read from blob storage if not given.
+            sizes [Iterable[int]]: default to THUMBNAIL_SIZES.
+        Return:
+            count [int]: thumbnails generated.
+        """
+        if sizes is None:
+            sizes = current_app.config['THUMBNAIL_SIZES']
+        return store_thumbnails(blobs.get_backend(), digest, sizes, data)
+
+    def find(self, digest, size):
+        """
+        Return:
+            name [str], fmt [str]; or None if not stored.
+        """
+        for fmt in FORMATS:
+            name = derivative_name(size, fmt)
+            if blobs.exists(digest, name):
+                return name, fmt
+        return None
+
+    def send(self, digest, size, mimetype, last_modified=None):
+        """Build a response of an image thumbnail, generate it on cache miss.
+        Fall back to the original image if no thumbnail can be generated.
+        Params:
+            digest [str]
+            size [int]
+            mimetype [str]: mimetype of the original image.
+            last_modified [datetime]
+        Return:
+            response [Response]
+        """
+        for fmt in FORMATS:
+            etag = f'{digest}.{derivative_name(size, fmt)}'
+            if request.if_none_match.contains(etag):
+                return send_immutable(etag, None, f'image/{fmt}', last_modified)
+
+        key = (digest, size)
+        rv = self.cache.get(key)
+        if rv is None and size in current_app.config['THUMBNAIL_SIZES']:
+            found = self.find(digest, size)
+            if found is None and self.generate(digest, sizes=(size,)):
+                found = self.find(digest, size)
+            if found is not None:
+                name, fmt = found
+                return blobs.send(digest, f'image/{fmt}', last_modified, name=name)
+            rv = (None, None)
+            self.cache.set(key, rv, CACHE_ENTRY_OVERHEAD)
+        elif rv is None:
+            with blobs.open(digest) as fh:
+                rv = make_thumbnail(fh, size) or (None, None)
+            self.cache.set(key, rv, CACHE_ENTRY_OVERHEAD + len(rv[0] or b''))
+
+        thumb, fmt = rv
+        if thumb is None:
+            return blobs.send(digest, mimetype, last_modified)
+        return send_immutable(
+            f'{digest}.{derivative_name(size, fmt)}',
+            lambda: BytesIO(thumb),
+            f'image/{fmt}',
+            last_modified,
+        )
+
+
+thumbnails = Thumbnails()
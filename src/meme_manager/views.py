@@ -1,7 +1,24 @@
-from flask import Blueprint, json, jsonify, request, Response
+from datetime import datetime
+from io import BytesIO
+
+from flask import Blueprint, current_app, json, jsonify, request
+from sqlalchemy import String, literal, select, tuple_
+from sqlalchemy.exc import IntegrityError
+from werkzeug.formparser import parse_form_data
 
 from . import db
-from .models import Image, Group
+from .models import Image, Group, Tag, get_versions
+from .storage import blobs, BlobNotFound
+from .search import search
+from .thumbnails import thumbnails
+from .dedup import POLICIES, merge_image
+from .similar import dhash, similar
+from . import batch
+from .importer import insert_images
+from .cache import response_cache
+from .metrics import metrics
+from .suggest import tag_index
+from .filters import FilterError, compile_filter
 
 DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
 
@@ -17,15 +34,207 @@ def disable_CORS(response):
     return response
 
 
+def versions_etag(*names):
+    """Weak ETag of a list response, changes whenever the listed tables change.
+    Params:
+        names [str]: version counter names.
+    Return:
+        etag [str]
+    """
+    return '-'.join(f'{n}{v}' for n, v in zip(names, get_versions(*names)))
+
+
+def not_modified(etag):
+    """
+    Return:
+        response [Response] or None: a 304 response if the client's cached
+        copy is still fresh.
+    """
+    if request.if_none_match.contains_weak(etag):
+        response = current_app.response_class(status=304)
+        response.set_etag(etag, weak=True)
+        return response
+    return None
+
+
+def parse_ids(value):
+    """
+    Params:
+        value: "ids" of a batch request body.
+    Return:
+        ids [list[int]]
+    Raise:
+        ValueError: value is not a list of integers.
+    """
+    if not isinstance(value, list) or not all(type(i) is int for i in value):
+        raise ValueError(value)
+    return value
+
+
+def serialize_images(rows):
+    """
+    Params:
+        rows [Iterable[Row]]: rows of Image.list_query().
+    Return:
+        data [list[dict]]: keys: id, img_type, tags, group, create_at.
+    """
+    rows = list(rows)
+    tags = Image.tags_of(row.id for row in rows)
+    return [
+        {
+            'id': row.id,
+            'img_type': row.img_type,
+            'tags': tags.get(row.id, []),
+            'group': row.group,
+            'create_at': row.create_at,
+        }
+        for row in rows
+    ]
+
+
+def encode_cursor(row):
+    """
+    Params:
+        row [Row]: of Image.list_query().
+    Return:
+        cursor [str]: '<create_at>,<id>', create_at as stored: rows added by
+        the ORM have fractions of a second, a cursor rounded to the second
+        would skip or repeat rows.
+    """
+    return f'{row.sort_key},{row.id}'
+
+
+def keyset_paginate(query, after, per_page):
+    """Page through query ordered by (create_at, id), starting right after
+    the cursor. Served by the (create_at, id) index, no OFFSET and no COUNT.
+    Params:
+        query [Query]: ordered by (Image.create_at, Image.id).
+        after [str]: cursor returned by the previous page, '' for first page.
+        per_page [int]
+    Return:
+        items [list], next_cursor [str] or None
+    Raise:
+        ValueError: bad cursor.
+    """
+    if after:
+        create_at, _, image_id = after.rpartition(',')
+        seconds, dot, fraction = create_at.partition('.')
+        datetime.strptime(seconds, DATETIME_FORMAT)
+        if dot and not fraction.isdigit():
+            raise ValueError(after)
+        # compare with the text sqlite stores, not a bound datetime.
+        query = query.filter(
+            tuple_(Image.create_at, Image.id) > tuple_(literal(create_at, String), int(image_id))
+        )
+
+    items = query.limit(per_page + 1).all()
+    if len(items) > per_page:
+        items = items[:per_page]
+        return items, encode_cursor(items[-1])
+    else:
+        return items, None
+
+
 # images
+def list_images():
+    """List path of show_images(), see the API doc below."""
+    etag = versions_etag('images')
+    cached = not_modified(etag)
+    if cached:
+        return cached
+
+    # apply search
+    group = request.args.get('group')
+    tag = request.args.get('tag')
+    tag_prefix = request.args.get('tag_prefix')
+    query = Image.list_query(DATETIME_FORMAT)
+    if group:
+        # by group_id, so the (group_id, create_at, id) index serves the filter and the order.
+        query = query.filter(Image.group_id == select(Group.id).where(Group.name == group).scalar_subquery())
+
+    if tag:
+        query = query.filter(Image.tag_filter(tag=tag))
+    if tag_prefix:
+        query = query.filter(Image.tag_filter(prefix=tag_prefix))
+
+    filter_ = request.args.get('filter')
+    if filter_:
+        try:
+            query = query.filter(compile_filter(filter_))
+        except FilterError as e:
+            return jsonify({
+                'error': f'筛选条件 filter={filter_} 有误：{e}'
+            }), 400
+
+    q = request.args.get('q')
+    matched = search(q) if q else None
+    if matched is not None:
+        query = query.join(matched, matched.c.image_id == Image.id)\
+                     .order_by(matched.c.rank)
+    # apply pagination
+    DEFAULT_PER_PAGE = 20
+    per_page = int(request.args.get('per_page', default=DEFAULT_PER_PAGE))
+    query = query.order_by(Image.create_at, Image.id)
+
+    after = request.args.get('after')
+    if after is not None:
+        if matched is not None:
+            return jsonify({
+                'error': '游标分页（after）不可与全文搜索（q）同时使用。'
+            }), 400
+
+        try:
+            items, next_cursor = keyset_paginate(query, after, per_page)
+        except ValueError:
+            return jsonify({
+                'error': f'游标 after={after} 格式错误。'
+            }), 400
+
+        pagination = {
+            'per_page': per_page,
+            'next_cursor': next_cursor,
+        }
+        if request.args.get('with_total') == '1':
+            pagination['total'] = query.order_by(None).count()
+    else:
+        page = int(request.args.get('page', default=1))
+        paginate = query.paginate(page=page, per_page=per_page)
+        items = paginate.items
+        pagination = {
+            'pages': paginate.pages,
+            'page': paginate.page,
+            'per_page': paginate.per_page,
+            'total': paginate.total,
+        }
+
+    response = {
+        'data': serialize_images(items),
+        'pagination': pagination,
+    }
+    response = jsonify(response)
+    response.set_etag(etag, weak=True)
+    response.cache_control.no_cache = True
+    return response
+
+
 """/images/
 GET
 分页后端实现，使用url参数?page=[int]&per_page=[int]
 - page: 可选，默认为 1。
 - per_page：可选，默认为 20。
-搜索：后端实现，使用 url 参数，可搜索项：tag。
-- tag: [str]
+搜索：后端实现，使用 url 参数，可搜索项：tag, tag_prefix, group。
+- tag: [str] 精确匹配标签。
+- tag_prefix: [str] 匹配以其开头的标签。
+- q: [str] 全文搜索标签、组名、文件名，可匹配词的片段，多个词以空格分隔（须全部匹配），
+  结果按相关度（bm25）排序。
 - group: [str]
+- filter: [str] 组合筛选，一条 SQL 完成，可与以上参数及两种分页同时使用，例：
+  tag:cat AND (group:funny OR ungrouped) AND NOT tag:dog* created>=2020-06 type:gif
+  - 条件：tag:<标签>，tag:<前缀>*，group:<组名>，ungrouped（无分组），type:<图片类型>，
+    created:<时间段>，created>=<时间段>（另有 >, <, <=），时间段为 YYYY、YYYY-MM、YYYY-MM-DD
+    或 "YYYY-MM-DD HH:MM:SS"。
+  - 以 AND、OR、NOT（或 -）及括号组合，相邻条件默认为 AND；含空格、括号的值用双引号括起。
+  - 格式错误时返回 400。
 resp: 200, body:
 {
     "data": [
@@ -46,7 +255,27 @@ resp: 200, body:
     }
 }
 
-GET id=[int]
+游标分页（keyset）：使用url参数?after=[cursor]&per_page=[int]，深翻页与首页开销相同。
+- after: 上一页返回的 next_cursor，首页传空字符串。不可与 q 同时使用。
+- with_total: 可选，为 1 时返回总条数，默认不计算。
+resp: 200, body:
+{
+    "data": [...], # 同上
+    "pagination": {
+        'per_page': [Number],
+        'next_cursor': [String] or [null], # null 表示已是最后一页
+        'total': [Number] # 仅当 with_total=1
+    }
+}
+
+支持条件请求：响应带弱 ETag，请求头 If-None-Match 匹配时返回 304。
+列表响应缓存在进程内（见 cache.py），相同参数的请求不访问数据库，数据变更时失效。
+
+GET id=[int]&size=[int]
+- size: 可选，返回缩略图（长边不超过 size 像素），无法生成缩略图时返回原图。
+支持 Range 请求（206 Partial Content）。
+图片内容不可变：响应带强 ETag（内容 sha256）及 Cache-Control: immutable，
+请求头 If-None-Match 匹配时返回 304。
 resp: 200, body:
 content-type: image/<img_type>
 图片二进制数据
@@ -55,40 +284,105 @@ content-type: image/<img_type>
 def show_images():
     image_id = request.args.get('id')
     if image_id:
-        image = Image.query.get(image_id)
-        response = Response(image.data, mimetype=f'image/{image.img_type}')
-        return response
+        image = db.session.query(Image.digest, Image.img_type, Image.create_at)\
+                          .filter(Image.id == int(image_id))\
+                          .first()
+        err = f'图片（id={image_id}）不存在，可能是其已被删除，请刷新页面。'
+        if image is None:
+            return jsonify({
+                'error': err
+            }), 404
+
+        size = request.args.get('size')
+        try:
+            if size:
+                size = int(size)
+                if not 0 < size <= current_app.config['THUMBNAIL_MAX_SIZE']:
+                    raise ValueError(size)
+        except ValueError:
+            return jsonify({
+                'error': f'缩略图尺寸 size={size} 不合法。'
+            }), 400
+
+        try:
+            if size:
+                return thumbnails.send(
+                    image.digest,
+                    size,
+                    f'image/{image.img_type}',
+                    last_modified=image.create_at,
+                )
+            return blobs.send(
+                image.digest,
+                f'image/{image.img_type}',
+                last_modified=image.create_at,
+            )
+        except BlobNotFound:
+            return jsonify({
+                'error': err
+            }), 404
     else:
-        # apply search
-        group = request.args.get('group')
-        tag = request.args.get('tag')
-        if group:
-            query = Image.query.join(Image.group).filter(Group.name == group)
-        else:
-            query = Image.query
+        return response_cache.serve(('images',), list_images)
 
-        if tag:
-            query = query.filter(Image.tags.contains(tag))
-        # apply pagination
-        DEFAULT_PER_PAGE = 20
-        page = int(request.args.get('page', default=1))
-        per_page = int(request.args.get('per_page', default=DEFAULT_PER_PAGE))
-        paginate = query.order_by(Image.create_at)\
-                        .paginate(page=page, per_page=per_page)
-
-        columns = ('id', 'img_type', 'tags', 'group', 'create_at')
-
-        response = {
-            'data': [record.readyToJSON(columns, DATETIME_FORMAT) for record in paginate.items],
-            'pagination': {
-                'pages': paginate.pages,
-                'page': paginate.page,
-                'per_page': paginate.per_page,
-                'total': paginate.total,
-            }
-        }
-        return jsonify(response)
-        
+
+"""/images/similar
+GET 使用url参数：?id=[int]&distance=[int]
+- distance: 可选，感知哈希的最大汉明距离（0~64），默认为配置项 SIMILAR_DISTANCE。
+返回与图片 id 相似（重新编码、缩放、压缩等）的其他图片，按距离升序。
+无法计算感知哈希的图片（如无法解码）返回空列表。
+resp: 200, body:
+{
+    "data": [
+        {
+            "id": [Number],
+            "img_type": [String],
+            "tags": [Array[String]],
+            "group": [String],
+            "create_at": [String],
+            "distance": [Number],
+        },
+        ...
+    ]
+}
+"""
+@bp_main.route('/api/images/similar', methods=['GET'])
+@response_cache.cached('images')
+def similar_images():
+    image_id = int(request.args['id'])
+    image = Image.query.get(image_id)
+    if image is None:
+        return jsonify({
+            'error': f'图片（id={image_id}）不存在，可能是其已被删除，请刷新页面。'
+        }), 404
+
+    distance = request.args.get('distance')
+    try:
+        if distance is not None:
+            distance = int(distance)
+            if not 0 <= distance <= 64:
+                raise ValueError(distance)
+    except ValueError:
+        return jsonify({
+            'error': f'距离 distance={distance} 不合法。'
+        }), 400
+
+    if not image.phash:
+        return jsonify({
+            'data': []
+        })
+
+    results = [(d, i) for d, i in similar.search(image.phash, distance) if i != image_id]
+    rows = Image.list_query(DATETIME_FORMAT).filter(Image.id.in_([i for _, i in results]))
+    records = {item['id']: item for item in serialize_images(rows)}
+    data = []
+    for d, i in results:
+        if i in records:
+            item = records[i]
+            item['distance'] = d
+            data.append(item)
+    return jsonify({
+        'data': data
+    })
 
 
 """/images/add
@@ -99,8 +393,13 @@ Content-Type: multipart/form-data
     "img_type": [String],
     "tags": [Array[String]]，
     "group" [Optional]: [String] | Null,
+    "dedup" [Optional]: "reject" | "merge" | "link"，默认为配置项 DEDUP_POLICY,
 }
-resp: 200, body: {"msg": [String]}
+resp: 200, body: {"msg": [String], "id": [Integer]}
+图片（内容相同）已存在时，按 dedup：
+- reject: 409, body: {"error": [String], "id": [Integer]}
+- merge: 将标签（以及分组，若已有图片无分组）合并到已有图片，200
+- link: 不修改已有图片，200
 """
 @bp_main.route('/api/images/add', methods=['POST'])
 def add_image():
@@ -108,11 +407,14 @@ def add_image():
     image_data = image_file.read()
     image_file.close()
     metadata = json.loads(request.form['metadata'])
-    record = Image(
-        data=image_data,
-        img_type=metadata['img_type'],
-        tags=metadata['tags'],
-    )
+    dedup = metadata.get('dedup') or current_app.config['DEDUP_POLICY']
+    if dedup not in POLICIES:
+        err = f'dedup 参数错误（dedup={dedup}）。'
+        return jsonify({
+            'error': err
+        }), 400
+
+    group = None
     group_name = metadata.get('group')
     if group_name is not None:
         group = Group.query.filter_by(name=group_name).first()
@@ -122,12 +424,152 @@ def add_image():
                 'error': err
             }), 400
 
-        record.group = group
+    digest = blobs.put(image_data)
+    existing = Image.query.filter_by(digest=digest).first()
+    if existing is None:
+        record = Image(
+            digest=digest,
+            size=len(image_data),
+            phash=dhash(BytesIO(image_data)),
+            img_type=metadata['img_type'],
+            filename=image_file.filename,
+            tags=metadata['tags'],
+            group=group,
+        )
+        db.session.add(record)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # a concurrent upload of the same content was committed first.
+            db.session.rollback()
+            existing = Image.query.filter_by(digest=digest).first()
+            if existing is None:
+                raise
+        else:
+            thumbnails.generate(record.digest, image_data)
+            return jsonify({
+                'msg': f'成功添加图片：{record}',
+                'id': record.id,
+            })
 
-    db.session.add(record)
-    db.session.commit()
+    if dedup == 'reject':
+        err = f'图片已存在（id={existing.id}）。'
+        return jsonify({
+            'error': err,
+            'id': existing.id,
+        }), 409
+    if dedup == 'merge':
+        merge_image(existing, metadata['tags'], group and group.id)
+        db.session.commit()
     return jsonify({
-        'msg': f'成功添加图片：{record}'
+        'msg': f'图片已存在：{existing}',
+        'id': existing.id,
+    })
+
+
+"""/images/add_batch
+POST 使用表单提交，一次上传多张图片。每个文件边接收边写入存储，不在内存中缓存整个请求体。
+所有图片在同一个事务中插入。
+Content-Type: multipart/form-data
+"metadata" [Optional]: [JSON-String] {
+    "tags" [Optional]: [Array[String]], # 所有图片共同的标签，另外每张图片以文件名（不含后缀）为标签
+    "group" [Optional]: [String] | Null,
+    "dedup" [Optional]: "reject" | "merge" | "link"，默认为配置项 DEDUP_POLICY,
+}, 与文件的先后顺序不限
+"images": [bytes-file], 可重复多个，图片类型取自文件名后缀
+resp: 200, body:
+{
+    "msg": [String],
+    "data": [
+        {
+            "filename": [String],
+            "id": [Number], # 新图片或（重复时）已有图片的 id
+            "status": "added" | "reject" | "merge" | "link",
+        },
+        ...
+    ]
+}
+"""
+@bp_main.route('/api/images/add_batch', methods=['POST'])
+def add_images():
+    writers = []
+
+    def stream_factory(total_content_length, content_type, filename, content_length=None):
+        writer = blobs.writer()
+        writers.append(writer)
+        return writer
+
+    try:
+        _, form, files = parse_form_data(
+            request.environ,
+            stream_factory=stream_factory,
+            max_content_length=current_app.config.get('MAX_CONTENT_LENGTH'),
+        )
+        metadata = json.loads(form.get('metadata') or '{}')
+        dedup = metadata.get('dedup') or current_app.config['DEDUP_POLICY']
+        if dedup not in POLICIES:
+            err = f'dedup 参数错误（dedup={dedup}）。'
+            return jsonify({
+                'error': err
+            }), 400
+
+        group_id = None
+        group_name = metadata.get('group')
+        if group_name is not None:
+            group = Group.query.filter_by(name=group_name).first()
+            if group is None:
+                err = f'组（name={group_name}）不存在。'
+                return jsonify({
+                    'error': err
+                }), 400
+            group_id = group.id
+
+        images = [f for f in files.getlist('images') if f.filename]
+        if not images:
+            return jsonify({
+                'error': '未上传图片。'
+            }), 400
+
+        rows = []
+        for image_file in images:
+            digest, size = image_file.stream.commit()
+            stem, _, suffix = image_file.filename.rpartition('.')
+            with blobs.open(digest) as fh:
+                phash = dhash(fh)
+            rows.append({
+                'digest': digest,
+                'size': size,
+                'phash': phash,
+                'img_type': suffix.lower() if stem else image_file.mimetype.rpartition('/')[2],
+                'filename': image_file.filename,
+                'group_id': group_id,
+                'tags': [stem or suffix, *metadata.get('tags', [])],
+            })
+    finally:
+        for writer in writers:
+            writer.discard()
+
+    try:
+        results = insert_images(db.session, rows, dedup)
+        db.session.commit()
+    except IntegrityError:
+        # a concurrent upload added some of the contents first: insert_images()
+        # now finds them and applies the dedup policy.
+        db.session.rollback()
+        results = insert_images(db.session, rows, dedup)
+        db.session.commit()
+    for row, (_, status) in zip(rows, results):
+        if status == 'added':
+            thumbnails.generate(row['digest'])
+
+    data = [
+        {'filename': row['filename'], 'id': image_id, 'status': status}
+        for row, (image_id, status) in zip(rows, results)
+    ]
+    count = sum(1 for item in data if item['status'] == 'added')
+    return jsonify({
+        'msg': f'成功添加 {count} 张图片，{len(data) - count} 张已存在',
+        'data': data,
     })
 
 
@@ -192,6 +634,69 @@ def update_image():
         })
 
 
+"""/images/batch/update
+将多张图片移至同一组，单个事务。
+POST {
+    "ids": [Array[Number]],
+    "group": [String] | Null # Null 表示移出分组
+}
+resp: 200, body: {"msg": [String], "count": [Number]} # count: 实际移动的图片数（忽略不存在的 id）
+"""
+@bp_main.route('/api/images/batch/update', methods=['POST'])
+def batch_update_images():
+    data = request.get_json()
+    try:
+        image_ids = parse_ids(data.get('ids'))
+    except ValueError:
+        return jsonify({
+            'error': 'ids 必须为整数数组。'
+        }), 400
+
+    group_name = data['group']
+    group_id = None
+    if group_name is not None:
+        group = Group.query.filter_by(name=group_name).first()
+        if group is None:
+            err = f'组（name={group_name}）不存在。'
+            return jsonify({
+                'error': err
+            }), 404
+        group_id = group.id
+
+    count = batch.move_images(db.session, image_ids, group_id)
+    db.session.commit()
+    target = '全部' if group_name is None else f'name={group_name}'
+    return jsonify({
+        'msg': f'成功将 {count} 张图片移至组（{target}）',
+        'count': count,
+    })
+
+
+"""/images/batch/delete
+删除多张图片，单个事务。
+POST {
+    "ids": [Array[Number]]
+}
+resp: 200, body: {"msg": [String], "count": [Number]} # count: 实际删除的图片数（忽略不存在的 id）
+"""
+@bp_main.route('/api/images/batch/delete', methods=['POST'])
+def batch_delete_images():
+    data = request.get_json()
+    try:
+        image_ids = parse_ids(data.get('ids'))
+    except ValueError:
+        return jsonify({
+            'error': 'ids 必须为整数数组。'
+        }), 400
+
+    count = batch.delete_images(db.session, image_ids)
+    db.session.commit()
+    return jsonify({
+        'msg': f'成功删除 {count} 张图片',
+        'count': count,
+    })
+
+
 # tags
 """/tags/
 GET ?image_id=[int]
@@ -201,6 +706,7 @@ resp: 200, body:
 }
 """
 @bp_main.route('/api/tags/', methods=['GET'])
+@response_cache.cached('images')
 def show_tags():
     image_id = int(request.args.get('image_id'))
     image = Image.query.get(image_id)
@@ -216,6 +722,85 @@ def show_tags():
     return jsonify(response)
 
 
+"""/tags/all
+GET ?sort=[String]&order=[String]&limit=[Number]
+所有使用中的标签及其图片数（标签云）。
+sort: "count"（默认）| "name"
+order: "desc" | "asc"，sort=count 时默认 desc，sort=name 时默认 asc
+limit [Optional]: 只返回前 limit 个，默认返回全部
+resp: 200, body:
+{
+    "data": [
+        {
+            "name": [String],
+            "count": [Number], # 使用该标签的图片数
+        },
+        ...
+    ]
+}
+"""
+@bp_main.route('/api/tags/all', methods=['GET'])
+@response_cache.cached('images')
+def show_all_tags():
+    sort = request.args.get('sort', default='count')
+    if sort not in ('count', 'name'):
+        return jsonify({
+            'error': f'sort 参数错误（sort={sort}）。'
+        }), 400
+    order = request.args.get('order', default='desc' if sort == 'count' else 'asc')
+    if order not in ('desc', 'asc'):
+        return jsonify({
+            'error': f'order 参数错误（order={order}）。'
+        }), 400
+    limit = request.args.get('limit', type=int)
+    if 'limit' in request.args and (limit is None or limit < 1):
+        return jsonify({
+            'error': f'limit 参数错误（limit={request.args["limit"]}），须为正整数。'
+        }), 400
+
+    # counts are maintained in tag.image_count, the image table is not read.
+    column = Tag.image_count if sort == 'count' else Tag.name
+    ordering = [column.desc() if order == 'desc' else column.asc()]
+    if sort == 'count':
+        ordering.append(Tag.name)
+    query = db.session.query(Tag.name, Tag.image_count)\
+                      .filter(Tag.image_count > 0)\
+                      .order_by(*ordering)\
+                      .limit(limit)
+    return jsonify({
+        'data': [{'name': name, 'count': count} for name, count in query],
+    })
+
+
+"""/tags/suggest
+GET ?prefix=[String]&limit=[Number]
+标签自动补全：以 prefix 开头（区分大小写）的标签，按使用次数从多到少排序。
+prefix 为空时返回最常用的标签。limit 默认为配置项 TAG_SUGGEST_LIMIT，最大 100。
+resp: 200, body:
+{
+    "data": [
+        {
+            "name": [String],
+            "count": [Number], # 使用该标签的图片数
+        },
+        ...
+    ]
+}
+"""
+@bp_main.route('/api/tags/suggest', methods=['GET'])
+def suggest_tags():
+    prefix = request.args.get('prefix', default='')
+    limit = request.args.get('limit', default=current_app.config['TAG_SUGGEST_LIMIT'], type=int)
+    if limit is None or not 0 < limit <= 100:
+        return jsonify({
+            'error': f'limit 参数错误（limit={request.args.get("limit")}），须为 1 到 100 的整数。'
+        }), 400
+
+    return jsonify({
+        'data': [{'name': name, 'count': count} for name, count in tag_index.suggest(prefix, limit)],
+    })
+
+
 """/tags/add
 POST {
     "image_id": [Number],
@@ -256,21 +841,147 @@ def delete_tag():
     })
 
 
+"""/tags/batch/add
+为多张图片添加相同标签，单个事务。
+POST {
+    "image_ids": [Array[Number]],
+    "tags": [Array[String]]
+}
+resp: 200, body: {"msg": [String], "count": [Number]} # count: 实际修改的图片数（忽略不存在的 id）
+"""
+@bp_main.route('/api/tags/batch/add', methods=['POST'])
+def batch_add_tags():
+    data = request.get_json()
+    try:
+        image_ids = parse_ids(data.get('image_ids'))
+    except ValueError:
+        return jsonify({
+            'error': 'image_ids 必须为整数数组。'
+        }), 400
+
+    count = batch.add_image_tags(db.session, image_ids, data['tags'])
+    db.session.commit()
+    return jsonify({
+        'msg': f'成功为 {count} 张图片添加标签：{data["tags"]}',
+        'count': count,
+    })
+
+
+"""/tags/batch/delete
+删除多张图片的相同标签，单个事务。
+POST {
+    "image_ids": [Array[Number]],
+    "tags": [Array[String]]
+}
+resp: 200, body: {"msg": [String], "count": [Number]} # count: 实际修改的图片数（忽略不存在的 id）
+"""
+@bp_main.route('/api/tags/batch/delete', methods=['POST'])
+def batch_delete_tags():
+    data = request.get_json()
+    try:
+        image_ids = parse_ids(data.get('image_ids'))
+    except ValueError:
+        return jsonify({
+            'error': 'image_ids 必须为整数数组。'
+        }), 400
+
+    count = batch.remove_image_tags(db.session, image_ids, data['tags'])
+    db.session.commit()
+    return jsonify({
+        'msg': f'成功删除 {count} 张图片的标签：{data["tags"]}',
+        'count': count,
+    })
+
+
+"""/tags/rename
+重命名标签，所有使用该标签的图片随之更新，单个事务。新名称已存在时请使用 /tags/merge。
+POST {
+    "name": [String],
+    "new_name": [String]
+}
+resp: 200, body: {"msg": [String], "count": [Number]} # count: 受影响的图片数
+"""
+@bp_main.route('/api/tags/rename', methods=['POST'])
+def rename_tag():
+    data = request.get_json()
+    name = data.get('name')
+    new_name = data.get('new_name')
+    if not isinstance(name, str) or not isinstance(new_name, str) or not new_name:
+        return jsonify({
+            'error': 'name 与 new_name 必须为非空字符串。'
+        }), 400
+
+    try:
+        count = batch.rename_tag(db.session, name, new_name)
+    except ValueError:
+        return jsonify({
+            'error': f'标签（name={new_name}）已存在，请使用合并标签。'
+        }), 409
+    if count is None:
+        return jsonify({
+            'error': f'标签（name={name}）不存在，可能是其已被删除，请刷新页面。'
+        }), 404
+
+    db.session.commit()
+    return jsonify({
+        'msg': f'成功将 {count} 张图片的标签 {name} 重命名为 {new_name}',
+        'count': count,
+    })
+
+
+"""/tags/merge
+合并标签：所有带有 tags 中任一标签的图片改为带有 target 标签，并删除 tags 中的标签，单个事务。
+target 不存在时会被创建，tags 中不存在的标签会被忽略。
+POST {
+    "tags": [Array[String]],
+    "target": [String]
+}
+resp: 200, body: {"msg": [String], "count": [Number]} # count: 受影响的图片数
+"""
+@bp_main.route('/api/tags/merge', methods=['POST'])
+def merge_tags():
+    data = request.get_json()
+    tags = data.get('tags')
+    target = data.get('target')
+    if not isinstance(tags, list) or not all(isinstance(t, str) for t in tags) \
+            or not isinstance(target, str) or not target:
+        return jsonify({
+            'error': 'tags 必须为字符串数组，target 必须为非空字符串。'
+        }), 400
+
+    count = batch.merge_tags(db.session, tags, target)
+    db.session.commit()
+    return jsonify({
+        'msg': f'成功将 {count} 张图片的标签 {tags} 合并为 {target}',
+        'count': count,
+    })
+
+
 # group
 """/groups/
 GET
+支持条件请求：响应带弱 ETag，请求头 If-None-Match 匹配时返回 304。
 resp: 200, body:
 {
     "data": [Array[String]]
 }
 """
 @bp_main.route('/api/groups/', methods=['GET'])
+@response_cache.cached('groups')
 def show_groups():
+    etag = versions_etag('groups')
+    cached = not_modified(etag)
+    if cached:
+        return cached
+
     groups = Group.query.order_by(Group.name).all()
     resp = {
         'data': [r.name for r in groups],
     }
-    return jsonify(resp)
+    response = jsonify(resp)
+    response.set_etag(etag, weak=True)
+    response.cache_control.no_cache = True
+    return response
 
 
 """/groups/add
@@ -332,3 +1043,48 @@ def update_group():
     return jsonify({
         'msg': f'成功更新组：{record}'
     })
+
+
+"""/metrics
+GET
+resp: 200, body: Prometheus 文本格式的指标：各接口的耗时分布、SQL 语句数与耗时、响应字节数。
+"""
+@bp_main.route('/api/metrics', methods=['GET'])
+def show_metrics():
+    if 'metrics' not in current_app.extensions:
+        return jsonify({
+            'error': '未开启指标统计（METRICS）。'
+        }), 404
+    return current_app.response_class(
+        metrics.render(),
+        mimetype='text/plain; version=0.0.4',
+    )
+
+
+"""/metrics/slow
+GET
+resp: 200, body: {
+    "data": [
+        {
+            "time": [String],
+            "method": [String],
+            "url": [String],
+            "status": [Number],
+            "duration": [Number],
+            "query_count": [Number],
+            "query_time": [Number],
+            "queries": [{"statement": [String], "duration": [Number]}, ...],
+        },
+        ...
+    ]
+}
+"""
+@bp_main.route('/api/metrics/slow', methods=['GET'])
+def show_slow_requests():
+    if 'metrics' not in current_app.extensions:
+        return jsonify({
+            'error': '未开启指标统计（METRICS）。'
+        }), 404
+    return jsonify({
+        'data': metrics.slow_requests(),
+    })
@@ -0,0 +1,32 @@
+import unittest
+import tempfile
+from pathlib import Path
+
+from benchmarks.bench import Library, compare, run
+
+
+class TestBench(unittest.TestCase):
+    def test_run(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            library = Library(50, groups=3, tags=10, blobs=5)
+            results = run(library, requests=2, import_files=3, workdir=Path(tmp), echo=lambda msg: None)
+        self.assertEqual(results['meta']['library']['images'], 50)
+        for name in ('list_first_page', 'list_group', 'search', 'add_image', 'cli_import', 'cli_export'):
+            result = results['results'][name]
+            self.assertGreater(result['throughput'], 0)
+            self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+
+    def test_compare(self):
+        meta = {'library': {'images': 50}}
+        baseline = {'meta': meta, 'results': {
+            'a': {'p50_ms': 10, 'p99_ms': 20, 'throughput': 100},
+            'b': {'p50_ms': 10, 'p99_ms': 20, 'throughput': 100},
+        }}
+        results = {'meta': meta, 'results': {
+            'a': {'p50_ms': 11, 'p99_ms': 22, 'throughput': 91},
+            'b': {'p50_ms': 15, 'p99_ms': 30, 'throughput': 66},
+            'c': {'p50_ms': 1, 'p99_ms': 2, 'throughput': 1000},
+        }}
+        lines, regressions = compare(results, baseline, 0.25)
+        self.assertEqual(regressions, ['b'])
+        self.assertEqual(len(lines), 3)
@@ -1,9 +1,25 @@
 import unittest
+import sqlite3
+import hashlib
+from unittest import mock
 from pathlib import Path
 
 from click.testing import CliRunner
 
-from meme_manager import cli
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    PILImage = None
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+from meme_manager import cli, create_app, db
+from meme_manager.sqlite import report_pragmas
+from meme_manager.explain import full_scans
+from meme_manager.migrations import MIGRATIONS
+from meme_manager.storage import FileSystemBackend
 from meme_manager import __version__
 
 
@@ -75,6 +91,64 @@ class TestImport(unittest.TestCase):
             result = runner.invoke(cli, ['import', 'testdir', 'testdb.sqlite'])
             self.assertEqual(result.exit_code, 0)
     
+    def test_import_batches(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            runner.invoke(cli, ['initdb', 'testdb.sqlite'])
+            Path('testdir').mkdir()
+            Path('testdir/group1').mkdir()
+            for i in range(5):
+                Path(f'testdir/group1/img{i}.jpg').write_bytes(f'image{i}'.encode())
+            Path('testdir/img.gif').write_bytes(b'image')
+            result = runner.invoke(cli, [
+                'import', '--jobs', '2', '--batch-size', '2', 'testdir', 'testdb.sqlite',
+            ])
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn('Total add 1 group, 6 images.', result.output)
+
+            conn = sqlite3.connect('testdb.sqlite')
+            rows = conn.execute(
+                'SELECT image.filename, image.img_type, image.size, "group".name, tag.name '
+                'FROM image LEFT JOIN "group" ON "group".id = image.group_id '
+                'JOIN image_tag ON image_tag.image_id = image.id JOIN tag ON tag.id = image_tag.tag_id '
+                'ORDER BY image.filename'
+            ).fetchall()
+            indexed = conn.execute(
+                "SELECT count(*) FROM image_fts WHERE image_fts MATCH 'group1'"
+            ).fetchone()[0]
+            conn.close()
+            expected = [(f'img{i}.jpg', 'jpg', 6, 'group1', f'img{i}') for i in range(5)]
+            expected.insert(0, ('img.gif', 'gif', 5, None, 'img'))
+            self.assertEqual(rows, expected)
+            self.assertEqual(indexed, 5)
+
+    def test_import_duplicates(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            runner.invoke(cli, ['initdb', 'testdb.sqlite'])
+            Path('testdir').mkdir()
+            Path('testdir/a.jpg').write_bytes(b'image')
+            Path('testdir/b.jpg').write_bytes(b'image')
+            Path('testdir/c.jpg').write_bytes(b'other image')
+            result = runner.invoke(cli, ['import', '-g', 'testGroup', 'testdir', 'testdb.sqlite'])
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn('Total add 2 images.', result.output)
+            self.assertIn('Duplicate: 1', result.output)
+
+            Path('d.jpg').write_bytes(b'other image')
+            result = runner.invoke(cli, ['import', '--dedup', 'link', 'd.jpg', 'testdb.sqlite'])
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn('already exists', result.output)
+
+            conn = sqlite3.connect('testdb.sqlite')
+            rows = conn.execute(
+                'SELECT image.size, tag.name FROM image '
+                'JOIN image_tag ON image_tag.image_id = image.id JOIN tag ON tag.id = image_tag.tag_id '
+                'ORDER BY image.size, tag.name'
+            ).fetchall()
+            conn.close()
+            self.assertEqual(rows, [(5, 'a'), (5, 'b'), (11, 'c')])
+
     def test_import_src_not_exists(self):
         runner = CliRunner()
         with runner.isolated_filesystem():
@@ -92,6 +166,84 @@ class TestImport(unittest.TestCase):
             self.assertIn('Error', result.output)
 
 
+class TestDedup(unittest.TestCase):
+    def test_collapse_duplicates(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            runner.invoke(cli, ['initdb', 'testdb.sqlite'])
+            conn = sqlite3.connect('testdb.sqlite')
+            conn.executescript("""
+                DROP INDEX ix_image_digest;
+                INSERT INTO "group" (name) VALUES ('testGroup');
+                INSERT INTO tag (name) VALUES ('aTag'), ('bTag'), ('cTag');
+                INSERT INTO image (digest, size, img_type, group_id) VALUES
+                    ('d1', 1, 'jpeg', NULL), ('d1', 1, 'jpeg', 1), ('d2', 1, 'jpeg', NULL), ('d1', 1, 'jpeg', NULL);
+                INSERT INTO image_tag (tag_id, image_id) VALUES (1, 1), (2, 2), (1, 2), (3, 3), (3, 4);
+            """)
+            conn.commit()
+            conn.close()
+
+            result = runner.invoke(cli, ['dedup', 'testdb.sqlite'])
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn('Total remove 2 duplicate images.', result.output)
+
+            conn = sqlite3.connect('testdb.sqlite')
+            images = conn.execute('SELECT id, group_id FROM image ORDER BY id').fetchall()
+            tags = conn.execute('SELECT image_id, tag_id FROM image_tag ORDER BY image_id, tag_id').fetchall()
+            conn.close()
+            self.assertEqual(images, [(1, 1), (3, None)])
+            self.assertEqual(tags, [(1, 1), (1, 2), (1, 3), (3, 3)])
+
+    def test_no_duplicate(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            runner.invoke(cli, ['initdb', 'testdb.sqlite'])
+            result = runner.invoke(cli, ['dedup', 'testdb.sqlite'])
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn('no duplicate', result.output)
+
+
+@unittest.skipIf(PILImage is None, 'Pillow is not installed')
+class TestFindDupes(unittest.TestCase):
+    def test_find_dupes(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            runner.invoke(cli, ['initdb', 'testdb.sqlite'])
+            Path('testdir').mkdir()
+            im = PILImage.effect_mandelbrot((256, 256), (-2, -1.5, 1, 1.5), 100).convert('RGB')
+            im.save('testdir/a.png')
+            im.resize((120, 120)).save('testdir/b.jpg', quality=40)
+            im.rotate(90).save('testdir/c.png')
+            Path('testdir/d.jpg').write_bytes(b'not an image')
+            runner.invoke(cli, ['import', '-g', 'testGroup', 'testdir', 'testdb.sqlite'])
+
+            conn = sqlite3.connect('testdb.sqlite')
+            ids = dict(conn.execute('SELECT filename, id FROM image').fetchall())
+            conn.close()
+            result = runner.invoke(cli, ['find-dupes', 'testdb.sqlite'])
+            self.assertEqual(result.exit_code, 0)
+            pair = sorted([ids['a.png'], ids['b.jpg']])
+            self.assertIn(f'Similar images: id={pair[0]}, id={pair[1]}', result.output)
+            self.assertIn('Total 1 sets of similar images.', result.output)
+
+    def test_unhashed(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            runner.invoke(cli, ['initdb', 'testdb.sqlite'])
+            Path('testdir').mkdir()
+            Path('testdir/a.jpg').write_bytes(b'image a')
+            Path('testdir/b.jpg').write_bytes(b'image b')
+            runner.invoke(cli, ['import', 'testdir', 'testdb.sqlite'])
+            # imported without Pillow
+            conn = sqlite3.connect('testdb.sqlite')
+            conn.execute('UPDATE image SET phash = NULL')
+            conn.commit()
+            conn.close()
+            result = runner.invoke(cli, ['find-dupes', 'testdb.sqlite'])
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn('2 images have no perceptual hash', result.output)
+
+
 class TestExport(unittest.TestCase):
     def test_export_all(self):
         runner = CliRunner()
@@ -126,6 +278,41 @@ class TestExport(unittest.TestCase):
     #         result = runner.invoke(cli, ['export', '--group', 'testGroup', 'testdb.sqlite', 'testdir'])
     #         self.assertEqual(result.exit_code, 0)
 
+    def test_export_imported_images(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            runner.invoke(cli, ['initdb', 'testdb.sqlite'])
+            Path('src/group1').mkdir(parents=True)
+            Path('src/group1/img1.jpg').write_bytes(b'image1')
+            Path('src/img1.jpg').write_bytes(b'image2')
+            Path('src/img2.jpg').write_bytes(b'image3')
+            runner.invoke(cli, ['import', 'src', 'testdb.sqlite'])
+            Path('dest').mkdir()
+            Path('dest/img2.jpg').write_bytes(b'not exported')
+            result = runner.invoke(cli, ['export', '--jobs', '2', 'testdb.sqlite', 'dest'])
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn('Success: 3', result.output)
+            self.assertEqual(Path('dest/group1/img1.jpg').read_bytes(), b'image1')
+            self.assertEqual(Path('dest/img1.jpg').read_bytes(), b'image2')
+            # 已存在的文件不被覆盖
+            self.assertEqual(Path('dest/img2.jpg').read_bytes(), b'not exported')
+            exported = sorted(p.read_bytes() for p in Path('dest').glob('*.jpg'))
+            self.assertEqual(exported, [b'image2', b'image3', b'not exported'])
+
+    def test_export_imported_group(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            runner.invoke(cli, ['initdb', 'testdb.sqlite'])
+            Path('src').mkdir()
+            Path('src/img1.jpg').write_bytes(b'image1')
+            runner.invoke(cli, ['import', '--group', 'testGroup', 'src', 'testdb.sqlite'])
+            Path('dest').mkdir()
+            result = runner.invoke(cli, [
+                'export', '--group', 'testGroup', '--name-pattern=id', 'testdb.sqlite', 'dest',
+            ])
+            self.assertEqual(result.exit_code, 0)
+            self.assertEqual(Path('dest/testGroup/1.jpg').read_bytes(), b'image1')
+
     def test_export_name_pattern_not_support(self):
         runner = CliRunner()
         with runner.isolated_filesystem():
@@ -143,6 +330,24 @@ class TestExport(unittest.TestCase):
             result = runner.invoke(cli, ['export', '--name-pattern=tag', 'testdb.sqlite', 'testdir'])
             self.assertEqual(result.exit_code, 0)
 
+    def test_export_first_tag_as_filename(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            runner.invoke(cli, ['initdb', 'testdb.sqlite'])
+            Path('src').mkdir()
+            Path('src/zebra.jpg').write_bytes(b'image1')
+            runner.invoke(cli, ['import', 'src', 'testdb.sqlite'])
+            conn = sqlite3.connect('testdb.sqlite')
+            # sorts before the stem
+            tag_id = conn.execute("INSERT INTO tag (name) VALUES ('animal')").lastrowid
+            conn.execute('INSERT INTO image_tag (tag_id, image_id) VALUES (?, 1)', (tag_id,))
+            conn.commit()
+            conn.close()
+            Path('dest').mkdir()
+            result = runner.invoke(cli, ['export', '--name-pattern=tag', 'testdb.sqlite', 'dest'])
+            self.assertEqual(result.exit_code, 0)
+            self.assertEqual(Path('dest/zebra.jpg').read_bytes(), b'image1')
+
     def test_export_use_id_as_filename(self):
         runner = CliRunner()
         with runner.isolated_filesystem():
@@ -150,3 +355,326 @@ class TestExport(unittest.TestCase):
             Path('testdir').mkdir()
             result = runner.invoke(cli, ['export', '--name-pattern=id', 'testdb.sqlite', 'testdir'])
             self.assertEqual(result.exit_code, 0)
+
+
+def create_legacy_db(db_file, n):
+    """Create a database with the schema of v0.3.0, image data stored inline."""
+    conn = sqlite3.connect(db_file)
+    conn.executescript("""
+        CREATE TABLE "group" (
+            id INTEGER NOT NULL, name VARCHAR(64), create_at DATETIME DEFAULT (CURRENT_TIMESTAMP) NOT NULL,
+            PRIMARY KEY (id), UNIQUE (name)
+        );
+        CREATE TABLE image (
+            id INTEGER NOT NULL, data BLOB NOT NULL, img_type VARCHAR(64) NOT NULL, tags TEXT NOT NULL,
+            group_id INTEGER, create_at DATETIME DEFAULT (CURRENT_TIMESTAMP) NOT NULL,
+            PRIMARY KEY (id), FOREIGN KEY(group_id) REFERENCES "group" (id)
+        );
+    """)
+    for i in range(n):
+        conn.execute(
+            'INSERT INTO image (data, img_type, tags) VALUES (?, ?, ?)',
+            (f'image{i}'.encode(), 'jpeg', f'tag{i},common' if i else ''),
+        )
+    conn.commit()
+    conn.close()
+
+
+class TestUpgrade(unittest.TestCase):
+    def test_move_blobs(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            create_legacy_db('testdb.sqlite', 5)
+            result = runner.invoke(cli, ['upgrade', '--batch-size', '2', 'testdb.sqlite'])
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn('done', result.output)
+
+            conn = sqlite3.connect('testdb.sqlite')
+            columns = [r[1] for r in conn.execute('PRAGMA table_info(image)')]
+            self.assertNotIn('data', columns)
+            rows = conn.execute('SELECT id, digest, size FROM image ORDER BY id').fetchall()
+            conn.close()
+            self.assertEqual(len(rows), 5)
+            for image_id, digest, size in rows:
+                data = f'image{image_id - 1}'.encode()
+                self.assertEqual(digest, hashlib.sha256(data).hexdigest())
+                self.assertEqual(size, len(data))
+                blob = Path('testdb.blobs', digest[:2], digest[2:4], digest)
+                self.assertEqual(blob.read_bytes(), data)
+
+    def test_move_tags(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            create_legacy_db('testdb.sqlite', 5)
+            result = runner.invoke(cli, ['upgrade', '--batch-size', '2', 'testdb.sqlite'])
+            self.assertEqual(result.exit_code, 0)
+
+            conn = sqlite3.connect('testdb.sqlite')
+            columns = [r[1] for r in conn.execute('PRAGMA table_info(image)')]
+            self.assertNotIn('tags', columns)
+            rows = conn.execute(
+                'SELECT image_id, name FROM image_tag JOIN tag ON tag.id = tag_id ORDER BY image_id, name'
+            ).fetchall()
+            conn.close()
+            expected = []
+            for i in range(1, 5):
+                expected += [(i + 1, 'common'), (i + 1, f'tag{i}')]
+            self.assertEqual(rows, expected)
+
+    def test_build_search_index(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            create_legacy_db('testdb.sqlite', 5)
+            result = runner.invoke(cli, ['upgrade', '--batch-size', '2', 'testdb.sqlite'])
+            self.assertEqual(result.exit_code, 0)
+
+            conn = sqlite3.connect('testdb.sqlite')
+            rows = conn.execute(
+                "SELECT rowid FROM image_fts WHERE image_fts MATCH 'common' ORDER BY rowid"
+            ).fetchall()
+            conn.close()
+            self.assertEqual(rows, [(2,), (3,), (4,), (5,)])
+
+    def test_without_drop_column(self):
+        # sqlite < 3.35
+        runner = CliRunner()
+        with runner.isolated_filesystem(), mock.patch('meme_manager.migrations.DROP_COLUMN', False):
+            create_legacy_db('testdb.sqlite', 5)
+            conn = sqlite3.connect('testdb.sqlite')
+            conn.execute('CREATE INDEX ix_legacy_img_type ON image (img_type)')
+            conn.commit()
+            conn.close()
+            result = runner.invoke(cli, ['migrate', '--batch-size', '2', 'testdb.sqlite'])
+            self.assertEqual(result.exit_code, 0, result.output)
+
+            conn = sqlite3.connect('testdb.sqlite')
+            columns = [r[1] for r in conn.execute('PRAGMA table_info(image)')]
+            indexes = [r[1] for r in conn.execute('PRAGMA index_list(image)')]
+            foreign_keys = [r[2] for r in conn.execute('PRAGMA foreign_key_list(image)')]
+            count = conn.execute('SELECT count(*) FROM image_tag').fetchone()[0]
+            conn.close()
+            self.assertNotIn('data', columns)
+            self.assertNotIn('tags', columns)
+            self.assertIn('ix_legacy_img_type', indexes)
+            self.assertIn('ix_image_digest', indexes)
+            self.assertEqual(foreign_keys, ['group'])
+            self.assertEqual(count, 8)
+
+            Path('new.jpeg').write_bytes(b'new image')
+            result = runner.invoke(cli, ['import', 'new.jpeg', 'testdb.sqlite'])
+            self.assertEqual(result.exit_code, 0, result.output)
+
+    def test_already_up_to_date(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            runner.invoke(cli, ['initdb', 'testdb.sqlite'])
+            result = runner.invoke(cli, ['upgrade', 'testdb.sqlite'])
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn('up to date', result.output)
+
+
+class TestMigrate(unittest.TestCase):
+    def test_keyset_batches(self):
+        # statement -> last_id of its batches
+        batches = {}
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('SELECT id') and 'FROM image WHERE id > ?' in statement:
+                batches.setdefault(statement, []).append(parameters[0])
+
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            create_legacy_db('testdb.sqlite', 5)
+            event.listen(Engine, 'before_cursor_execute', record)
+            try:
+                result = runner.invoke(cli, ['migrate', '--batch-size', '2', 'testdb.sqlite'])
+            finally:
+                event.remove(Engine, 'before_cursor_execute', record)
+            self.assertEqual(result.exit_code, 0, result.output)
+        # blobs, tags, search index and perceptual hashes.
+        self.assertEqual(len(batches), 4 if PILImage else 3)
+        for last_ids in batches.values():
+            # each batch starts after the previous one.
+            self.assertEqual(last_ids, sorted(set(last_ids)))
+            self.assertEqual(last_ids[0], 0)
+            self.assertGreaterEqual(len(last_ids), 3)
+
+    def test_record_versions(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            create_legacy_db('testdb.sqlite', 5)
+            result = runner.invoke(cli, ['migrate', '--batch-size', '2', 'testdb.sqlite'])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn('Move image blobs: 2/5', result.output)
+            self.assertIn(f'to version {MIGRATIONS[-1][0]} done', result.output)
+
+            conn = sqlite3.connect('testdb.sqlite')
+            versions = [r[0] for r in conn.execute('SELECT version FROM schema_migration ORDER BY version')]
+            conn.close()
+            self.assertEqual(versions, [version for version, _, _ in MIGRATIONS])
+
+            result = runner.invoke(cli, ['migrate', 'testdb.sqlite'])
+            self.assertIn('up to date', result.output)
+
+    def test_initdb_stamped(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            runner.invoke(cli, ['initdb', 'testdb.sqlite'])
+            result = runner.invoke(cli, ['migrate', '--status', 'testdb.sqlite'])
+            self.assertEqual(result.exit_code, 0)
+            self.assertNotIn('[ ]', result.output)
+            self.assertEqual(result.output.count('[x]'), len(MIGRATIONS))
+
+    def test_resume(self):
+        put_stream = FileSystemBackend.put_stream
+        calls = []
+
+        def interrupted_put_stream(backend, fileobj):
+            calls.append(1)
+            if len(calls) == 3:
+                raise OSError('disk full')
+            return put_stream(backend, fileobj)
+
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            create_legacy_db('testdb.sqlite', 5)
+            with mock.patch.object(FileSystemBackend, 'put_stream', interrupted_put_stream):
+                result = runner.invoke(cli, ['migrate', '--batch-size', '2', 'testdb.sqlite'])
+            self.assertNotEqual(result.exit_code, 0)
+
+            conn = sqlite3.connect('testdb.sqlite')
+            versions = [r[0] for r in conn.execute('SELECT version FROM schema_migration ORDER BY version')]
+            moved = conn.execute('SELECT count(*) FROM image WHERE digest IS NOT NULL').fetchone()[0]
+            conn.close()
+            self.assertEqual(versions, [1, 2])
+            # the first batch is committed.
+            self.assertEqual(moved, 2)
+
+            result = runner.invoke(cli, ['migrate', '--batch-size', '2', 'testdb.sqlite'])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn('Move image blobs: 2/3', result.output)
+            conn = sqlite3.connect('testdb.sqlite')
+            digests = [r[0] for r in conn.execute('SELECT digest FROM image ORDER BY id')]
+            conn.close()
+            self.assertEqual(digests, [hashlib.sha256(f'image{i}'.encode()).hexdigest() for i in range(5)])
+
+
+    def test_count_tag_images(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            runner.invoke(cli, ['initdb', 'testdb.sqlite'])
+            Path('testdir').mkdir()
+            for i in range(3):
+                Path(f'testdir/img{i}.jpg').write_bytes(f'image{i}'.encode())
+            runner.invoke(cli, ['import', '--group', 'g', 'testdir', 'testdb.sqlite'])
+            # the schema before tag.image_count.
+            conn = sqlite3.connect('testdb.sqlite')
+            conn.executescript("""
+                DROP TRIGGER image_tag_count_insert;
+                DROP TRIGGER image_tag_count_delete;
+                DROP TRIGGER image_tag_count_update;
+                DROP INDEX ix_tag_image_count;
+                ALTER TABLE tag DROP COLUMN image_count;
+                DELETE FROM schema_migration WHERE version = 9;
+            """)
+            conn.close()
+
+            result = runner.invoke(cli, ['migrate', '--batch-size', '2', 'testdb.sqlite'])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn('Count tag images: 2/3', result.output)
+            conn = sqlite3.connect('testdb.sqlite')
+            counts = conn.execute('SELECT name, image_count FROM tag ORDER BY name').fetchall()
+            conn.execute("INSERT INTO image_tag (tag_id, image_id) SELECT id, 1 FROM tag WHERE name = 'img1'")
+            count = conn.execute("SELECT image_count FROM tag WHERE name = 'img1'").fetchone()[0]
+            conn.close()
+            self.assertEqual(counts, [('img0', 1), ('img1', 1), ('img2', 1)])
+            self.assertEqual(count, 2)
+
+
+class TestTagCommands(unittest.TestCase):
+    def setUp(self):
+        self.runner = CliRunner()
+
+    def import_images(self):
+        self.runner.invoke(cli, ['initdb', 'testdb.sqlite'])
+        Path('testdir').mkdir()
+        for i, name in enumerate(['catt', 'kitty', 'kitten']):
+            Path(f'testdir/{name}.jpg').write_bytes(f'image{i}'.encode())
+        self.runner.invoke(cli, ['import', 'testdir', 'testdb.sqlite'])
+
+    def tag_counts(self):
+        conn = sqlite3.connect('testdb.sqlite')
+        rows = conn.execute('SELECT name, image_count FROM tag ORDER BY name').fetchall()
+        conn.close()
+        return rows
+
+    def test_rename_tag(self):
+        with self.runner.isolated_filesystem():
+            self.import_images()
+            result = self.runner.invoke(cli, ['rename-tag', 'catt', 'cat', 'testdb.sqlite'])
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn('on 1 images done', result.output)
+            self.assertEqual(self.tag_counts(), [('cat', 1), ('kitten', 1), ('kitty', 1)])
+
+            result = self.runner.invoke(cli, ['rename-tag', 'kitty', 'cat', 'testdb.sqlite'])
+            self.assertIn('already exists', result.output)
+
+    def test_merge_tags(self):
+        with self.runner.isolated_filesystem():
+            self.import_images()
+            result = self.runner.invoke(cli, ['merge-tags', '--into', 'cat', 'catt', 'kitty', 'kitten', 'testdb.sqlite'])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn('on 3 images done', result.output)
+            self.assertEqual(self.tag_counts(), [('cat', 3)])
+
+
+class TestSQLiteProfile(unittest.TestCase):
+    def test_wal(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            runner.invoke(cli, ['initdb', 'testdb.sqlite'])
+            conn = sqlite3.connect('testdb.sqlite')
+            journal_mode = conn.execute('PRAGMA journal_mode').fetchone()[0]
+            conn.close()
+            self.assertEqual(journal_mode, 'wal')
+
+    def test_report_pragmas(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            runner.invoke(cli, ['initdb', 'testdb.sqlite'])
+            app = create_app('production')
+            app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{Path("testdb.sqlite").resolve()}'
+            lines = []
+            with app.app_context():
+                mismatched = report_pragmas(db.engine, app.config['SQLITE_PRAGMAS'], lines.append)
+                self.assertIsInstance(db.engine.pool, QueuePool)
+            self.assertEqual(mismatched, [])
+            self.assertIn('journal_mode=wal', lines[0])
+            self.assertIn('synchronous=1', lines[0])
+
+
+class TestExplain(unittest.TestCase):
+    def test_no_full_scan(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            runner.invoke(cli, ['initdb', 'testdb.sqlite'])
+            Path('testdir').mkdir()
+            Path('testdir/group1').mkdir()
+            Path('testdir/group1/img1.jpg').write_bytes(b'image1')
+            Path('testdir/group1/img2.jpg').write_bytes(b'image2')
+            Path('testdir/img3.jpg').write_bytes(b'image3')
+            runner.invoke(cli, ['import', 'testdir', 'testdb.sqlite'])
+            result = runner.invoke(cli, ['explain', '--verbose', 'testdb.sqlite'])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn('GET /api/images/?group=group1', result.output)
+            self.assertIn(' 0 full scans.', result.output)
+
+    def test_full_scans(self):
+        plan = [
+            'SCAN image',
+            'SCAN TABLE tag',
+            'SCAN image USING INDEX ix_image_create_at_id',
+            'SCAN image_fts VIRTUAL TABLE INDEX 0:',
+            'SCAN anon_1',
+        ]
+        self.assertEqual(full_scans(plan, {'image', 'tag'}), ['image', 'tag'])
@@ -0,0 +1,57 @@
+import unittest
+import json
+from datetime import datetime
+
+from flask import jsonify
+
+from meme_manager import db
+from meme_manager.fastjson import OrjsonProvider, orjson
+
+from tests import test_app
+
+
+@unittest.skipIf(orjson is None, 'orjson is not installed')
+class TestOrjsonProvider(unittest.TestCase):
+
+    def setUp(self):
+        with test_app.app_context():
+            db.create_all()
+
+    def tearDown(self):
+        with test_app.app_context():
+            db.drop_all()
+
+    def test_installed(self):
+        self.assertIsInstance(test_app.json, OrjsonProvider)
+
+    def test_jsonify(self):
+        with test_app.app_context():
+            resp = jsonify({
+                'name': '表情包',
+                'create_at': datetime(2020, 1, 2, 3, 4, 5),
+                'ids': [1, 2],
+                1: None,
+            })
+        self.assertEqual(resp.mimetype, 'application/json')
+        # not escaped, orjson writes UTF-8.
+        self.assertIn('表情包'.encode(), resp.get_data())
+        self.assertEqual(json.loads(resp.get_data()), {
+            'name': '表情包',
+            # HTTP date, as Flask's provider
+            'create_at': 'Thu, 02 Jan 2020 03:04:05 GMT',
+            'ids': [1, 2],
+            '1': None,
+        })
+
+    def test_dumps_fallback(self):
+        with test_app.app_context():
+            compact = test_app.json.dumps({'a': [1]})
+            indented = test_app.json.dumps({'a': [1]}, indent=2)
+        self.assertEqual(compact, '{"a":[1]}')
+        # stdlib only argument
+        self.assertEqual(indented, json.dumps({'a': [1]}, indent=2))
+
+    def test_malformed_body(self):
+        client = test_app.test_client()
+        resp = client.post('/api/images/update', data='{"id": 1,', content_type='application/json')
+        self.assertEqual(resp.status_code, 400)
@@ -12,12 +12,12 @@ def fake_records(n):
             name=f'testGroup{i}',
         )
         img1 = Image(
-            data=b'abcdefggggggg',
+            data=f'group{i} image1'.encode(),
             img_type='jpeg',
             tags=['aTag', 'bTag']
         )
         img2 = Image(
-            data=b'abcdefggggggg',
+            data=f'group{i} image2'.encode(),
             img_type='jpeg',
             tags=['aTag', 'bTag']
         )
@@ -45,6 +45,18 @@ class TestGroupsShow(unittest.TestCase):
         json_data = resp.get_json()
         self.assertIn('data', json_data)
 
+    def test_cache(self):
+        client = test_app.test_client()
+        etag = client.get(self.url).headers.get('ETag')
+        resp = client.get(self.url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+
+        # 修改后缓存失效
+        client.post('/api/groups/add', json={'name': 'addedGroup'})
+        resp = client.get(self.url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('addedGroup', resp.get_json()['data'])
+
 
 class TestGroupAdd(unittest.TestCase):
     url = '/api/groups/add'
@@ -1,8 +1,17 @@
 import unittest
 import json
+import hashlib
+from datetime import datetime
 from io import BytesIO
 
-from meme_manager import db, Image, Group
+from sqlalchemy import event, text
+
+from meme_manager import db, blobs, Image, Group
+
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    PILImage = None
 
 from tests import test_app
 
@@ -13,12 +22,12 @@ def fake_groups(n):
             name=f'testGroup{i}',
         )
         img1 = Image(
-            data=b'abcdefggggggg',
+            data=f'group{i} image1'.encode(),
             img_type='jpeg',
             tags=['aTag', 'bTag']
         )
         img2 = Image(
-            data=b'abcdefggggggg',
+            data=f'group{i} image2'.encode(),
             img_type='jpeg',
             tags=['aTag', 'bTag']
         )
@@ -30,7 +39,7 @@ def fake_groups(n):
 def fake_images(n):
     for i in range(n):
         img = Image(
-            data=b'abcdefggggggg',
+            data=b'abcdefggggggg' + b'g' * i,
             img_type='jpeg',
             tags=['aTag', 'bTag']
         )
@@ -66,6 +75,59 @@ class TestImageShow(unittest.TestCase):
         self.assertEqual(resp.status_code, 200)
         self.assertEqual(resp.mimetype, 'image/jpeg')
         self.assertEqual(resp.headers.get('Content-Type'), 'image/jpeg')
+        self.assertEqual(resp.content_length, len(b'abcdefggggggg'))
+        self.assertEqual(resp.data, b'abcdefggggggg')
+
+    def test_show_one_images_range(self):
+        client = test_app.test_client()
+        resp = client.get(
+            self.url,
+            query_string={'id': 1},
+            headers={'Range': 'bytes=2-5'},
+        )
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp.headers.get('Content-Range'), 'bytes 2-5/13')
+        self.assertEqual(resp.data, b'cdef')
+
+    def test_show_one_images_cache(self):
+        client = test_app.test_client()
+        resp = client.get(self.url, query_string={'id': 1})
+        etag = resp.headers.get('ETag')
+        self.assertEqual(etag, '"%s"' % hashlib.sha256(b'abcdefggggggg').hexdigest())
+        self.assertIn('immutable', resp.headers.get('Cache-Control'))
+
+        resp = client.get(
+            self.url,
+            query_string={'id': 1},
+            headers={'If-None-Match': etag},
+        )
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, b'')
+
+    def test_list_cache(self):
+        client = test_app.test_client()
+        resp = client.get(self.url)
+        etag = resp.headers.get('ETag')
+        self.assertTrue(etag.startswith('W/'))
+
+        resp = client.get(self.url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+
+        # 修改后缓存失效
+        client.get('/api/images/delete', query_string={'id': 1})
+        resp = client.get(self.url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers.get('ETag'), etag)
+
+    def test_show_not_exists_image(self):
+        client = test_app.test_client()
+        resp = client.get(
+            self.url,
+            query_string={'id': 10000}
+        )
+        self.assertEqual(resp.status_code, 404)
+        json_data = resp.get_json()
+        self.assertIn('error', json_data)
     
     def test_pagination(self):
         client = test_app.test_client()
@@ -80,6 +142,238 @@ class TestImageShow(unittest.TestCase):
         self.assertEqual(len(json_data['data']), 10)
 
 
+def fake_picture(width, height, mode='RGB', fmt='JPEG'):
+    buf = BytesIO()
+    PILImage.new(mode, (width, height)).save(buf, fmt)
+    return buf.getvalue()
+
+
+@unittest.skipIf(PILImage is None, 'Pillow is not installed')
+class TestImageThumbnail(unittest.TestCase):
+    url = '/api/images/'
+
+    def setUp(self):
+        with test_app.app_context():
+            db.create_all()
+            fake_images(1)
+
+    def tearDown(self):
+        with test_app.app_context():
+            db.drop_all()
+
+    def add_picture(self, data):
+        client = test_app.test_client()
+        resp = client.post('/api/images/add', data={
+            'image': (BytesIO(data), 'picture.jpeg'),
+            'metadata': json.dumps({'img_type': 'jpeg', 'tags': []}),
+        })
+        self.assertEqual(resp.status_code, 200)
+        with test_app.app_context():
+            return Image.query.order_by(Image.id.desc()).first().id
+
+    def test_precomputed_size(self):
+        image_id = self.add_picture(fake_picture(800, 400))
+        with test_app.app_context():
+            digest = Image.query.get(image_id).digest
+            self.assertTrue(blobs.exists(digest, 'thumb200.jpeg'))
+        client = test_app.test_client()
+        resp = client.get(self.url, query_string={'id': image_id, 'size': 200})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'image/jpeg')
+        self.assertEqual(PILImage.open(BytesIO(resp.data)).size, (200, 100))
+
+    def test_other_size(self):
+        image_id = self.add_picture(fake_picture(800, 400, 'RGBA', 'PNG'))
+        client = test_app.test_client()
+        resp = client.get(self.url, query_string={'id': image_id, 'size': 80})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'image/png')
+        self.assertEqual(PILImage.open(BytesIO(resp.data)).size, (80, 40))
+        etag = resp.headers.get('ETag')
+
+        resp = client.get(
+            self.url,
+            query_string={'id': image_id, 'size': 80},
+            headers={'If-None-Match': etag},
+        )
+        self.assertEqual(resp.status_code, 304)
+
+    def test_not_a_picture(self):
+        client = test_app.test_client()
+        resp = client.get(self.url, query_string={'id': 1, 'size': 200})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, b'abcdefggggggg')
+
+    def test_illegal_size(self):
+        client = test_app.test_client()
+        resp = client.get(self.url, query_string={'id': 1, 'size': 100000})
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn('error', resp.get_json())
+
+
+def fake_meme(variant):
+    """Variants of a picture: 'original', 'resized' (re-encoded, smaller and
+    lossy), 'recompressed' and 'rotated' (a different picture).
+    """
+    im = PILImage.effect_mandelbrot((256, 256), (-2, -1.5, 1, 1.5), 100).convert('RGB')
+    buf = BytesIO()
+    if variant == 'original':
+        im.save(buf, 'PNG')
+    elif variant == 'resized':
+        im.resize((120, 120)).save(buf, 'JPEG', quality=40)
+    elif variant == 'recompressed':
+        im.save(buf, 'JPEG', quality=90)
+    else:
+        im.rotate(90).save(buf, 'PNG')
+    return buf.getvalue()
+
+
+@unittest.skipIf(PILImage is None, 'Pillow is not installed')
+class TestImageSimilar(unittest.TestCase):
+    url = '/api/images/similar'
+
+    def setUp(self):
+        with test_app.app_context():
+            db.create_all()
+        client = test_app.test_client()
+        for variant in ('original', 'resized', 'rotated'):
+            client.post(
+                '/api/images/add',
+                data={
+                    'image': (BytesIO(fake_meme(variant)), f'{variant}.png'),
+                    'metadata': json.dumps({
+                        'img_type': 'png',
+                        'tags': [variant],
+                    })
+                }
+            )
+
+    def tearDown(self):
+        with test_app.app_context():
+            db.drop_all()
+
+    def test_similar(self):
+        client = test_app.test_client()
+        resp = client.get(self.url, query_string={'id': 1})
+        self.assertEqual(resp.status_code, 200)
+        json_data = resp.get_json()
+        self.assertEqual([r['id'] for r in json_data['data']], [2])
+        self.assertLessEqual(json_data['data'][0]['distance'], 10)
+
+    def test_distance(self):
+        client = test_app.test_client()
+        resp = client.get(self.url, query_string={'id': 1, 'distance': 64})
+        self.assertEqual([r['id'] for r in resp.get_json()['data']], [2, 3])
+        resp = client.get(self.url, query_string={'id': 1, 'distance': 65})
+        self.assertEqual(resp.status_code, 400)
+
+    def test_index_catches_up(self):
+        client = test_app.test_client()
+        client.get(self.url, query_string={'id': 1})
+        client.get('/api/images/delete', query_string={'id': 2})
+        client.post(
+            '/api/images/add',
+            data={
+                'image': (BytesIO(fake_meme('recompressed')), 'recompressed.jpeg'),
+                'metadata': json.dumps({
+                    'img_type': 'png',
+                    'tags': [],
+                })
+            }
+        )
+        resp = client.get(self.url, query_string={'id': 1})
+        self.assertEqual([r['id'] for r in resp.get_json()['data']], [4])
+
+    def test_index_reused_id(self):
+        client = test_app.test_client()
+        client.get('/api/images/delete', query_string={'id': 3})
+        client.get(self.url, query_string={'id': 1})
+        client.get('/api/images/delete', query_string={'id': 2})
+        # sqlite gives the id of the deleted newest image to the next one.
+        client.post(
+            '/api/images/add',
+            data={
+                'image': (BytesIO(fake_meme('recompressed')), 'recompressed.jpeg'),
+                'metadata': json.dumps({
+                    'img_type': 'png',
+                    'tags': [],
+                })
+            }
+        )
+        resp = client.get(self.url, query_string={'id': 1, 'distance': 64})
+        self.assertEqual([r['id'] for r in resp.get_json()['data']], [2])
+
+    def test_not_exists(self):
+        client = test_app.test_client()
+        resp = client.get(self.url, query_string={'id': 10000})
+        self.assertEqual(resp.status_code, 404)
+
+
+class TestImageKeysetPagination(unittest.TestCase):
+    url = '/api/images/'
+
+    def setUp(self):
+        with test_app.app_context():
+            db.create_all()
+            fake_images(25)
+
+    def tearDown(self):
+        with test_app.app_context():
+            db.drop_all()
+
+    def test_walk_pages(self):
+        client = test_app.test_client()
+        ids = []
+        cursor = ''
+        while cursor is not None:
+            resp = client.get(self.url, query_string={'after': cursor, 'per_page': 10})
+            self.assertEqual(resp.status_code, 200)
+            json_data = resp.get_json()
+            self.assertNotIn('total', json_data['pagination'])
+            ids += [r['id'] for r in json_data['data']]
+            cursor = json_data['pagination']['next_cursor']
+        # 所有图片 create_at 相同，按 id 排序
+        self.assertEqual(ids, list(range(1, 26)))
+
+    def test_sub_second_create_at(self):
+        with test_app.app_context():
+            for image in Image.query.all():
+                # 1s, 1.25s, 1.5s, 1s ... not the order of the ids
+                image.create_at = datetime(2020, 1, 1, 0, 0, 1, (image.id % 3) * 250000)
+            db.session.commit()
+        client = test_app.test_client()
+        ids = []
+        cursor = ''
+        while cursor is not None:
+            resp = client.get(self.url, query_string={'after': cursor, 'per_page': 2})
+            self.assertEqual(resp.status_code, 200)
+            ids += [r['id'] for r in resp.get_json()['data']]
+            cursor = resp.get_json()['pagination']['next_cursor']
+        self.assertEqual(sorted(ids), list(range(1, 26)))
+
+    def test_with_total(self):
+        client = test_app.test_client()
+        resp = client.get(self.url, query_string={'after': '', 'with_total': 1})
+        self.assertEqual(resp.get_json()['pagination']['total'], 25)
+
+    def test_cached_apart_from_offset_pagination(self):
+        client = test_app.test_client()
+        for first, second in (({}, {'after': ''}), ({'after': ''}, {})):
+            client.get(self.url, query_string={'per_page': 2, **first})
+            resp = client.get(self.url, query_string={'per_page': 2, **second})
+            pagination = resp.get_json()['pagination']
+            if 'after' in second:
+                self.assertIn('next_cursor', pagination)
+            else:
+                self.assertIn('total', pagination)
+
+    def test_bad_cursor(self):
+        client = test_app.test_client()
+        resp = client.get(self.url, query_string={'after': 'illegal'})
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn('error', resp.get_json())
+
+
 class TestImageSearch(unittest.TestCase):
     url = '/api/images/'
 
@@ -90,19 +384,19 @@ class TestImageSearch(unittest.TestCase):
                 name=f'testGroup',
             )
             img1 = Image(
-                data=b'abcdefggggggg',
+                data=b'image1',
                 img_type='jpeg',
                 tags=['aTag'],
             )
             img2 = Image(
-                data=b'abcdefggggggg',
+                data=b'image2',
                 img_type='jpeg',
                 tags=['bTag'],
             )
             group.images = [img1, img2]
             db.session.add(group)
             img3 = Image(
-                data=b'abcdefggggggg',
+                data=b'image3',
                 img_type='jpeg',
                 tags=['cTag'],
             )
@@ -124,6 +418,68 @@ class TestImageSearch(unittest.TestCase):
         self.assertIn('data', json_data)
         self.assertEqual(len(json_data['data']), 1)
 
+    def test_search_tag_exact_match(self):
+        with test_app.app_context():
+            fake_image = Image(data=b'image4', img_type='jpeg', tags=['aTagSuffix'])
+            db.session.add(fake_image)
+            db.session.commit()
+        client = test_app.test_client()
+        resp = client.get(
+            self.url,
+            query_string={'tag': 'aTag'}
+        )
+        self.assertEqual(resp.status_code, 200)
+        json_data = resp.get_json()
+        self.assertEqual([r['tags'] for r in json_data['data']], [['aTag']])
+
+    def test_search_tag_prefix(self):
+        with test_app.app_context():
+            fake_image = Image(data=b'image4', img_type='jpeg', tags=['aTagSuffix'])
+            db.session.add(fake_image)
+            db.session.commit()
+        client = test_app.test_client()
+        resp = client.get(
+            self.url,
+            query_string={'tag_prefix': 'aTa'}
+        )
+        self.assertEqual(resp.status_code, 200)
+        json_data = resp.get_json()
+        self.assertEqual(len(json_data['data']), 2)
+
+    def test_search_fulltext(self):
+        with test_app.app_context():
+            db.session.add(Image(
+                data=b'image4', img_type='jpeg',
+                filename='funny_cat.jpeg', tags=['喵星人表情包'],
+            ))
+            db.session.add(Image(
+                data=b'image5', img_type='jpeg',
+                filename='dog.jpeg', tags=['cat'],
+            ))
+            db.session.commit()
+        client = test_app.test_client()
+        resp = client.get(self.url, query_string={'q': 'cat'})
+        self.assertEqual(resp.status_code, 200)
+        json_data = resp.get_json()
+        # 标签匹配权重高于文件名
+        self.assertEqual([r['tags'] for r in json_data['data']], [['cat'], ['喵星人表情包']])
+
+        resp = client.get(self.url, query_string={'q': '星人表'})
+        self.assertEqual(len(resp.get_json()['data']), 1)
+
+        resp = client.get(self.url, query_string={'q': 'testGr bT'})
+        self.assertEqual(len(resp.get_json()['data']), 1)
+
+    def test_search_fulltext_after_update(self):
+        client = test_app.test_client()
+        client.post('/api/groups/update', json={'name': 'testGroup', 'new_name': 'renamedGroup'})
+        client.post('/api/tags/add', json={'image_id': 3, 'tags': ['addedTag']})
+        client.get('/api/images/delete', query_string={'id': 1})
+        resp = client.get(self.url, query_string={'q': 'renamed'})
+        self.assertEqual([r['id'] for r in resp.get_json()['data']], [2])
+        resp = client.get(self.url, query_string={'q': 'addedTag'})
+        self.assertEqual([r['id'] for r in resp.get_json()['data']], [3])
+
     def test_search_group(self):
         client = test_app.test_client()
         resp = client.get(
@@ -150,6 +506,145 @@ class TestImageSearch(unittest.TestCase):
         self.assertEqual(len(json_data['data']), 1)
 
 
+class TestImageFilter(unittest.TestCase):
+    url = '/api/images/'
+
+    def setUp(self):
+        with test_app.app_context():
+            db.create_all()
+            funny = Group(name='funny')
+            other = Group(name='other group')
+            rows = [
+                # data, img_type, tags, group, create_at
+                (b'image1', 'jpeg', ['cat'], funny, datetime(2020, 1, 15)),
+                (b'image2', 'gif', ['cat', 'dog'], funny, datetime(2020, 6, 1)),
+                (b'image3', 'gif', ['cat'], None, datetime(2020, 12, 31, 23, 59, 59)),
+                (b'image4', 'png', ['dog'], other, datetime(2021, 3, 1)),
+                (b'image5', 'jpeg', ['catgirl', 'a (b)'], None, datetime(2021, 6, 1)),
+            ]
+            for data, img_type, tags, group, create_at in rows:
+                db.session.add(Image(data=data, img_type=img_type, tags=tags,
+                                     group=group, create_at=create_at))
+            db.session.commit()
+            # stored as CURRENT_TIMESTAMP does, without microseconds.
+            db.session.execute(text('UPDATE image SET create_at = substr(create_at, 1, 19)'))
+            db.session.commit()
+
+    def tearDown(self):
+        with test_app.app_context():
+            db.drop_all()
+
+    def ids(self, filter_, **args):
+        client = test_app.test_client()
+        resp = client.get(self.url, query_string={'filter': filter_, **args})
+        self.assertEqual(resp.status_code, 200, resp.get_json())
+        return [r['id'] for r in resp.get_json()['data']]
+
+    def test_tags(self):
+        self.assertEqual(self.ids('tag:cat AND tag:dog'), [2])
+        self.assertEqual(self.ids('tag:cat tag:dog'), [2])
+        self.assertEqual(self.ids('tag:cat OR tag:dog'), [1, 2, 3, 4])
+        self.assertEqual(self.ids('tag:cat -tag:dog'), [1, 3])
+        self.assertEqual(self.ids('tag:cat*'), [1, 2, 3, 5])
+        self.assertEqual(self.ids('tag:"a (b)"'), [5])
+        # AND binds tighter than OR
+        self.assertEqual(self.ids('tag:dog OR tag:cat AND type:jpeg'), [1, 2, 4])
+        self.assertEqual(self.ids('(tag:dog OR tag:cat) AND type:jpeg'), [1])
+
+    def test_groups(self):
+        self.assertEqual(self.ids('group:funny OR group:"other group"'), [1, 2, 4])
+        self.assertEqual(self.ids('ungrouped'), [3, 5])
+        # ungrouped images are not in any group
+        self.assertEqual(self.ids('NOT group:funny'), [3, 4, 5])
+        self.assertEqual(self.ids('NOT (group:funny OR ungrouped)'), [4])
+        self.assertEqual(self.ids('group:notExists'), [])
+        self.assertEqual(self.ids('NOT group:notExists'), [1, 2, 3, 4, 5])
+
+    def test_created(self):
+        self.assertEqual(self.ids('created:2020'), [1, 2, 3])
+        self.assertEqual(self.ids('created:2020-06'), [2])
+        self.assertEqual(self.ids('created>2020-06'), [3, 4, 5])
+        self.assertEqual(self.ids('created>=2020-06 created<2021'), [2, 3])
+        self.assertEqual(self.ids('created<=2020-12-31'), [1, 2, 3])
+        self.assertEqual(self.ids('created:"2020-12-31 23:59:59"'), [3])
+        self.assertEqual(self.ids('-created:2020'), [4, 5])
+        # periods ending after the year 9999
+        self.assertEqual(self.ids('created:9999'), [])
+        self.assertEqual(self.ids('created<=9999-12'), [1, 2, 3, 4, 5])
+        self.assertEqual(self.ids('created>"9999-12-31 23:59:59"'), [])
+        self.assertEqual(self.ids('created>="9999-12-31 23:59:59"'), [])
+        self.assertEqual(self.ids('NOT created>9999'), [1, 2, 3, 4, 5])
+
+    def test_type(self):
+        with test_app.app_context():
+            # imported from X.JPG
+            db.session.add(Image(data=b'image6', img_type='JPG', tags=[]))
+            db.session.commit()
+        self.assertEqual(self.ids('type:gif'), [2, 3])
+        self.assertEqual(self.ids('type:jpg'), [6])
+        self.assertEqual(self.ids('type:JPG'), [6])
+        self.assertEqual(self.ids('type:JPEG'), [1, 5])
+
+    def test_combined(self):
+        self.assertEqual(
+            self.ids('tag:cat* (group:funny OR ungrouped) -type:gif created>=2020-01-15'),
+            [1, 5],
+        )
+        # with other params and both paginations
+        self.assertEqual(self.ids('type:gif', tag='dog'), [2])
+        self.assertEqual(self.ids('tag:cat*', per_page=2, page=2), [3, 5])
+        client = test_app.test_client()
+        resp = client.get(self.url, query_string={'filter': 'tag:cat*', 'after': '', 'per_page': 3})
+        json_data = resp.get_json()
+        self.assertEqual([r['id'] for r in json_data['data']], [1, 2, 3])
+        self.assertEqual(
+            self.ids('tag:cat*', after=json_data['pagination']['next_cursor']), [5])
+
+    def test_one_query(self):
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip().startswith('SELECT') and 'FROM image ' in statement:
+                statements.append(statement)
+
+        with test_app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', count)
+            try:
+                self.ids('(tag:cat OR tag:dog) -tag:catgirl group:funny created:2020', after='')
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', count)
+        self.assertEqual(len(statements), 1)
+
+    def test_syntax_error(self):
+        client = test_app.test_client()
+        for filter_ in ('tag:', 'tag:cat AND', '(tag:cat', 'tag:cat)', 'color:red', 'cat',
+                        'tag>cat', 'created:2020-13', 'tag:"cat', 'NOT', '()',
+                        ' '.join(['tag:cat'] * 33), '(' * 20 + 'tag:cat' + ')' * 20):
+            resp = client.get(self.url, query_string={'filter': filter_})
+            self.assertEqual(resp.status_code, 400, filter_)
+            self.assertIn('error', resp.get_json())
+
+
+def add_concurrently(data):
+    """Return a before_cursor_execute listener which, before the first insert
+    into image, commits an image of data tagged aTag as another request would.
+    """
+    done = []
+
+    def listener(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith('INSERT INTO image ') and not done:
+            done.append(statement)
+            dbapi_conn = conn.connection
+            dbapi_conn.execute(
+                "INSERT INTO image (digest, size, img_type) VALUES (?, ?, 'jpeg')",
+                (hashlib.sha256(data).hexdigest(), len(data)),
+            )
+            dbapi_conn.execute("INSERT OR IGNORE INTO tag (name) VALUES ('aTag')")
+            dbapi_conn.execute("INSERT INTO image_tag (tag_id, image_id) SELECT id, 1 FROM tag WHERE name = 'aTag'")
+            dbapi_conn.commit()
+    return listener
+
+
 class TestImageAdd(unittest.TestCase):
     url = '/api/images/add'
 
@@ -201,6 +696,77 @@ class TestImageAdd(unittest.TestCase):
         with test_app.app_context():
             self.assertTrue(Image.query.get(1))
     
+    def add(self, client, tags, **metadata):
+        return client.post(
+            self.url,
+            data={
+                'image': (BytesIO(b'added image data'), 'test_image.jpeg'),
+                'metadata': json.dumps({
+                    'img_type': 'jpeg',
+                    'tags': tags,
+                    **metadata,
+                })
+            }
+        )
+
+    def test_dedup_merge(self):
+        client = test_app.test_client()
+        self.add(client, ['aTag'])
+        resp = self.add(client, ['aTag', 'bTag'])
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.get_json()['id'], 1)
+        with test_app.app_context():
+            self.assertEqual(Image.query.count(), 1)
+            self.assertEqual(Image.query.get(1).tags, ['aTag', 'bTag'])
+
+    def test_dedup_reject(self):
+        client = test_app.test_client()
+        self.add(client, ['aTag'])
+        resp = self.add(client, ['bTag'], dedup='reject')
+        self.assertEqual(resp.status_code, 409)
+        json_data = resp.get_json()
+        self.assertIn('error', json_data)
+        self.assertEqual(json_data['id'], 1)
+        with test_app.app_context():
+            self.assertEqual(Image.query.count(), 1)
+            self.assertEqual(Image.query.get(1).tags, ['aTag'])
+
+    def test_dedup_link(self):
+        client = test_app.test_client()
+        self.add(client, ['aTag'])
+        resp = self.add(client, ['bTag'], dedup='link')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.get_json()['id'], 1)
+        with test_app.app_context():
+            self.assertEqual(Image.query.count(), 1)
+            self.assertEqual(Image.query.get(1).tags, ['aTag'])
+
+    def test_dedup_invalid(self):
+        client = test_app.test_client()
+        resp = self.add(client, [], dedup='replace')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_dedup_race(self):
+        client = test_app.test_client()
+        for dedup, status, tags in (('reject', 409, ['aTag']), ('merge', 200, ['aTag', 'bTag'])):
+            with test_app.app_context():
+                db.drop_all()
+                db.create_all()
+                # the same content is committed by another request after the
+                # digest lookup.
+                listener = add_concurrently(b'added image data')
+                event.listen(db.engine, 'before_cursor_execute', listener)
+            try:
+                resp = self.add(client, ['bTag'], dedup=dedup)
+            finally:
+                with test_app.app_context():
+                    event.remove(db.engine, 'before_cursor_execute', listener)
+            self.assertEqual(resp.status_code, status)
+            self.assertEqual(resp.get_json()['id'], 1)
+            with test_app.app_context():
+                self.assertEqual(Image.query.count(), 1)
+                self.assertEqual(Image.query.get(1).tags, tags)
+
     def test_with_group(self):
         # setup
         with test_app.app_context():
@@ -258,6 +824,32 @@ class TestImageDelete(unittest.TestCase):
         with test_app.app_context():
             self.assertFalse(Image.query.get(1))
     
+    def test_delete_blob(self):
+        client = test_app.test_client()
+        with test_app.app_context():
+            image = Image(data=b'only referenced once', img_type='jpeg', tags=[])
+            db.session.add(image)
+            db.session.commit()
+            image_id, digest = image.id, image.digest
+            self.assertTrue(blobs.exists(digest))
+        resp = client.get(self.url, query_string={'id': image_id})
+        self.assertEqual(resp.status_code, 200)
+        with test_app.app_context():
+            self.assertFalse(blobs.exists(digest))
+
+    def test_keep_blob_referenced_again(self):
+        with test_app.app_context():
+            image = Image(data=b'deleted then added again', img_type='jpeg', tags=[])
+            db.session.add(image)
+            db.session.commit()
+            digest = image.digest
+            db.session.delete(image)
+            # found orphan here, then referenced again before the commit.
+            db.session.flush()
+            db.session.add(Image(data=b'deleted then added again', img_type='jpeg', tags=[]))
+            db.session.commit()
+            self.assertTrue(blobs.exists(digest))
+
     def test_delete_not_exists_image(self):
         client = test_app.test_client()
         resp = client.get(
@@ -332,3 +924,271 @@ class TestImageUpdate(unittest.TestCase):
                 Image.query.get(2).group_id,
                 None,
             )
+
+
+class TestImageBatch(unittest.TestCase):
+    def setUp(self):
+        with test_app.app_context():
+            db.create_all()
+            fake_images(3)
+            fake_groups(1)
+
+    def tearDown(self):
+        with test_app.app_context():
+            db.drop_all()
+
+    def test_batch_update(self):
+        client = test_app.test_client()
+        resp = client.post('/api/images/batch/update', json={
+            'ids': [1, 2, 10000],
+            'group': 'testGroup1',
+        })
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.get_json()['count'], 2)
+        resp = client.get('/api/images/', query_string={'group': 'testGroup1'})
+        self.assertEqual(len(resp.get_json()['data']), 4)
+
+        resp = client.post('/api/images/batch/update', json={
+            'ids': [1, 4],
+            'group': None,
+        })
+        self.assertEqual(resp.status_code, 200)
+        with test_app.app_context():
+            self.assertIsNone(Image.query.get(1).group)
+            self.assertIsNone(Image.query.get(4).group)
+            self.assertEqual(Image.query.get(2).group.name, 'testGroup1')
+
+    def test_batch_update_not_exists_group(self):
+        client = test_app.test_client()
+        resp = client.post('/api/images/batch/update', json={
+            'ids': [1],
+            'group': 'notExistsGroup',
+        })
+        self.assertEqual(resp.status_code, 404)
+
+    def test_batch_delete(self):
+        with test_app.app_context():
+            digests = [Image.query.get(i).digest for i in (1, 2)]
+        client = test_app.test_client()
+        resp = client.post('/api/images/batch/delete', json={'ids': [1, 2, 10000]})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.get_json()['count'], 2)
+        with test_app.app_context():
+            self.assertEqual(Image.query.count(), 3)
+            self.assertIsNone(Image.query.get(1))
+            for digest in digests:
+                self.assertFalse(blobs.exists(digest))
+        resp = client.get('/api/images/', query_string={'tag': 'aTag'})
+        self.assertEqual(len(resp.get_json()['data']), 3)
+
+    def test_invalid_ids(self):
+        client = test_app.test_client()
+        resp = client.post('/api/images/batch/delete', json={'ids': [1, 'a']})
+        self.assertEqual(resp.status_code, 400)
+
+
+class TestImageAddBatch(unittest.TestCase):
+    url = '/api/images/add_batch'
+
+    def setUp(self):
+        with test_app.app_context():
+            db.create_all()
+            group = Group(name='testGroup')
+            db.session.add(group)
+            db.session.commit()
+
+    def tearDown(self):
+        with test_app.app_context():
+            db.drop_all()
+
+    def test_add_batch(self):
+        client = test_app.test_client()
+        resp = client.post(
+            self.url,
+            data={
+                'metadata': json.dumps({
+                    'tags': ['common'],
+                    'group': 'testGroup',
+                }),
+                'images': [
+                    (BytesIO(b'image a'), 'a.jpeg'),
+                    (BytesIO(b'image b'), 'b.GIF'),
+                    (BytesIO(b'image a'), 'c.jpeg'),
+                ],
+            }
+        )
+        self.assertEqual(resp.status_code, 200)
+        json_data = resp.get_json()
+        self.assertEqual(
+            [(r['filename'], r['id'], r['status']) for r in json_data['data']],
+            [('a.jpeg', 1, 'added'), ('b.GIF', 2, 'added'), ('c.jpeg', 1, 'merge')],
+        )
+        with test_app.app_context():
+            image = Image.query.get(1)
+            self.assertEqual(image.data, b'image a')
+            # in the order added: c.jpeg was merged last.
+            self.assertEqual(image.tags, ['a', 'common', 'c'])
+            self.assertEqual(image.group.name, 'testGroup')
+            self.assertEqual(Image.query.get(2).img_type, 'gif')
+
+    def test_reject(self):
+        client = test_app.test_client()
+        data = {
+            'metadata': json.dumps({'dedup': 'reject'}),
+            'images': [(BytesIO(b'image a'), 'a.jpeg')],
+        }
+        client.post(self.url, data=data)
+        data['images'] = [(BytesIO(b'image a'), 'a.jpeg')]
+        resp = client.post(self.url, data=data)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.get_json()['data'][0]['status'], 'reject')
+        with test_app.app_context():
+            self.assertEqual(Image.query.count(), 1)
+
+    def test_dedup_race(self):
+        client = test_app.test_client()
+        listener = add_concurrently(b'image a')
+        with test_app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            resp = client.post(self.url, data={
+                'metadata': json.dumps({'dedup': 'link'}),
+                'images': [(BytesIO(b'image a'), 'a.jpeg'), (BytesIO(b'image b'), 'b.jpeg')],
+            })
+        finally:
+            with test_app.app_context():
+                event.remove(db.engine, 'before_cursor_execute', listener)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            [(r['id'], r['status']) for r in resp.get_json()['data']],
+            [(1, 'link'), (2, 'added')],
+        )
+        with test_app.app_context():
+            self.assertEqual(Image.query.get(1).tags, ['aTag'])
+
+    def test_metadata_after_images(self):
+        client = test_app.test_client()
+        resp = client.post(self.url, data={
+            'images': [(BytesIO(b'image a'), 'a.jpeg')],
+            'metadata': json.dumps({'group': 'testGroup'}),
+        })
+        self.assertEqual(resp.status_code, 200)
+        with test_app.app_context():
+            self.assertEqual(Image.query.get(1).group.name, 'testGroup')
+
+    def test_no_image(self):
+        client = test_app.test_client()
+        resp = client.post(self.url, data={'metadata': '{}'})
+        self.assertEqual(resp.status_code, 400)
+
+    def test_not_exists_group(self):
+        client = test_app.test_client()
+        resp = client.post(
+            self.url,
+            data={
+                'metadata': json.dumps({'group': 'notExistsGroup'}),
+                'images': [(BytesIO(b'image a'), 'a.jpeg')],
+            }
+        )
+        self.assertEqual(resp.status_code, 400)
+        with test_app.app_context():
+            self.assertEqual(Image.query.count(), 0)
+
+
+class TestImageListResponseCache(unittest.TestCase):
+    url = '/api/images/'
+
+    def setUp(self):
+        with test_app.app_context():
+            db.create_all()
+            fake_images(3)
+            self.engine = db.engine
+        self.statements = []
+        event.listen(self.engine, 'before_cursor_execute', self.count_statement)
+
+    def tearDown(self):
+        event.remove(self.engine, 'before_cursor_execute', self.count_statement)
+        test_app.config['RESPONSE_CACHE_TTL'] = 30
+        with test_app.app_context():
+            db.drop_all()
+
+    def count_statement(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def test_served_without_database(self):
+        client = test_app.test_client()
+        resp = client.get(self.url, query_string={'page': 1, 'per_page': 2})
+        self.assertTrue(self.statements)
+        del self.statements[:]
+        # same params in another order.
+        cached = client.get(self.url, query_string={'per_page': 2, 'page': 1})
+        self.assertEqual(self.statements, [])
+        self.assertEqual(cached.get_json(), resp.get_json())
+
+        resp = client.get(
+            self.url,
+            query_string={'page': 1, 'per_page': 2},
+            headers={'If-None-Match': cached.headers['ETag']},
+        )
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(self.statements, [])
+
+    def test_invalidated_by_write(self):
+        client = test_app.test_client()
+        resp = client.get(self.url, query_string={'tag': 'cTag'})
+        self.assertEqual(len(resp.get_json()['data']), 0)
+        client.post('/api/tags/add', json={'image_id': 1, 'tags': ['cTag']})
+        resp = client.get(self.url, query_string={'tag': 'cTag'})
+        self.assertEqual(len(resp.get_json()['data']), 1)
+
+    def test_ttl(self):
+        test_app.config['RESPONSE_CACHE_TTL'] = 0
+        client = test_app.test_client()
+        client.get(self.url)
+        del self.statements[:]
+        client.get(self.url)
+        self.assertTrue(self.statements)
+
+
+class TestImageListQueries(unittest.TestCase):
+    url = '/api/images/'
+
+    def setUp(self):
+        with test_app.app_context():
+            db.create_all()
+            fake_groups(10)
+            self.engine = db.engine
+        self.statements = []
+        event.listen(self.engine, 'before_cursor_execute', self.count_statement)
+
+    def tearDown(self):
+        event.remove(self.engine, 'before_cursor_execute', self.count_statement)
+        with test_app.app_context():
+            db.drop_all()
+
+    def count_statement(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def count_queries(self, **query_string):
+        del self.statements[:]
+        resp = test_app.test_client().get(self.url, query_string=query_string)
+        self.assertEqual(resp.status_code, 200)
+        return len(self.statements), resp.get_json()['data']
+
+    def test_constant_query_count(self):
+        few, data = self.count_queries(per_page=2)
+        self.assertEqual(len(data), 2)
+        many, data = self.count_queries(per_page=20)
+        self.assertEqual(len(data), 20)
+        self.assertEqual(few, many)
+        self.assertEqual(data[0]['group'], 'testGroup1')
+        self.assertEqual(data[0]['tags'], ['aTag', 'bTag'])
+        self.assertRegex(data[0]['create_at'], r'^\d{4}-\d\d-\d\d \d\d:\d\d:\d\d$')
+
+        few, _ = self.count_queries(per_page=2, after='')
+        many, _ = self.count_queries(per_page=20, after='')
+        self.assertEqual(few, many)
+
+    def test_no_blob_column(self):
+        self.count_queries(per_page=20)
+        self.assertFalse([s for s in self.statements if 'digest' in s])
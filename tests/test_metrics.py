@@ -0,0 +1,63 @@
+import unittest
+import re
+
+from meme_manager import create_app, db, Image
+
+from tests.test_images import fake_images
+
+
+class TestMetrics(unittest.TestCase):
+    url = '/api/metrics'
+
+    def setUp(self):
+        # a fresh app, so no other test's request is counted.
+        self.app = create_app('test')
+        with self.app.app_context():
+            db.create_all()
+            fake_images(5)
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.drop_all()
+
+    def test_prometheus_text(self):
+        client = self.app.test_client()
+        client.get('/api/images/', query_string={'per_page': 5})
+        client.get('/api/images/', query_string={'per_page': 2})
+        resp = client.get(self.url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.content_type.startswith('text/plain'))
+        text = resp.get_data(as_text=True)
+        self.assertIn('# TYPE meme_http_request_duration_seconds histogram', text)
+        labels = '{method="GET",endpoint="/api/images/"'
+        self.assertIn(f'meme_http_request_duration_seconds_count{labels}}} 2', text)
+        self.assertIn(f'meme_http_request_duration_seconds_bucket{labels},le="+Inf"}} 2', text)
+        self.assertIn(f'meme_http_responses_total{labels},status="200"}} 2', text)
+        self.assertIn(f'meme_sql_queries_per_request_bucket{labels},le="0"}} 0', text)
+        queries = re.search(rf'meme_sql_queries_per_request_sum{re.escape(labels)}}} (\d+)', text)
+        self.assertGreater(int(queries.group(1)), 0)
+        size = re.search(rf'meme_http_response_bytes_total{re.escape(labels)}}} (\d+)', text)
+        self.assertGreater(int(size.group(1)), 0)
+
+    def test_blob_bytes(self):
+        client = self.app.test_client()
+        with self.app.app_context():
+            image = Image.query.first()
+            image_id, size = image.id, image.size
+        resp = client.get('/api/images/', query_string={'id': image_id})
+        resp.close()
+        text = client.get(self.url).get_data(as_text=True)
+        self.assertIn(f'meme_http_response_bytes_total{{method="GET",endpoint="/api/images/"}} {size}', text)
+
+    def test_slow_requests(self):
+        self.app.config['METRICS_SLOW_REQUEST'] = 0
+        client = self.app.test_client()
+        client.get('/api/images/', query_string={'tag': 'aTag'})
+        resp = client.get(self.url + '/slow')
+        self.assertEqual(resp.status_code, 200)
+        entries = resp.get_json()['data']
+        entry = entries[0]
+        self.assertEqual(entry['url'], '/api/images/?tag=aTag')
+        self.assertEqual(entry['status'], 200)
+        self.assertEqual(entry['query_count'], len(entry['queries']))
+        self.assertTrue(any('tag.name' in q['statement'] for q in entry['queries']))
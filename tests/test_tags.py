@@ -10,7 +10,7 @@ from tests import test_app
 def fake_records(n):
     for i in range(n):
         img = Image(
-            data=b'abcdefggggggg',
+            data=b'abcdefggggggg' + b'g' * i,
             img_type='jpeg',
             tags=['aTag', 'bTag'],
         )
@@ -40,6 +40,18 @@ class TestTagsShow(unittest.TestCase):
         json_data = resp.get_json()
         self.assertIn('data', json_data)
 
+    def test_order_added(self):
+        with test_app.app_context():
+            db.session.add(Image(data=b'ordered', img_type='jpeg', tags=['zebra', 'b', 'a']))
+            db.session.commit()
+        client = test_app.test_client()
+        client.post('/api/tags/add', json={'image_id': 21, 'tags': ['aa']})
+        client.post('/api/tags/delete', json={'image_id': 21, 'tag': 'b'})
+        resp = client.get(self.url, query_string={'image_id': 21})
+        self.assertEqual(resp.get_json()['data'], ['zebra', 'a', 'aa'])
+        resp = client.get('/api/images/', query_string={'tag': 'zebra'})
+        self.assertEqual(resp.get_json()['data'][0]['tags'], ['zebra', 'a', 'aa'])
+
 
 class TestTagsAdd(unittest.TestCase):
     url = '/api/tags/add'
@@ -103,3 +115,200 @@ class TestTagDelete(unittest.TestCase):
         with test_app.app_context():
             image = Image.query.get(1)
             self.assertNotIn('aTag', image.tags)
+
+
+class TestTagsBatch(unittest.TestCase):
+    def setUp(self):
+        with test_app.app_context():
+            db.create_all()
+            fake_records(3)
+
+    def tearDown(self):
+        with test_app.app_context():
+            db.drop_all()
+
+    def test_batch_add(self):
+        client = test_app.test_client()
+        resp = client.post('/api/tags/batch/add', json={
+            'image_ids': [1, 2, 10000],
+            'tags': ['aTag', 'cTag'],
+        })
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.get_json()['count'], 2)
+        with test_app.app_context():
+            self.assertEqual(Image.query.get(1).tags, ['aTag', 'bTag', 'cTag'])
+            self.assertEqual(Image.query.get(2).tags, ['aTag', 'bTag', 'cTag'])
+            self.assertEqual(Image.query.get(3).tags, ['aTag', 'bTag'])
+        resp = client.get('/api/images/', query_string={'tag': 'cTag'})
+        self.assertEqual(len(resp.get_json()['data']), 2)
+
+    def test_batch_delete(self):
+        client = test_app.test_client()
+        resp = client.post('/api/tags/batch/delete', json={
+            'image_ids': [1, 3],
+            'tags': ['aTag', 'notExistsTag'],
+        })
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.get_json()['count'], 2)
+        with test_app.app_context():
+            self.assertEqual(Image.query.get(1).tags, ['bTag'])
+            self.assertEqual(Image.query.get(2).tags, ['aTag', 'bTag'])
+            self.assertEqual(Image.query.get(3).tags, ['bTag'])
+
+    def test_invalid_ids(self):
+        client = test_app.test_client()
+        resp = client.post('/api/tags/batch/add', json={
+            'image_ids': '1,2',
+            'tags': ['aTag'],
+        })
+        self.assertEqual(resp.status_code, 400)
+
+
+class TestTagsSuggest(unittest.TestCase):
+    url = '/api/tags/suggest'
+
+    def setUp(self):
+        with test_app.app_context():
+            db.create_all()
+            for i, tags in enumerate([['apple', 'banana'], ['apple', 'apricot'], ['apple', 'Avocado'], ['blue']]):
+                db.session.add(Image(data=f'suggest{i}'.encode(), img_type='jpeg', tags=tags))
+            db.session.commit()
+
+    def tearDown(self):
+        with test_app.app_context():
+            db.drop_all()
+
+    def test_prefix(self):
+        client = test_app.test_client()
+        resp = client.get(self.url, query_string={'prefix': 'a'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.get_json()['data'], [
+            {'name': 'apple', 'count': 3},
+            {'name': 'apricot', 'count': 1},
+        ])
+
+    def test_most_used(self):
+        client = test_app.test_client()
+        resp = client.get(self.url, query_string={'limit': 2})
+        self.assertEqual([t['name'] for t in resp.get_json()['data']], ['apple', 'Avocado'])
+
+    def test_kept_current(self):
+        client = test_app.test_client()
+        self.assertEqual(client.get(self.url, query_string={'prefix': 'b'}).get_json()['data'],
+                         [{'name': 'banana', 'count': 1}, {'name': 'blue', 'count': 1}])
+        client.post('/api/tags/add', json={'image_id': 4, 'tags': ['banana']})
+        client.post('/api/tags/delete', json={'image_id': 4, 'tag': 'blue'})
+        self.assertEqual(client.get(self.url, query_string={'prefix': 'b'}).get_json()['data'],
+                         [{'name': 'banana', 'count': 2}])
+        client.get('/api/images/delete', query_string={'id': 1})
+        self.assertEqual(client.get(self.url, query_string={'prefix': 'b'}).get_json()['data'],
+                         [{'name': 'banana', 'count': 1}])
+
+    def test_bad_limit(self):
+        client = test_app.test_client()
+        resp = client.get(self.url, query_string={'limit': 0})
+        self.assertEqual(resp.status_code, 400)
+
+
+class TestTagsAll(unittest.TestCase):
+    url = '/api/tags/all'
+
+    def setUp(self):
+        with test_app.app_context():
+            db.create_all()
+            for i, tags in enumerate([['b', 'a'], ['b', 'c'], ['b', 'c']]):
+                db.session.add(Image(data=f'all{i}'.encode(), img_type='jpeg', tags=tags))
+            db.session.commit()
+
+    def tearDown(self):
+        with test_app.app_context():
+            db.drop_all()
+
+    def get(self, **query_string):
+        resp = test_app.test_client().get(self.url, query_string=query_string)
+        self.assertEqual(resp.status_code, 200)
+        return [(t['name'], t['count']) for t in resp.get_json()['data']]
+
+    def test_sort(self):
+        self.assertEqual(self.get(), [('b', 3), ('c', 2), ('a', 1)])
+        self.assertEqual(self.get(sort='count', order='asc'), [('a', 1), ('c', 2), ('b', 3)])
+        self.assertEqual(self.get(sort='name'), [('a', 1), ('b', 3), ('c', 2)])
+        self.assertEqual(self.get(limit=2), [('b', 3), ('c', 2)])
+
+    def test_bad_args(self):
+        client = test_app.test_client()
+        for query_string in ({'sort': 'x'}, {'order': 'x'}, {'limit': 0}):
+            resp = client.get(self.url, query_string=query_string)
+            self.assertEqual(resp.status_code, 400)
+
+    def test_counts_maintained(self):
+        client = test_app.test_client()
+        client.post('/api/tags/add', json={'image_id': 1, 'tags': ['c', 'd']})
+        client.post('/api/tags/delete', json={'image_id': 2, 'tag': 'b'})
+        client.post('/api/tags/batch/add', json={'image_ids': [1, 2, 3], 'tags': ['e']})
+        client.post('/api/tags/batch/delete', json={'image_ids': [3], 'tags': ['e']})
+        self.assertEqual(self.get(), [('c', 3), ('b', 2), ('e', 2), ('a', 1), ('d', 1)])
+        client.get('/api/images/delete', query_string={'id': 1})
+        client.post('/api/images/batch/delete', json={'ids': [3]})
+        self.assertEqual(self.get(), [('c', 1), ('e', 1)])
+
+
+class TestTagsRenameMerge(unittest.TestCase):
+    def setUp(self):
+        with test_app.app_context():
+            db.create_all()
+            for i, tags in enumerate([['catt', 'a'], ['kitty', 'catt'], ['kitten'], ['cat']]):
+                db.session.add(Image(data=f'rename{i}'.encode(), img_type='jpeg', tags=tags))
+            db.session.commit()
+
+    def tearDown(self):
+        with test_app.app_context():
+            db.drop_all()
+
+    def tags(self):
+        client = test_app.test_client()
+        return [client.get('/api/tags/', query_string={'image_id': i}).get_json()['data'] for i in range(1, 5)]
+
+    def counts(self):
+        data = test_app.test_client().get('/api/tags/all', query_string={'sort': 'name'}).get_json()['data']
+        return {t['name']: t['count'] for t in data}
+
+    def search(self, q):
+        data = test_app.test_client().get('/api/images/', query_string={'q': q}).get_json()['data']
+        return sorted(image['id'] for image in data)
+
+    def test_rename(self):
+        client = test_app.test_client()
+        resp = client.post('/api/tags/rename', json={'name': 'catt', 'new_name': 'tabby'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.get_json()['count'], 2)
+        # a renamed tag keeps its place
+        self.assertEqual(self.tags(), [['tabby', 'a'], ['kitty', 'tabby'], ['kitten'], ['cat']])
+        self.assertEqual(self.counts(), {'a': 1, 'cat': 1, 'kitten': 1, 'kitty': 1, 'tabby': 2})
+        self.assertEqual(self.search('tabby'), [1, 2])
+        self.assertEqual(self.search('catt'), [])
+
+    def test_rename_errors(self):
+        client = test_app.test_client()
+        resp = client.post('/api/tags/rename', json={'name': 'catt', 'new_name': 'cat'})
+        self.assertEqual(resp.status_code, 409)
+        resp = client.post('/api/tags/rename', json={'name': 'nope', 'new_name': 'x'})
+        self.assertEqual(resp.status_code, 404)
+        resp = client.post('/api/tags/rename', json={'name': 'catt', 'new_name': ''})
+        self.assertEqual(resp.status_code, 400)
+
+    def test_merge(self):
+        client = test_app.test_client()
+        resp = client.post('/api/tags/merge', json={'tags': ['catt', 'kitty', 'kitten', 'nope'], 'target': 'cat'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.get_json()['count'], 3)
+        self.assertEqual(self.tags(), [['a', 'cat'], ['cat'], ['cat'], ['cat']])
+        self.assertEqual(self.counts(), {'a': 1, 'cat': 4})
+        self.assertEqual(self.search('cat'), [1, 2, 3, 4])
+        self.assertEqual(self.search('kitten'), [])
+
+    def test_merge_into_new_tag(self):
+        client = test_app.test_client()
+        resp = client.post('/api/tags/merge', json={'tags': ['kitty', 'kitten'], 'target': 'kitty cat'})
+        self.assertEqual(resp.get_json()['count'], 2)
+        self.assertEqual(self.counts()['kitty cat'], 2)